@@ -1,17 +1,37 @@
+import io
 import os
 import uuid
-import fitz
-import gridfs
 import re
 import base64
-from bson import ObjectId
-from flask import Flask, request, jsonify, render_template
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import threading
+from flask import Blueprint, Flask, current_app, request, jsonify, render_template
+from datetime import datetime
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
-from docx import Document
+from llm_client import get_llm_client, LLMUnavailableError
+from conversation_memory import build_chat_messages, load_recent_turns, schedule_summary_update
+from chat_messages import (
+    InvalidCursor, new_message, iter_session_messages, history_page, encode_cursor, keyset_filter
+)
+import datastore
+from datastore import sessions as session_collection, messages as messages_collection
+from write_behind import WRITE_BEHIND, MessageWriter
+from http_cache import make_etag, not_modified, tagged
+import capture
+import http_cache
+import llm_usage
+import metrics
+import profiling
+import tracing
+from json_provider import FastJSONProvider, stream_response
+from rate_limit import RATE_LIMIT_BACKEND, ConcurrencyLimiter, RateLimited, RequestLimits, client_ip, get_backend
+from map_reduce import map_reduce_answer
+from extractive_qa import EXTRACTIVE_QA, extract_answer, get_index
+from lazy_imports import lazy_import
+
+# Heavy parsers, loaded on first use
+fitz = lazy_import("fitz")
+docx = lazy_import("docx")
 
 # ------------------------------
 # Load environment & setup
@@ -19,17 +39,20 @@ from docx import Document
 load_dotenv()
 api_key = os.getenv('AI21_API_KEY')
 
-# MongoDB setup
-mongo_client = MongoClient("mongodb://localhost:27017")
-db = mongo_client["chat_history_db"]
-fs = gridfs.GridFS(db)
-session_collection = db["chat_sessions"]
+# MongoDB connection settings and pooling live in datastore; the LLM client
+# and the message writer are built per worker in create_app()
+bp = Blueprint("chatbot", __name__)
 
-# AI21 setup
-client = AI21Client(api_key=api_key)
-
-# Flask app
-app = Flask(__name__)
+# /session/list and /chat/history page sizes
+SESSION_PAGE_SIZE = int(os.getenv("SESSION_PAGE_SIZE", "50"))
+SESSION_MAX_PAGE_SIZE = int(os.getenv("SESSION_MAX_PAGE_SIZE", "500"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "200"))
+# Full histories with at least this many turns are streamed straight from the cursor
+HISTORY_STREAM_MIN_ITEMS = int(os.getenv("HISTORY_STREAM_MIN_ITEMS", "1000"))
+# /usage report rows
+USAGE_REPORT_LIMIT = int(os.getenv("USAGE_REPORT_LIMIT", "50"))
+USAGE_REPORT_MAX_LIMIT = int(os.getenv("USAGE_REPORT_MAX_LIMIT", "1000"))
 
 
 # ------------------------------
@@ -43,55 +66,213 @@ def highlight(text, keyword):
 
 def extract_text_from_file(file_path, file_type):
     """Extract text depending on file type"""
+    with metrics.stage("extraction"):
+        return _extract_text(file_path, file_type)
+
+
+# PyMuPDF is not thread-safe: one PDF is parsed at a time per process (gthread
+# workers, ingest threads). Parallel PDF parsing takes processes (ingest --processes).
+_pdf_lock = threading.Lock()
+
+
+def pdf_text(*args, **kwargs):
+    """Text of a PDF opened with fitz.open(*args, **kwargs)"""
+    with _pdf_lock:
+        pdf = fitz.open(*args, **kwargs)
+        try:
+            return "".join([page.get_text() for page in pdf])
+        finally:
+            pdf.close()
+
+
+def _extract_text(file_path, file_type):
     if file_type == "txt":
         with open(file_path, "r", encoding="utf-8") as f:
             return f.read()
     elif file_type == "pdf":
-        pdf = fitz.open(file_path)
-        pdf_text = "".join([page.get_text() for page in pdf])
-        pdf.close()
-        return pdf_text
+        return pdf_text(file_path)
     elif file_type == "docx":
-        doc = Document(file_path)
+        doc = docx.Document(file_path)
         return "\n".join([p.text for p in doc.paragraphs])
     return ""
 
 
+def read_documents(documents, failures=None):
+    """
+    Fetch each session document from GridFS and return (filename, extracted text) pairs;
+    documents that can't be read are skipped, and their filenames added to `failures`
+    """
+    doc_content_parts = []
+    for d in documents:
+        try:
+            with tracing.span("document", filename=d["filename"], type=d["type"]):
+                if d.get("text_id"):
+                    # Extracted at ingest time (see ingest.py); no parsing on the request path
+                    with tracing.span("gridfs.fetch", gridfs_id=str(d["text_id"])):
+                        text = datastore.read_file(d["text_id"]).decode("utf-8")
+                else:
+                    with tracing.span("gridfs.fetch", gridfs_id=str(d["gridfs_id"])):
+                        content = datastore.read_file(d["gridfs_id"])
+                    text = extract_document(content, d["type"])
+                if text is not None:
+                    doc_content_parts.append((d["filename"], text))
+        except:
+            if failures is not None:
+                failures.append(d["filename"])
+    return doc_content_parts
+
+
+def read_all_documents(documents):
+    """(pairs, complete) for extractive_qa.get_index: only a read with no failures gets cached"""
+    failures = []
+    return read_documents(documents, failures), not failures
+
+
+def extract_document(content, file_type):
+    """Text of a stored document's bytes, or None for unsupported types (parsed in memory: no shared temp files)"""
+    if file_type not in ("txt", "pdf", "docx"):
+        return None
+    with metrics.stage("extraction"):
+        if file_type == "txt":
+            return content.decode("utf-8")
+        elif file_type == "pdf":
+            return pdf_text(stream=content, filetype="pdf")
+        doc = docx.Document(io.BytesIO(content))
+        return "\n".join([p.text for p in doc.paragraphs])
+
+
+def search_lines(doc_content_parts, query):
+    """Every line of the documents containing `query` (case-insensitive), highlighted"""
+    matches = []
+    for line in "\n".join(doc_content_parts).split("\n"):
+        if query.lower() in line.lower():
+            matches.append(highlight(line.strip(), query))
+    return matches
+
+
+def read_documents_text(documents):
+    """Fetch each session document from GridFS and return the extracted texts"""
+    return [text for _, text in read_documents(documents)]
+
+
+def llm():
+    """The current app's LLM client (timeouts, retries, hedging and circuit breaking live in llm_client)"""
+    return current_app.extensions["chatbot"]["llm"]
+
+
+def too_many_requests(error):
+    """429 for a RateLimited refusal"""
+    response = jsonify({"error": str(error), "retry_after": error.retry_after_header})
+    response.headers["Retry-After"] = error.retry_after_header
+    return response, 429
+
+
+def message_writer():
+    """The current app's chat message writer (see write_behind.py)"""
+    return current_app.extensions["chatbot"]["writer"]
+
+
+def save_chat_turn(session_id, question, answer, mode, usage):
+    """
+    Queue a Q&A turn, with the token counts of `usage` (an llm_usage.Tally),
+    for the messages collection and refresh the rolling summary; returns its cursor.
+    """
+    with metrics.stage("persistence"):
+        record = new_message(session_id, question, answer, mode, **usage.fields())
+        message_writer().submit(record)  # also bumps message_count / last_activity / usage rollups on flush
+        schedule_summary_update(llm(), session_collection, messages_collection, session_id,
+                                rollups=datastore.usage_rollups)
+    return encode_cursor(record)
+
+
+def system_prompt(mode, doc_content_parts):
+    """System instructions for a direct answer: all document text (local) or none (global)"""
+    if mode == "local":
+        doc_content = "\n\n".join(doc_content_parts)
+        return (
+            "You are an assistant that must only answer using the following document. "
+            "Do not use any external knowledge.\n\n"
+            f"{doc_content}\n\n"
+            "Instructions:\n"
+            "- If the answer is found, respond with '(From local source)' followed by the answer.\n"
+            "- If not found, respond with exactly: 'Not available in the document.'"
+        )
+    return (
+        "You are an AI assistant that answers using general knowledge.\n"
+        "Important - Along with the answer, add this phrase: (From Global source)"
+    )
+
+
+def answer_directly(session, question, mode, doc_content_parts):
+    """Single LLM call with all document text (local) or none (global) in the prompt"""
+    with metrics.stage("prompt_build"):
+        system = system_prompt(mode, doc_content_parts)
+        turns = load_recent_turns(messages_collection, session["_id"], message_writer().pending(session["_id"]),
+                                  session.get("memory"))
+        messages = build_chat_messages(system, session.get("memory"), turns, question)
+    chat_completions = llm().chat.completions.create(
+        messages=messages,
+        model="jamba-large",
+    )
+    return chat_completions.choices[0].message.content
+
+
 # ------------------------------
 # ROUTES
 # ------------------------------
+SESSION_SUMMARY_FIELDS = {
+    "description": 1, "created_at": 1, "mode": 1,
+    "doc_count": 1, "message_count": 1, "last_activity": 1
+}
+
 
 # 📌 Route 1: Create a new session
-@app.route("/session/create", methods=["POST"])
+@bp.route("/session/create", methods=["POST"])
 def create_session():
     """Create a new chat session"""
     data = request.json
     session_id = str(uuid.uuid4())
     session_description = data.get("description", f"Session {session_id[:6]}")
 
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(timezone.utc),
-        "documents": [],
-        "chat_history": [],
-        "mode": "local"  # default mode
-    })
+    datastore.create_session(session_description, session_id, mode="local")  # default mode
     return jsonify({"session_id": session_id, "message": "Session created", "description": session_description}), 201
 
 
-# 📌 Route 2: List all sessions
-@app.route("/session/list", methods=["GET"])
+# 📌 Route 2: List sessions (newest first, one page at a time)
+@bp.route("/session/list", methods=["GET"])
 def list_sessions():
-    """List all saved chat sessions"""
-    sessions = list(session_collection.find({}, {"chat_history": 0}))
+    """
+    List saved chat sessions as lightweight summaries.
+    Query params: limit, cursor (next_cursor of the previous page), q (description filter)
+    """
+    try:
+        limit = max(1, min(int(request.args.get("limit", SESSION_PAGE_SIZE)), SESSION_MAX_PAGE_SIZE))
+        query = {}
+        if request.args.get("cursor"):
+            query.update(keyset_filter("$lt", request.args["cursor"], field="created_at"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    etag = make_etag("sessions", datastore.session_list_version(), sorted(request.args.items()))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    if request.args.get("q"):
+        query["description"] = {"$regex": re.escape(request.args["q"]), "$options": "i"}
+
+    sessions = list(session_collection.find(query, SESSION_SUMMARY_FIELDS)
+                    .sort([("created_at", -1), ("_id", -1)])
+                    .limit(limit + 1))
+    next_cursor = encode_cursor(sessions[limit - 1], field="created_at") if len(sessions) > limit else None
+    sessions = sessions[:limit]
     for s in sessions:
         s["_id"] = str(s["_id"])
-    return jsonify(sessions)
+    return tagged(jsonify({"sessions": sessions, "next_cursor": next_cursor}), etag)
 
 
 # 📌 Route 3: Upload a document (txt/pdf/docx)
-@app.route("/document/upload", methods=["POST"])
+@bp.route("/document/upload", methods=["POST"])
 def upload_document():
     """
     Upload a document to a session.
@@ -140,133 +321,166 @@ def upload_document():
             "received_files": list(request.files.keys())
         }), 400
 
+    tracing.annotate(session_id=session_id, filename=filename, bytes=len(file_content))
+
     # Store in GridFS + Mongo
-    file_id = fs.put(file_content, filename=filename)
-    session_collection.update_one(
-        {"_id": session_id},
-        {"$push": {
-            "documents": {
-                "filename": filename,
-                "gridfs_id": str(file_id),
-                "type": file_type,
-                "uploaded_at": datetime.now(timezone.utc)
-            }
-        }}
-    )
+    with metrics.stage("persistence"):
+        file_id = datastore.store_file(file_content, filename)
+        datastore.add_documents(session_id, [datastore.document_ref(filename, file_id, file_type)])
 
     return jsonify({
         "message": f"✅ {filename} uploaded successfully",
         "session_id": session_id,
-        "gridfs_id": str(file_id)
+        "gridfs_id": file_id
     })
 
 
 # 📌 Route 4: Ask a question (local docs or global knowledge)
-@app.route("/ask", methods=["POST"])
+@bp.route("/ask", methods=["POST"])
 def ask_question():
     """Ask a question either using local docs or general knowledge"""
     data = request.json
     session_id = data.get("session_id")
     question = data.get("question")
     mode = data.get("mode")  # frontend will send mode
+    tracing.annotate(session_id=session_id, mode=mode or "", strategy=data.get("strategy", "direct"))
+
+    # Per-IP and per-session token buckets, before any work is done
+    try:
+        current_app.extensions["chatbot"]["limits"].check("ask", session_id=session_id, ip=client_ip(request))
+    except RateLimited as e:
+        return too_many_requests(e)
 
-    session = session_collection.find_one({"_id": session_id})
+    # History lives in the messages collection; only what the prompt needs is loaded
+    session = datastore.get_session(session_id, ["documents", "memory"])
     if not session:
         return jsonify({"error": "Session not found"}), 404
 
-    # Collect text from documents
-    doc_content_parts = []
-    for d in session.get("documents", []):
-        try:
-            gridout = fs.get(ObjectId(d["gridfs_id"]))
-            content = gridout.read()
-
-            if d["type"] == "txt":
-                doc_content_parts.append(content.decode("utf-8"))
-            elif d["type"] == "pdf":
-                with open("temp.pdf", "wb") as f:
-                    f.write(content)
-                pdf = fitz.open("temp.pdf")
-                pdf_text = "".join([page.get_text() for page in pdf])
-                pdf.close()
-                doc_content_parts.append(pdf_text)
-            elif d["type"] == "docx":
-                with open("temp.docx", "wb") as f:
-                    f.write(content)
-                docx = Document("temp.docx")
-                docx_text = "\n".join([p.text for p in docx.paragraphs])
-                doc_content_parts.append(docx_text)
-        except:
-            continue
+    # "map_reduce" opts in to chunked answering for corpora larger than the context window
+    strategy = data.get("strategy", "direct")
+    # "refine" asks for an LLM answer even when a document sentence answers the question
+    refine = bool(data.get("refine"))
+    documents = session.get("documents", [])
+    extra = {}
+
+    # Fast path: answer straight from a document sentence, no LLM call
+    index = None
+    if mode == "local" and strategy == "direct" and EXTRACTIVE_QA and not refine:
+        with metrics.stage("retrieval"):
+            index = get_index(tuple(d.get("gridfs_id") for d in documents), lambda: read_all_documents(documents))
+            extracted = extract_answer(index, question)
+        if extracted:
+            cursor = save_chat_turn(session_id, question, extracted["answer"], mode, llm_usage.Tally())
+            return jsonify({**extracted, "extractive": True, "cursor": cursor})
 
-    doc_content = "\n\n".join(doc_content_parts)
+    # Collect text from documents
+    doc_content_parts = index.texts if index else read_documents_text(documents)
 
-    # Define system prompt
-    if mode == "local":
-        system = (
-            "You are an assistant that must only answer using the following document. "
-            "Do not use any external knowledge.\n\n"
-            f"{doc_content}\n\n"
-            "Instructions:\n"
-            "- If the answer is found, respond with '(From local source)' followed by the answer.\n"
-            "- If not found, respond with exactly: 'Not available in the document.'"
-        )
-    else:
-        system = (
-            "You are an AI assistant that answers using general knowledge.\n"
-            "Important - Along with the answer, add this phrase: (From Global source)"
-        )
+    try:
+        # Tokens of every call made for this answer, map-reduce fan-out included
+        with llm_usage.collect() as usage:
+            if mode == "local" and strategy == "map_reduce":
+                # Map calls run on worker threads; the whole fan-out counts as this request's llm time
+                with metrics.stage("llm"):
+                    response, extra["map_reduce"] = map_reduce_answer(llm(), question, doc_content_parts)
+            else:
+                response = answer_directly(session, question, mode, doc_content_parts)
+    except RateLimited as e:
+        # Every provider slot is taken and the wait queue is full
+        return too_many_requests(e)
+    except LLMUnavailableError as e:
+        return jsonify({"error": f"AI provider unavailable: {str(e)}"}), 503
+
+    cursor = save_chat_turn(session_id, question, response, mode, usage)
+
+    return jsonify({"answer": response, "cursor": cursor, "usage": usage.fields(), **extra})
+
+
+def parse_limit(value):
+    """A page size as the API sends them: an integer or a numeric string; ValueError otherwise"""
+    try:
+        return int(value)
+    except TypeError:
+        # JSON bodies can carry a list or an object here
+        raise ValueError(f"Invalid limit: {value!r} (expected an integer)")
 
-    messages = [
-        ChatMessage(content=system, role="system"),
-        ChatMessage(content=question, role="user"),
-    ]
-    chat_completions = client.chat.completions.create(
-        messages=messages,
-        model="jamba-large",
-    )
-    response = chat_completions.choices[0].message.content
-
-    # Save in chat history
-    session_collection.update_one(
-        {"_id": session_id},
-        {"$push": {
-            "chat_history": {
-                "question": question,
-                "answer": response,
-                "mode": mode,
-                "timestamp": datetime.now(timezone.utc)
-            }
-        }}
-    )
 
-    return jsonify({"answer": response})
+def parse_timestamp(value):
+    """A timestamp as the API sends them: ISO 8601 or HTTP-date; ValueError otherwise"""
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid timestamp: {value!r} (expected an ISO 8601 or HTTP-date string)")
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid timestamp: {value!r} (expected an ISO 8601 or HTTP-date string)")
 
 
-# 📌 Route 5: Get Full Chat History
-@app.route("/chat/history", methods=["POST"])
+# 📌 Route 5: Get Chat History (full, or one cursor page)
+@bp.route("/chat/history", methods=["POST"])
 def get_chat_history():
-    """Get all chat history for a given session_id"""
+    """
+    Get chat history for a given session_id.
+    Paging (all optional; without them the full history is returned):
+    - limit: page size (default HISTORY_PAGE_SIZE, max HISTORY_MAX_PAGE_SIZE)
+    - before / after: cursor of a message, for older pages / new messages
+    - since: ISO or HTTP-date timestamp (either JSON_DATETIME_FORMAT), messages newer than it
+    """
     data = request.json
     session_id = data.get("session_id")
 
     if not session_id:
         return jsonify({"error": "Missing session_id"}), 400
 
-    session = session_collection.find_one({"_id": session_id})
+    # Unflushed turns are part of the body but not yet of the session's version
+    pending = message_writer().pending(session_id)
+    version = datastore.session_version(session_id)
+    if version is None:
+        return jsonify({"error": "Session not found"}), 404
+    paging = {k: data.get(k) for k in ("limit", "before", "after", "since")}
+    etag = make_etag("history", session_id, version, len(pending), paging)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    session = datastore.get_session(session_id, ["description", "message_count"])
     if not session:
         return jsonify({"error": "Session not found"}), 404
 
-    history = session.get("chat_history", [])
-    return jsonify({
+    response = {
         "session_id": session_id,
         "description": session.get("description", "No description"),
-        "chat_history": history
-    })
+    }
+    if not any(paging.values()):
+        history = iter_session_messages(messages_collection, session_id, pending=pending)
+        if session.get("message_count", 0) + len(pending) >= HISTORY_STREAM_MIN_ITEMS:
+            return tagged(stream_response(current_app, response, "chat_history", history), etag)
+        response["chat_history"] = list(history)
+        return tagged(jsonify(response), etag)
+
+    try:
+        limit = min(parse_limit(data.get("limit") or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE)
+        since = parse_timestamp(data.get("since")) if data.get("since") else None
+        page, has_more = history_page(
+            messages_collection, session_id, max(1, limit),
+            before=data.get("before"), after=data.get("after"), since=since, pending=pending
+        )
+    except (InvalidCursor, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    response["chat_history"] = page
+    if data.get("after") or since:
+        response["has_more_after"] = has_more
+    else:
+        response["has_more_before"] = has_more
+    return tagged(jsonify(response), etag)
 
 
 # 📌 Route 6: Toggle Mode for a session
-@app.route("/session/toggle_mode", methods=["POST"])
+@bp.route("/session/toggle_mode", methods=["POST"])
 def toggle_mode():
     """Toggle session mode between 'local' and 'global'"""
     data = request.get_json()
@@ -275,89 +489,70 @@ def toggle_mode():
     if not session_id:
         return jsonify({"success": False, "message": "Missing session_id"}), 400
 
-    session = session_collection.find_one({"_id": session_id})
+    session = datastore.get_session(session_id, ["mode"])
     if not session:
         return jsonify({"success": False, "message": "Session not found"}), 404
 
     current_mode = session.get("mode", "local")
     new_mode = "global" if current_mode == "local" else "local"
 
-    session_collection.update_one(
-        {"_id": session_id},
-        {"$set": {"mode": new_mode}}
-    )
+    datastore.set_mode(session_id, new_mode)
 
     return jsonify({"success": True, "new_mode": new_mode})
 
 
 # 📌 Route 7: Search inside uploaded documents
-@app.route("/search/documents", methods=["POST"])
+@bp.route("/search/documents", methods=["POST"])
 def search_documents_api():
     """Search for a keyword inside uploaded documents"""
     data = request.json
     session_id = data.get("session_id")
     query = data.get("q")
+    tracing.annotate(session_id=session_id, query=query)
 
-    session = session_collection.find_one({"_id": session_id})
+    session = datastore.get_session(session_id, ["documents"])
     if not session:
         return jsonify({"error": "Session not found"}), 404
 
-    doc_content_parts = []
-    for d in session.get("documents", []):
-        try:
-            gridout = fs.get(ObjectId(d["gridfs_id"]))
-            content = gridout.read()
-            if d["type"] == "txt":
-                doc_content_parts.append(content.decode("utf-8"))
-            elif d["type"] == "pdf":
-                with open("temp.pdf", "wb") as f:
-                    f.write(content)
-                pdf = fitz.open("temp.pdf")
-                pdf_text = "".join([page.get_text() for page in pdf])
-                pdf.close()
-                doc_content_parts.append(pdf_text)
-            elif d["type"] == "docx":
-                with open("temp.docx", "wb") as f:
-                    f.write(content)
-                docx = Document("temp.docx")
-                docx_text = "\n".join([p.text for p in docx.paragraphs])
-                doc_content_parts.append(docx_text)
-        except:
-            continue
+    doc_content_parts = read_documents_text(session.get("documents", []))
 
-    matches = []
-    for line in "\n".join(doc_content_parts).split("\n"):
-        if query.lower() in line.lower():
-            matches.append(highlight(line.strip(), query))
+    with metrics.stage("retrieval"):
+        matches = search_lines(doc_content_parts, query)
 
     return jsonify({"query": query, "matches": matches})
 
 
 # 📌 Route 8: Search inside chat history
-@app.route("/search/chat", methods=["POST"])
+@bp.route("/search/chat", methods=["POST"])
 def search_chat_api():
     """Search for a keyword inside chat history"""
     data = request.json
     session_id = data.get("session_id")
     query = data.get("q")
+    tracing.annotate(session_id=session_id, query=query)
 
-    session = session_collection.find_one({"_id": session_id}, {"chat_history": 1})
-    if not session:
+    if not datastore.get_session(session_id, ["_id"]):
         return jsonify({"error": "Session not found"}), 404
 
+    # Match server-side so only hits leave MongoDB
+    pattern = {"$regex": re.escape(query), "$options": "i"}
+    hits = messages_collection.find(
+        {"session_id": session_id, "$or": [{"question": pattern}, {"answer": pattern}]},
+        {"_id": 0, "question": 1, "answer": 1}
+    ).sort("timestamp", 1)
+
     matches = []
-    for chat in session.get("chat_history", []):
-        if query.lower() in chat["question"].lower() or query.lower() in chat["answer"].lower():
-            matches.append({
-                "question": highlight(chat["question"], query),
-                "answer": highlight(chat["answer"], query)
-            })
+    for chat in hits:
+        matches.append({
+            "question": highlight(chat["question"], query),
+            "answer": highlight(chat["answer"], query)
+        })
 
     return jsonify({"query": query, "matches": matches})
 
 
 # 📌 Route 9: Delete a session
-@app.route("/session/delete", methods=["POST"])
+@bp.route("/session/delete", methods=["POST"])
 def delete_session():
     data = request.get_json()
     session_id = data.get("session_id")
@@ -366,9 +561,8 @@ def delete_session():
         return jsonify({"success": False, "message": "Session ID missing"}), 400
 
     try:
-        result = session_collection.delete_one({"_id": session_id})
-
-        if result.deleted_count > 0:
+        message_writer().discard(session_id)  # don't let queued turns land after the delete
+        if datastore.delete_session(session_id):
             return jsonify({"success": True, "message": "Session deleted"})
         else:
             return jsonify({"success": False, "message": "Session not found"}), 404
@@ -376,23 +570,31 @@ def delete_session():
         return jsonify({"success": False, "message": str(e)}), 500
     
 # 📌 Route 10: to list the documents in the session list
-@app.route("/document/list", methods=["POST"])
+@bp.route("/document/list", methods=["POST"])
 def list_documents():
     data = request.json
     session_id = data.get("session_id")
     if not session_id:
         return jsonify({"error": "Missing session_id"}), 400
 
-    session = session_collection.find_one({"_id": session_id})
+    version = datastore.session_version(session_id)
+    if version is None:
+        return jsonify({"error": "Session not found"}), 404
+    etag = make_etag("documents", session_id, version)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    session = datastore.get_session(session_id, ["documents"])
     if not session:
         return jsonify({"error": "Session not found"}), 404
 
     # Assuming you store docs in session like: { "documents": [ { "filename": "x.pdf", "file_id": "..."} ] }
     docs = session.get("documents", [])
-    return jsonify({"documents": docs})
+    return tagged(jsonify({"documents": docs}), etag)
 
 # 📌 Route 11: to delete the documents from the session list
-@app.route("/document/delete", methods=["POST"])
+@bp.route("/document/delete", methods=["POST"])
 def delete_document():
     data = request.json
     session_id = data.get("session_id")
@@ -401,39 +603,99 @@ def delete_document():
     if not session_id or not filename:
         return jsonify({"message": "Missing session_id or filename"}), 400
 
-    session = session_collection.find_one({"_id": session_id})
-    if not session:
+    if not datastore.get_session(session_id, ["_id"]):
         return jsonify({"message": "Session not found"}), 404
 
-    documents = session.get("documents", [])
-    updated_docs = [doc for doc in documents if doc.get("filename") != filename]
-
-    if len(updated_docs) == len(documents):
+    # ✅ Detach from the session and delete from GridFS (the directory watcher deletes the same way)
+    if not datastore.delete_documents(session_id, [filename]):
         return jsonify({"message": "File not found in session"}), 404
 
-    # ✅ Update session with remaining docs
-    session_collection.update_one(
-        {"_id": session_id}, {"$set": {"documents": updated_docs}}
-    )
+    return jsonify({"message": f"{filename} deleted successfully"})
 
-    # ✅ Optionally also delete from GridFS
-    for doc in documents:
-        if doc.get("filename") == filename:
-            try:
-                fs.delete(ObjectId(doc["gridfs_id"]))
-            except Exception as e:
-                print("GridFS delete error:", e)
 
-    return jsonify({"message": f"{filename} deleted successfully"})
+# 📌 Route 12: Token usage and cost
+@bp.route("/usage", methods=["GET"])
+def usage_report():
+    """
+    Token usage and cost from the per-session, per-day rollups.
+    Query params: group (session, day or model; default session), session_id,
+    from / to (YYYY-MM-DD, inclusive), sort (cost_usd, total_tokens, ...), limit
+    """
+    group = request.args.get("group", "session")
+    sort = request.args.get("sort", "cost_usd")
+    if group not in llm_usage.REPORT_GROUPS:
+        return jsonify({"error": f"group must be one of {', '.join(llm_usage.REPORT_GROUPS)}"}), 400
+    if sort not in llm_usage.REPORT_SORTS:
+        return jsonify({"error": f"sort must be one of {', '.join(llm_usage.REPORT_SORTS)}"}), 400
+    try:
+        limit = min(int(request.args.get("limit") or USAGE_REPORT_LIMIT), USAGE_REPORT_MAX_LIMIT)
+        start, end = request.args.get("from"), request.args.get("to")
+        for day in (start, end):
+            if day:
+                datetime.strptime(day, "%Y-%m-%d")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    rows, totals = llm_usage.report(datastore.usage_rollups, group, session_id=request.args.get("session_id"),
+                                    start=start, end=end, sort=sort, limit=max(1, limit))
+    return jsonify({"group": group, "from": start, "to": end, "sort": sort, "rows": rows, "totals": totals})
+
 
 # Home route
-@app.route("/", methods=["GET"])
+@bp.route("/", methods=["GET"])
 def home():
     return render_template("index.html")
 
 
 # ------------------------------
-# Run Flask App
+# App factory
+# ------------------------------
+def create_app(config=None):
+    """
+    Build the Flask app with its own LLM client and message writer.
+
+    Runs once per worker process (gunicorn calls "app_flask:create_app()" after
+    forking, see gunicorn.conf.py), so no client or thread is shared across a fork.
+    config overrides: AI21_API_KEY, LLM_CLIENT (a prebuilt client), WRITE_BEHIND,
+    RATE_LIMIT_BACKEND ("memory" for one process, "mongo" to share limits across workers),
+    RATE_LIMITS (False turns the per-session / per-IP /ask buckets off, for load tests).
+    """
+    app = Flask(__name__)
+    # orjson-backed jsonify with native datetime / ObjectId support
+    app.json = FastJSONProvider(app)
+    app.config.update(AI21_API_KEY=api_key, LLM_CLIENT=None, WRITE_BEHIND=WRITE_BEHIND,
+                      RATE_LIMIT_BACKEND=RATE_LIMIT_BACKEND, RATE_LIMITS=True)
+    app.config.update(config or {})
+
+    datastore.ensure_indexes()
+    limits_backend = get_backend(app.config["RATE_LIMIT_BACKEND"])
+    app.extensions["chatbot"] = {
+        # Provider calls wait for one of LLM_MAX_CONCURRENCY slots (429 once the queue is full)
+        "llm": app.config["LLM_CLIENT"] or get_llm_client(
+            app.config["AI21_API_KEY"], admission=ConcurrencyLimiter(limits_backend)
+        ),
+        "limits": (RequestLimits(limits_backend) if app.config["RATE_LIMITS"]
+                   else RequestLimits(limits_backend, session_per_min=0, ip_per_min=0)),
+        # Chat turns are buffered and written in batches
+        "writer": MessageWriter(messages_collection, session_collection, enabled=app.config["WRITE_BEHIND"],
+                                on_write=datastore.touch_sessions, rollups=datastore.usage_rollups),
+    }
+    app.register_blueprint(bp)
+    # ETag / 304 for the polled endpoints and gzip/brotli for large bodies
+    http_cache.init_app(app)
+    # Per-route / per-stage latency histograms at /metrics
+    metrics.init_app(app)
+    # Sampled span trees exported to JSONL / OTLP
+    tracing.init_app(app)
+    # X-Profile: <PROFILE_TOKEN> profiles that one request (after tracing, to reuse its request id)
+    profiling.init_app(app)
+    # CAPTURE_ENABLED=1 records sanitized requests for replay.py
+    capture.init_app(app)
+    return app
+
+
+# ------------------------------
+# Run Flask App (development server; see gunicorn.conf.py for production)
 # ------------------------------
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    create_app().run(debug=True, port=5000)
@@ -0,0 +1,269 @@
+"""
+Streaming export / import of sessions, chat history and document blobs
+(`python cli.py export` / `python cli.py import`).
+
+An export is a directory holding two files:
+
+    data.ndjson   one record per line, MongoDB extended JSON:
+                  {"kind": "session", "doc": {...}} for every session, then
+                  {"kind": "rollup", "doc": {...}} for their usage rollups
+                  (llm_usage.py), then
+                  {"kind": "message", "doc": {...}} for every chat turn
+    blobs.tar     every document referenced by those sessions, as
+                  blobs/<GridFS id>, with the original filename and content
+                  type in PAX headers
+
+Everything is read from cursors and GridFS streams and written as it goes,
+so memory stays flat however large the dataset is. GridFS ids are kept
+on import, so the sessions' document refs stay valid in the new database
+and importing the same export twice adds nothing: records and blobs that
+already exist are counted as skipped. The extracted text stored by
+`cli.py ingest` is included with --with-text; without it the refs drop
+their text_id and the app parses the original files again.
+
+Import writes blobs first, on --workers threads, then inserts sessions,
+rollups and messages with unordered bulk inserts of --batch records. An
+export made before rollups were exported has none; importing it rebuilds
+them from the messages it inserts (summary calls, which have no message,
+are not in those), so /usage covers the restored history either way.
+Message lines with an `owed` list come from a write-behind dead letter
+(see write_behind.py): besides being inserted, they get the session
+counters and rollups they still owe, once.
+
+    python cli.py export backup/ [--session ID ...] [--with-text]
+    python cli.py import backup/ --workers 8
+"""
+import json
+import os
+import sys
+import tarfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from bson import ObjectId, json_util
+
+import datastore
+import llm_usage
+import write_behind
+
+DATA_FILE = "data.ndjson"
+BLOBS_FILE = "blobs.tar"
+BLOB_DIR = "blobs/"
+FILENAME_HEADER = "chatbot.filename"
+CONTENT_TYPE_HEADER = "chatbot.content_type"
+
+DUPLICATE_KEY = 11000
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+
+
+def _line(kind, doc):
+    return json_util.dumps({"kind": kind, "doc": doc}, json_options=JSON_OPTIONS) + "\n"
+
+
+# ------------------------------
+# Export
+# ------------------------------
+def _blob_ids(documents, with_text):
+    for ref in documents:
+        yield ref["gridfs_id"]
+        if with_text and ref.get("text_id"):
+            yield ref["text_id"]
+
+
+def export_data(directory, session_ids=None, with_text=False, stream=sys.stderr):
+    """Write `directory`/data.ndjson and blobs.tar; returns record counts"""
+    os.makedirs(directory, exist_ok=True)
+    query = {"_id": {"$in": list(session_ids)}} if session_ids else {}
+    counts = {"sessions": 0, "rollups": 0, "messages": 0, "blobs": 0, "blob_bytes": 0, "missing_blobs": 0}
+
+    with open(os.path.join(directory, DATA_FILE), "w", encoding="utf-8") as data:
+        for session in datastore.sessions.find(query).sort("_id", 1):
+            if not with_text:
+                for ref in session.get("documents", []):
+                    ref.pop("text_id", None)
+            data.write(_line("session", session))
+            counts["sessions"] += 1
+        message_query = {"session_id": {"$in": list(session_ids)}} if session_ids else {}
+        for rollup in datastore.usage_rollups.find(message_query).sort("_id", 1):
+            data.write(_line("rollup", rollup))
+            counts["rollups"] += 1
+        for message in datastore.messages.find(message_query).sort("_id", 1).batch_size(1000):
+            data.write(_line("message", message))
+            counts["messages"] += 1
+
+    import gridfs
+    with tarfile.open(os.path.join(directory, BLOBS_FILE), "w|", format=tarfile.PAX_FORMAT) as tar:
+        seen = set()  # ids only, one small string per blob
+        for session in datastore.sessions.find(query, {"documents": 1}).sort("_id", 1):
+            for blob_id in _blob_ids(session.get("documents", []), with_text):
+                if blob_id in seen:
+                    continue
+                seen.add(blob_id)
+                try:
+                    grid_out = datastore.fs.get(ObjectId(blob_id))
+                except gridfs.errors.NoFile:
+                    print(f"missing blob {blob_id}", file=stream)
+                    counts["missing_blobs"] += 1
+                    continue
+                info = tarfile.TarInfo(BLOB_DIR + blob_id)
+                info.size = grid_out.length
+                info.pax_headers = {FILENAME_HEADER: grid_out.filename or "",
+                                    CONTENT_TYPE_HEADER: getattr(grid_out, "content_type", None) or ""}
+                tar.addfile(info, grid_out)  # copied in chunks straight from GridFS
+                counts["blobs"] += 1
+                counts["blob_bytes"] += grid_out.length
+    return counts
+
+
+# ------------------------------
+# Import
+# ------------------------------
+def _put_blob(blob_id, data, filename, content_type):
+    """Store one blob under its original id; False if it is already there"""
+    import gridfs
+    options = {"contentType": content_type} if content_type else {}
+    try:
+        datastore.fs.put(data, _id=ObjectId(blob_id), filename=filename or None, **options)
+        return True
+    except gridfs.errors.FileExists:
+        return False
+
+
+def import_blobs(path, workers=8, counts=None):
+    """Stream blobs.tar into GridFS with `workers` parallel writes (at most 2 x workers blobs in memory)"""
+    counts = counts if counts is not None else {}
+    counts.setdefault("blobs", 0)
+    counts.setdefault("blobs_skipped", 0)
+    lock = threading.Lock()
+
+    def store(*args):
+        added = _put_blob(*args)
+        with lock:
+            counts["blobs" if added else "blobs_skipped"] += 1
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="import") as pool, \
+            tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.startswith(BLOB_DIR):
+                continue
+            data = tar.extractfile(member).read()
+            headers = member.pax_headers
+            pending.add(pool.submit(store, member.name[len(BLOB_DIR):], data,
+                                    headers.get(FILENAME_HEADER), headers.get(CONTENT_TYPE_HEADER)))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        for future in wait(pending)[0]:
+            future.result()
+    return counts
+
+
+def _insert(collection, docs, counts, kind):
+    """Unordered bulk insert; records that already exist are skipped. Returns the inserted ones"""
+    from pymongo.errors import BulkWriteError
+    try:
+        collection.insert_many(docs, ordered=False)
+        inserted = docs
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(err["code"] != DUPLICATE_KEY for err in errors):
+            raise
+        duplicates = {err["index"] for err in errors}
+        inserted = [doc for i, doc in enumerate(docs) if i not in duplicates]
+    counts[kind] += len(inserted)
+    counts[f"{kind}_skipped"] += len(docs) - len(inserted)
+    return inserted
+
+
+def import_records(path, batch=1000, counts=None):
+    """Stream data.ndjson into the sessions, usage rollups and messages collections"""
+    counts = counts if counts is not None else {}
+    for key in ("sessions", "sessions_skipped", "rollups", "rollups_skipped", "messages", "messages_skipped"):
+        counts.setdefault(key, 0)
+    targets = {"session": (datastore.sessions, "sessions"), "rollup": (datastore.usage_rollups, "rollups"),
+               "message": (datastore.messages, "messages")}
+    buffers = {kind: [] for kind in targets}
+    owed = []  # (message, steps) of dead-lettered messages
+    has_rollups = False  # exported rollups come before the messages
+
+    def write(kind):
+        collection, name = targets[kind]
+        inserted = _insert(collection, buffers[kind], counts, name)
+        buffers[kind] = []
+        if kind == "message" and not has_rollups:
+            # An older export: count the restored turns (only the new ones, so re-imports add nothing)
+            llm_usage.record_rollups(datastore.usage_rollups, inserted)
+
+    def settle():
+        _insert(datastore.messages, [doc for doc, _ in owed], counts, "messages")
+        write_behind.settle_owed(datastore.messages, datastore.sessions, datastore.usage_rollups, owed)
+        owed.clear()
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json_util.loads(line, json_options=JSON_OPTIONS)
+            kind = record.get("kind")
+            if kind not in targets:
+                continue
+            if "owed" in record:
+                owed.append((record["doc"], record["owed"]))
+                if len(owed) >= batch:
+                    settle()
+                continue
+            has_rollups = has_rollups or kind == "rollup"
+            buffers[kind].append(record["doc"])
+            if len(buffers[kind]) >= batch:
+                write(kind)
+    for kind in targets:
+        if buffers[kind]:
+            write(kind)
+    if owed:
+        settle()
+    return counts
+
+
+def import_data(directory, workers=8, batch=1000):
+    """Load an export made by export_data; blobs go in before the sessions that point at them"""
+    counts = {}
+    blobs = os.path.join(directory, BLOBS_FILE)
+    if os.path.exists(blobs):
+        import_blobs(blobs, workers, counts)
+    import_records(os.path.join(directory, DATA_FILE), batch, counts)
+    datastore.ensure_indexes()
+    datastore.touch_sessions()  # cached session-list ETags are stale now
+    return counts
+
+
+# ------------------------------
+# CLI
+# ------------------------------
+def run_export(args):
+    """`cli.py export`"""
+    counts = export_data(args.directory, args.session, args.with_text)
+    print(json.dumps(counts))
+    return 0
+
+
+def run_import(args):
+    """`cli.py import`"""
+    if not os.path.exists(os.path.join(args.directory, DATA_FILE)):
+        raise SystemExit(f"No {DATA_FILE} in {args.directory}")
+    counts = import_data(args.directory, args.workers, args.batch)
+    print(json.dumps(counts))
+    return 0
+
+
+def add_export_arguments(parser):
+    parser.add_argument("directory", help="output directory (created if missing)")
+    parser.add_argument("--session", action="append", help="export only this session (repeatable)")
+    parser.add_argument("--with-text", action="store_true", help="include the extracted text stored at ingest")
+
+
+def add_import_arguments(parser):
+    parser.add_argument("directory", help="a directory written by `cli.py export`")
+    parser.add_argument("--workers", type=int, default=8, help="parallel GridFS writes")
+    parser.add_argument("--batch", type=int, default=1000, help="records per bulk insert")
@@ -0,0 +1,79 @@
+"""
+JSON encoding benchmark for a large /chat/history response.
+
+Encodes a synthetic history of --messages turns (10k by default) the way the
+app used to (stdlib json, as Flask's default provider does), through
+FastJSONProvider, and through the streamed path, and reports the best of
+--runs for each plus the largest single chunk the stream holds in memory.
+
+    python bench_json.py
+    python bench_json.py --messages 50000 --runs 10
+    JSON_DATETIME_FORMAT=iso python bench_json.py
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from flask import Flask
+
+import json_provider
+from json_provider import FastJSONProvider, stdlib_dumps
+
+
+def make_history(count):
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    return {
+        "session_id": "bench-session",
+        "description": "JSON benchmark",
+        "chat_history": [
+            {
+                "question": f"Question {i}: what does section {i % 40} of the contract say about renewals?",
+                "answer": "The renewal clause states that the agreement renews automatically "
+                          "for successive one-year terms unless either party gives notice. " * 3,
+                "mode": "local" if i % 3 else "global",
+                "timestamp": start + timedelta(seconds=30 * i),
+                "message_id": ObjectId(),
+            }
+            for i in range(count)
+        ],
+    }
+
+
+def best_of(runs, fn):
+    timings, result = [], None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON encoding of a large chat history")
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--runs", type=int, default=5, help="best of N")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.json = provider = FastJSONProvider(app)
+    body = make_history(args.messages)
+    head = {k: v for k, v in body.items() if k != "chat_history"}
+
+    def stream():
+        chunks = list(provider.stream_json(head, "chat_history", iter(body["chat_history"])))
+        return b"".join(chunks), max(len(c) for c in chunks)
+
+    stdlib_ms, stdlib_out = best_of(args.runs, lambda: stdlib_dumps(body).encode("utf-8"))
+    fast_ms, fast_out = best_of(args.runs, lambda: provider.response(body).get_data())
+    stream_ms, (stream_out, largest_chunk) = best_of(args.runs, stream)
+
+    # All three must decode to the same document
+    assert provider.loads(stdlib_out) == provider.loads(fast_out) == provider.loads(stream_out)
+
+    print(f"{args.messages} messages, {len(fast_out) / 1e6:.1f} MB, orjson: {json_provider.HAS_ORJSON}, "
+          f"datetimes: {json_provider.JSON_DATETIME_FORMAT}")
+    print(f"{'encoder':<18}{'ms':>9}{'speedup':>9}")
+    for name, ms in (("stdlib json", stdlib_ms), ("FastJSONProvider", fast_ms), ("streamed", stream_ms)):
+        print(f"{name:<18}{ms:>9.1f}{stdlib_ms / ms:>8.1f}x")
+    print(f"largest streamed chunk: {largest_chunk / 1e3:.0f} kB")
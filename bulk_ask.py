@@ -0,0 +1,235 @@
+"""
+Non-interactive bulk question answering (`python cli.py ask`).
+
+Reads questions from a file, one per line: plain text, or a JSON object
+with "question" and optionally "id" and "mode". The session's documents
+are read once (using the text stored by `cli.py ingest` where there is
+one), the prompt context and the extractive sentence index are built once,
+and the questions are answered --concurrency at a time, the way /ask
+answers a standalone question:
+
+  - local mode tries a document sentence first (unless --no-extractive), then
+    asks the model with the documents in the prompt (or map-reduce with
+    --strategy map_reduce)
+  - global mode asks the model directly
+
+Results stream to the --output NDJSON file as each question completes:
+
+    {"line": 12, "id": "q12", "question": ..., "mode": "local", "answer": ...,
+     "extractive": false, "latency_ms": 843.2, "model": "jamba-large",
+     "prompt_tokens": 5321, "completion_tokens": 88, "cost_usd": 0.011, "error": null}
+
+Rerunning with --resume skips every line already in the output file (a
+line cut short by the interruption is dropped first). Answers are not added
+to the session's chat history unless --save is given.
+
+    python cli.py ask questions.txt --session <id> --output results.ndjson --concurrency 16
+    python cli.py ask eval.jsonl --session <id> --output results.ndjson --resume
+"""
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import datastore
+import llm_usage
+from conversation_memory import build_chat_messages
+from extractive_qa import EXTRACTIVE_QA, SentenceIndex, extract_answer
+from llm_client import get_llm_client
+from loadtest import percentile
+from map_reduce import map_reduce_answer
+
+MODEL = "jamba-large"
+
+
+# ------------------------------
+# Input / output
+# ------------------------------
+def read_questions(path):
+    """Yield (line number, record) for every non-blank line of `path`"""
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = None
+            if line.startswith("{"):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    pass
+            if not isinstance(record, dict) or not record.get("question"):
+                record = {"question": line}
+            yield number, record
+
+
+def completed_lines(path):
+    """Line numbers already answered in an output file; drops a trailing partial line"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    done = set()
+    for line in data.splitlines():
+        try:
+            done.add(json.loads(line)["line"])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return done
+
+
+# ------------------------------
+# Answering
+# ------------------------------
+class SessionContext:
+    """Everything an answer needs from the session, loaded once"""
+
+    def __init__(self, session_id, extractive=EXTRACTIVE_QA):
+        from app_flask import read_documents, system_prompt
+        session = datastore.get_session(session_id, ["documents", "mode"])
+        if session is None:
+            raise LookupError(f"Session {session_id} not found")
+        self.session_id = session_id
+        self.mode = session.get("mode", "local")
+        self.documents = read_documents(session.get("documents", []))
+        self.texts = [text for _, text in self.documents]
+        self.prompts = {mode: system_prompt(mode, self.texts) for mode in ("local", "global")}
+        self.index = SentenceIndex(self.documents) if extractive else None
+
+
+def answer(client, context, question, mode, strategy="direct"):
+    """(answer, extractive) for one standalone question"""
+    if mode == "local" and strategy == "direct" and context.index is not None:
+        extracted = extract_answer(context.index, question)
+        if extracted:
+            return extracted["answer"], True
+    if mode == "local" and strategy == "map_reduce":
+        response, _ = map_reduce_answer(client, question, context.texts, model=MODEL)
+        return response, False
+    messages = build_chat_messages(context.prompts[mode], None, [], question)
+    completion = client.chat.completions.create(messages=messages, model=MODEL)
+    return completion.choices[0].message.content, False
+
+
+class Runner:
+    def __init__(self, client, context, output, concurrency=8, strategy="direct", mode=None, save=False,
+                 stream=sys.stderr):
+        self.client = client
+        self.context = context
+        self.output = output
+        self.concurrency = max(1, concurrency)
+        self.strategy = strategy
+        self.mode = mode
+        self.save = save
+        self.stream = stream
+        self.latencies = []
+        self.counts = {"answered": 0, "extractive": 0, "failed": 0}
+        self.tokens = {"prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._last_progress = 0.0
+
+    def _one(self, number, record):
+        mode = record.get("mode") or self.mode or self.context.mode
+        question = record["question"]
+        result = {"line": number, "id": record.get("id", number), "question": question, "mode": mode}
+        started = time.perf_counter()
+        with llm_usage.collect() as usage:
+            try:
+                result["answer"], result["extractive"] = answer(self.client, self.context, question, mode,
+                                                                self.strategy)
+                result["error"] = None
+            except Exception as e:  # one failed question doesn't stop the run
+                result.update(answer=None, extractive=False, error=f"{type(e).__name__}: {e}")
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        result.update(usage.fields())
+        if self.save and result["error"] is None:
+            datastore.save_message(self.context.session_id, question, result["answer"], mode, **usage.fields())
+        self._write(result)
+        return result
+
+    def _write(self, result):
+        line = json.dumps(result, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self.output.write(line)
+            self.output.flush()  # every finished line survives an interruption
+            self.latencies.append(result["latency_ms"])
+            self.counts["failed" if result["error"] else "answered"] += 1
+            self.counts["extractive"] += bool(result["extractive"])
+            for key in self.tokens:
+                self.tokens[key] += result.get(key) or 0
+        now = time.monotonic()
+        if now - self._last_progress >= 1.0:
+            self._last_progress = now
+            print(self.progress().ljust(90), end="\r", file=self.stream, flush=True)
+
+    def progress(self):
+        done = self.counts["answered"] + self.counts["failed"]
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return (f"{done} done  failed {self.counts['failed']}  {done / elapsed:.1f} q/s  "
+                f"p50 {percentile(self.latencies, 50):.0f} ms  ${self.tokens['cost_usd']:.4f}")
+
+    def run(self, questions):
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ask") as pool:
+            for number, record in questions:
+                pending.add(pool.submit(self._one, number, record))
+                if len(pending) >= self.concurrency * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()  # answer errors are recorded; this surfaces write errors
+            for future in wait(pending)[0]:
+                future.result()
+        print(self.progress().ljust(90), file=self.stream)
+        return self.summary()
+
+    def summary(self):
+        elapsed = time.monotonic() - self._started
+        done = self.counts["answered"] + self.counts["failed"]
+        return {
+            **self.counts,
+            "seconds": round(elapsed, 1),
+            "questions_per_sec": round(done / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": percentile(self.latencies, 50),
+            "p95_ms": percentile(self.latencies, 95),
+            "p99_ms": percentile(self.latencies, 99),
+            **{k: round(v, 6) for k, v in self.tokens.items()},
+        }
+
+
+def run(args):
+    """`cli.py ask`"""
+    if not args.resume and os.path.exists(args.output) and os.path.getsize(args.output):
+        raise SystemExit(f"{args.output} already has results; use --resume to continue it")
+    done = completed_lines(args.output) if args.resume else set()
+    try:
+        context = SessionContext(args.session, extractive=EXTRACTIVE_QA and not args.no_extractive)
+    except LookupError as e:
+        raise SystemExit(str(e))
+    print(f"{len(context.documents)} document(s) loaded; {len(done)} question(s) already answered",
+          file=sys.stderr)
+
+    questions = ((n, r) for n, r in read_questions(args.questions) if n not in done)
+    with open(args.output, "a", encoding="utf-8") as output:
+        runner = Runner(get_llm_client(), context, output, concurrency=args.concurrency,
+                        strategy=args.strategy, mode=args.mode, save=args.save)
+        summary = runner.run(questions)
+    print(json.dumps(summary))
+    return 1 if summary["failed"] else 0
+
+
+def add_arguments(parser):
+    parser.add_argument("questions", help="questions file: one question per line, or JSON lines")
+    parser.add_argument("--session", required=True, help="session whose documents answer the questions")
+    parser.add_argument("--output", required=True, help="NDJSON results file")
+    parser.add_argument("--resume", action="store_true", help="skip questions already in --output")
+    parser.add_argument("--concurrency", type=int, default=8, help="questions answered at once")
+    parser.add_argument("--mode", choices=("local", "global"), help="default: the session's mode")
+    parser.add_argument("--strategy", choices=("direct", "map_reduce"), default="direct")
+    parser.add_argument("--no-extractive", action="store_true", help="always ask the model in local mode")
+    parser.add_argument("--save", action="store_true", help="also add the answers to the session's chat history")
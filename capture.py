@@ -0,0 +1,205 @@
+"""
+Traffic capture for replay load tests (see replay.py).
+
+When enabled, requests whose path starts with one of CAPTURE_ROUTES are
+appended to CAPTURE_FILE as NDJSON, one request per line, after they finish:
+
+    {"captured_at": "...", "method": "POST", "path": "/ask", "route": "/ask",
+     "status": 200, "duration_ms": 812.4, "response_bytes": 431,
+     "json": {"session_id": "s-3f9c...", "question": "...", "mode": "local"}}
+
+Records are sanitized before they leave the process:
+
+  - session ids and filenames become stable pseudonyms (salted hashes), so a
+    replay keeps the shape of the traffic (which requests share a session,
+    which upload a delete refers to) without the real identifiers
+  - uploaded file content is never stored, only its type and size
+  - free text (questions, search terms) is handled per CAPTURE_TEXT:
+    redact (default) masks e-mail addresses, URLs and long digit runs,
+    mask replaces every letter and digit (keeping length and spacing),
+    keep stores it as is
+
+    CAPTURE_ENABLED      1 = record (default 0)
+    CAPTURE_FILE         output file (default requests.jsonl)
+    CAPTURE_ROUTES       comma-separated path prefixes (default /ask,/search/,/document/)
+    CAPTURE_SAMPLE_RATE  fraction of matching requests recorded (default 1)
+    CAPTURE_TEXT         redact / mask / keep (default redact)
+    CAPTURE_SALT         pseudonym salt; use the same value on every worker (default empty)
+"""
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CAPTURE_ENABLED = os.getenv("CAPTURE_ENABLED", "0") == "1"
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "requests.jsonl")
+CAPTURE_ROUTES = tuple(p.strip() for p in os.getenv("CAPTURE_ROUTES", "/ask,/search/,/document/").split(",") if p.strip())
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "1"))
+CAPTURE_TEXT = os.getenv("CAPTURE_TEXT", "redact")
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "")
+
+ID_FIELDS = {"session_id": "s"}
+TEXT_FIELDS = ("question", "q", "description")
+
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+_URL = re.compile(r"https?://\S+")
+_DIGITS = re.compile(r"\d{6,}")
+_WORD = re.compile(r"[^\W_]")
+
+
+# ------------------------------
+# Sanitizing
+# ------------------------------
+def pseudonym(value, prefix):
+    digest = hashlib.sha256(f"{CAPTURE_SALT}:{value}".encode("utf-8")).hexdigest()[:16]
+    return f"{prefix}-{digest}"
+
+
+def pseudonym_filename(filename):
+    """A stable stand-in that keeps the extension (it decides how the file is parsed)"""
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return pseudonym(filename, "doc") + (f".{ext}" if ext else "")
+
+
+def sanitize_text(text, mode=None):
+    mode = mode or CAPTURE_TEXT
+    if not isinstance(text, str) or mode == "keep":
+        return text
+    if mode == "mask":
+        return _WORD.sub("x", text)
+    text = _EMAIL.sub("<email>", text)
+    text = _URL.sub("<url>", text)
+    return _DIGITS.sub(lambda m: "0" * len(m.group(0)), text)
+
+
+def sanitize_body(body):
+    """A copy of a JSON request body safe to keep; uploads are reduced to type and size"""
+    if not isinstance(body, dict):
+        return None, None
+    clean, upload = {}, None
+    for key, value in body.items():
+        if key in ID_FIELDS and isinstance(value, str):
+            clean[key] = pseudonym(value, ID_FIELDS[key])
+        elif key == "filename" and isinstance(value, str):
+            clean[key] = pseudonym_filename(value)
+        elif key == "file_content":
+            upload = {"bytes": len(value or "") * 3 // 4}
+        elif key in TEXT_FIELDS:
+            clean[key] = sanitize_text(value)
+        elif isinstance(value, (str, int, float, bool)) or value is None:
+            clean[key] = value
+    if upload is not None:
+        upload["type"] = (clean.get("filename") or "").rsplit(".", 1)[-1]
+    return clean, upload
+
+
+def _multipart_body(request):
+    """Multipart uploads are recorded like the JSON form, without the file"""
+    body = {"session_id": request.form.get("session_id")}
+    file = request.files.get("file")
+    if file is None:
+        return sanitize_body(body)
+    body["filename"] = file.filename
+    clean, _ = sanitize_body(body)
+    stream = file.stream
+    stream.seek(0, os.SEEK_END)
+    return clean, {"bytes": stream.tell(), "type": clean["filename"].rsplit(".", 1)[-1]}
+
+
+# ------------------------------
+# Writing
+# ------------------------------
+class _Writer:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=10000)
+        self._pid = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def submit(self, record):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._pid = pid
+                    threading.Thread(target=self._run, name="capture", daemon=True).start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            lines = [self._queue.get()]
+            while len(lines) < 500:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                # One write per batch; O_APPEND keeps lines from several workers whole
+                with open(CAPTURE_FILE, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(r, default=str) + "\n" for r in lines))
+            except OSError as e:
+                print("Capture write error:", e)
+
+    def flush(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)  # the last batch may still be being written
+
+
+_writer = _Writer()
+flush = _writer.flush
+
+
+# ------------------------------
+# Flask integration
+# ------------------------------
+def _before_request():
+    from flask import g, request
+    if request.path.startswith(CAPTURE_ROUTES) and random.random() < CAPTURE_SAMPLE_RATE:
+        g.capture_started = time.perf_counter()
+
+
+def _after_request(response):
+    from flask import g, request
+    started = g.pop("capture_started", None)
+    if started is None:
+        return response
+    if request.mimetype == "multipart/form-data":
+        body, upload = _multipart_body(request)
+    else:
+        body, upload = sanitize_body(request.get_json(silent=True))
+    record = {
+        "captured_at": datetime.now(timezone.utc).isoformat(),
+        "method": request.method,
+        "path": request.path,
+        "route": request.url_rule.rule if request.url_rule else request.path,
+        "status": response.status_code,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+        "response_bytes": None if response.is_streamed else response.calculate_content_length(),
+        "json": body,
+    }
+    if upload is not None:
+        record["upload"] = upload
+    _writer.submit(record)
+    return response
+
+
+def init_app(app):
+    """Record matching requests of `app` (nothing is registered unless CAPTURE_ENABLED=1)"""
+    if not CAPTURE_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,210 @@
+"""
+Chat history storage.
+
+Each Q&A turn is its own document in the `chat_messages` collection instead
+of an element of the session's embedded `chat_history` array, so sessions
+stay small no matter how long the conversation runs:
+
+    {"session_id": ..., "question": ..., "answer": ..., "mode": ..., "timestamp": ...}
+
+Reads go through the compound (session_id, timestamp, _id) index; history
+pages are addressed with opaque keyset cursors built from (timestamp, _id).
+"""
+import base64
+import json
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+ASCENDING, DESCENDING = 1, -1  # pymongo's sort directions, without importing the driver
+
+MESSAGES_COLLECTION = "chat_messages"
+
+# Fields kept from clients: session_id, the per-turn usage accounting (see
+# llm_usage.py), which is served aggregated by /usage instead, the key a
+# migrated message had before it got an ObjectId (see migrate_messages.py)
+# and the flag of a dead-lettered one whose counters were settled on import
+# (see write_behind.settle_owed)
+INTERNAL_FIELDS = ("session_id", "model", "llm_calls", "prompt_tokens", "completion_tokens", "cost_usd",
+                   "legacy_id", "owed_settled")
+HIDDEN_FIELDS = {field: 0 for field in INTERNAL_FIELDS}
+# Fields returned to clients; _id is internal too (it is only used for cursors)
+PUBLIC_FIELDS = {"_id": 0, **HIDDEN_FIELDS}
+
+
+def ensure_indexes(messages):
+    # _id breaks timestamp ties so cursor pages sort straight off the index
+    messages.create_index(
+        [("session_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+        name="session_timestamp"
+    )
+
+
+def new_message(session_id, question, answer, mode, **extra):
+    """
+    Build a Q&A turn record with its _id and timestamp assigned up front,
+    so it can be cursored and read back before it reaches MongoDB.
+    """
+    now = datetime.now(timezone.utc)
+    return {
+        "_id": ObjectId(),
+        "session_id": session_id,
+        "question": question,
+        "answer": answer,
+        "mode": mode,
+        # MongoDB keeps milliseconds; match it so cursors agree before and after the write
+        "timestamp": now.replace(microsecond=now.microsecond // 1000 * 1000),
+        **extra
+    }
+
+
+def append_message(messages, session_id, question, answer, mode, **extra):
+    """Store one Q&A turn"""
+    record = new_message(session_id, question, answer, mode, **extra)
+    messages.insert_one(record)
+    return record
+
+
+# ------------------------------
+# Merging not-yet-flushed messages (see write_behind.py)
+# ------------------------------
+def _naive_utc(ts):
+    """pymongo hands back naive UTC datetimes; compare pending records the same way"""
+    if isinstance(ts, datetime) and ts.tzinfo is not None:
+        return ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _order_key(message):
+    return _naive_utc(message["timestamp"]), str(message["_id"])
+
+
+def _merge(found, pending, keep=lambda m: True):
+    """Add pending records not already returned by MongoDB, in (timestamp, _id) order"""
+    seen = {m["_id"] for m in found}
+    extra = [dict(p) for p in pending if p["_id"] not in seen and keep(p)]
+    for message in extra:
+        for field in INTERNAL_FIELDS:
+            message.pop(field, None)
+    return sorted(found + extra, key=_order_key)
+
+
+def _public(messages):
+    for message in messages:
+        message.pop("_id", None)
+    return messages
+
+
+def session_messages(messages, session_id, skip=0, limit=0, pending=()):
+    """Turns of a session, oldest first (`pending` only applies to a full read)"""
+    cursor = messages.find({"session_id": session_id}, PUBLIC_FIELDS)
+    cursor = cursor.sort([("timestamp", ASCENDING), ("_id", ASCENDING)]).skip(skip)
+    if skip or limit or not pending:
+        return list(cursor.limit(limit) if limit else cursor)
+    found = list(messages.find({"session_id": session_id}, HIDDEN_FIELDS)
+                 .sort([("timestamp", ASCENDING), ("_id", ASCENDING)]))
+    return _public(_merge(found, pending))
+
+
+def iter_session_messages(messages, session_id, pending=()):
+    """
+    All turns of a session, oldest first, as an iterable for streaming:
+    the MongoDB cursor itself when nothing is pending, else the merged list.
+    """
+    if pending:
+        return session_messages(messages, session_id, pending=pending)
+    cursor = messages.find({"session_id": session_id}, PUBLIC_FIELDS)
+    return cursor.sort([("timestamp", ASCENDING), ("_id", ASCENDING)])
+
+
+def recent_messages(messages, session_id, limit, pending=()):
+    """The last `limit` turns of a session, oldest first"""
+    cursor = messages.find({"session_id": session_id}, HIDDEN_FIELDS)
+    cursor = cursor.sort([("timestamp", DESCENDING), ("_id", DESCENDING)]).limit(limit)
+    return _public(_merge(list(cursor)[::-1], pending)[-limit:])
+
+
+def count_messages(messages, session_id):
+    return messages.count_documents({"session_id": session_id})
+
+
+def delete_session_messages(messages, session_id):
+    return messages.delete_many({"session_id": session_id}).deleted_count
+
+
+# ------------------------------
+# Cursor pagination
+# ------------------------------
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(doc, field="timestamp"):
+    """Opaque cursor pointing at one document of a (field, _id) ordering"""
+    ts, _id = doc[field], doc["_id"]
+    payload = [
+        ["d", ts.isoformat()] if isinstance(ts, datetime) else ["v", ts],
+        ["o", str(_id)] if isinstance(_id, ObjectId) else ["v", _id],
+    ]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        (ts_type, ts), (id_type, _id) = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        ts = datetime.fromisoformat(ts) if ts_type == "d" else ts
+        _id = ObjectId(_id) if id_type == "o" else _id
+    except Exception:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}")
+    return ts, _id
+
+
+def keyset_filter(op, cursor, field="timestamp"):
+    """Filter for documents strictly before ($lt) or after ($gt) the cursor in (field, _id) order"""
+    ts, _id = decode_cursor(cursor)
+    return {"$or": [{field: {op: ts}}, {field: ts, "_id": {op: _id}}]}
+
+
+def history_page(messages, session_id, limit, before=None, after=None, since=None, pending=()):
+    """
+    One page of a session's history, oldest first, plus whether more exists.
+
+    - before: the `limit` messages just older than this cursor (scrolling up)
+    - after:  the `limit` messages just newer than this cursor (incremental refresh)
+    - since:  the first `limit` messages with a timestamp later than this datetime
+    - none:   the latest `limit` messages
+    Each returned message carries its own `cursor`. `pending` are records
+    accepted but not yet written, merged in for read-your-writes.
+    """
+    query = {"session_id": session_id}
+    keep = lambda m: True
+    if before:
+        query.update(keyset_filter("$lt", before))
+        ts, _id = decode_cursor(before)
+        keep = lambda m: _order_key(m) < (_naive_utc(ts), str(_id))
+    elif after:
+        query.update(keyset_filter("$gt", after))
+        ts, _id = decode_cursor(after)
+        keep = lambda m: _order_key(m) > (_naive_utc(ts), str(_id))
+    elif since:
+        query["timestamp"] = {"$gt": since}
+        keep = lambda m: _naive_utc(m["timestamp"]) > _naive_utc(since)
+
+    newest_first = not (after or since)
+    direction = DESCENDING if newest_first else ASCENDING
+    cursor = messages.find(query, HIDDEN_FIELDS)
+    page = list(cursor.sort([("timestamp", direction), ("_id", direction)]).limit(limit + 1))
+    if pending:
+        page = _merge(page, pending, keep)
+        if newest_first:
+            page.reverse()
+        page = page[:limit + 1]
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    if newest_first:
+        page.reverse()
+    for message in page:
+        message["cursor"] = encode_cursor(message)
+        del message["_id"]
+    return page, has_more
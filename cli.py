@@ -0,0 +1,47 @@
+"""
+Command-line tools for bulk work against the chatbot's MongoDB.
+
+    python cli.py ingest <dirs / files / globs> [--session ID | --new-session DESCRIPTION]
+    python cli.py ask <questions file> --session ID --output results.ndjson [--resume]
+    python cli.py export <directory> [--session ID ...] [--with-text]
+    python cli.py import <directory>
+    python cli.py watch <directories> --session ID [--prune]
+
+Run `python cli.py <command> --help` for each command's options. Database
+settings come from the environment, as for the app (see datastore.py).
+"""
+import argparse
+import sys
+
+import backup
+import bulk_ask
+import ingest
+import watcher
+
+# name -> (add_arguments, run, help, description)
+COMMANDS = {
+    "ingest": (ingest.add_arguments, ingest.run, "upload and extract whole directories into a session",
+               ingest.__doc__),
+    "ask": (bulk_ask.add_arguments, bulk_ask.run, "answer a file of questions concurrently into NDJSON",
+            bulk_ask.__doc__),
+    "export": (backup.add_export_arguments, backup.run_export, "stream sessions, history and blobs to a directory",
+               backup.__doc__),
+    "import": (backup.add_import_arguments, backup.run_import, "load a directory written by export",
+               backup.__doc__),
+    "watch": (watcher.add_arguments, watcher.run, "keep a session in sync with directories as files change",
+              watcher.__doc__),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chatbot bulk tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, (add_arguments, _, help_text, description) in COMMANDS.items():
+        add_arguments(commands.add_parser(name, help=help_text, description=description,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter))
+    args = parser.parse_args(argv)
+    return COMMANDS[args.command][1](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
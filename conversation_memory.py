@@ -0,0 +1,199 @@
+"""
+Bounded conversation memory for multi-turn /ask.
+
+A prompt carries the last CONTEXT_TURNS turns verbatim plus a running summary
+of everything older, so follow-up questions keep their context while the
+prompt size stays flat no matter how long the session gets.
+
+The summary lives on the session document:
+
+    "memory": {"summary": "...", "summarized_count": 120, "updated_at": ...}
+
+`summarized_count` is how many of the session's turns (oldest first, see
+chat_messages.py) have been folded into the summary. Folding happens in the background, in batches of
+SUMMARY_BATCH turns, once they have scrolled out of the verbatim window. Turns
+that have left the window but are not folded yet stay in the prompt verbatim,
+up to CONTEXT_TURNS + SUMMARY_BATCH - 1 turns in all. While folding keeps up
+every turn is therefore in one place or the other; each summary call folds
+one batch and each new turn triggers at most SUMMARY_MAX_FOLDS of them (one
+update per session at a time), so if folding falls behind (the summary model
+failing) the oldest unfolded turns drop out of the prompt until it catches up.
+
+Sessions migrated with a long history would start far behind, so
+migrate_messages.py seeds their memory with seed_summary(): a plain digest
+of the older questions, no model call, that later folds build on.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from llm_provider import ChatMessage
+
+import llm_usage
+import tracing
+from chat_messages import count_messages, recent_messages, session_messages
+
+load_dotenv()
+
+CONTEXT_TURNS = int(os.getenv("CONTEXT_TURNS", "6"))
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", "10"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "2000"))
+TURN_MAX_CHARS = int(os.getenv("TURN_MAX_CHARS", "1500"))
+SUMMARY_MAX_FOLDS = int(os.getenv("SUMMARY_MAX_FOLDS", "3"))  # summary calls per new turn
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "jamba-mini-1.6-2025-03")
+
+# Most turns a prompt carries verbatim: the window plus a not-yet-folded batch
+MAX_VERBATIM_TURNS = CONTEXT_TURNS + max(SUMMARY_BATCH, 1) - 1
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+_scheduled = set()  # sessions with an update queued or running
+_scheduled_lock = threading.Lock()
+
+
+# ------------------------------
+# Helpers
+# ------------------------------
+def _clip(text, limit):
+    text = text or ""
+    return text if len(text) <= limit else text[:limit] + " …"
+
+
+def _count_turns(messages, session_id, pending=()):
+    """Turns in the session, counting `pending` ones that haven't reached MongoDB yet"""
+    total = count_messages(messages, session_id)
+    if pending:
+        ids = [p["_id"] for p in pending]
+        total += len(ids) - messages.count_documents({"_id": {"$in": ids}})
+    return total
+
+
+def load_recent_turns(messages, session_id, pending=(), memory=None):
+    """
+    The verbatim window, oldest first (`pending`: unflushed turns): the last
+    CONTEXT_TURNS turns, plus older ones not yet folded into the summary in
+    `memory`, up to MAX_VERBATIM_TURNS.
+    """
+    turns = recent_messages(messages, session_id, MAX_VERBATIM_TURNS, pending)
+    if len(turns) <= CONTEXT_TURNS:
+        return turns
+    unsummarized = _count_turns(messages, session_id, pending) - (memory or {}).get("summarized_count", 0)
+    return turns[-max(unsummarized, CONTEXT_TURNS):]
+
+
+def build_chat_messages(system, memory, turns, question):
+    """
+    Assemble the prompt: system instructions, the summary of older turns,
+    the recent turns verbatim, then the new question.
+    """
+    messages = [ChatMessage(content=system, role="system")]
+
+    summary = (memory or {}).get("summary")
+    if summary:
+        messages.append(ChatMessage(
+            content=f"Summary of the earlier conversation:\n{_clip(summary, SUMMARY_MAX_CHARS)}",
+            role="system"
+        ))
+
+    for turn in turns[-MAX_VERBATIM_TURNS:]:
+        messages.append(ChatMessage(content=_clip(turn.get("question"), TURN_MAX_CHARS), role="user"))
+        messages.append(ChatMessage(content=_clip(turn.get("answer"), TURN_MAX_CHARS), role="assistant"))
+
+    messages.append(ChatMessage(content=question, role="user"))
+    return messages
+
+
+# ------------------------------
+# Rolling summary
+# ------------------------------
+def update_summary(client, sessions, messages, session_id, rollups=None):
+    """
+    Fold turns that have left the verbatim window into the session summary,
+    one batch of SUMMARY_BATCH turns per model call and at most
+    SUMMARY_MAX_FOLDS calls (tokens counted in `rollups`)
+    """
+    for _ in range(SUMMARY_MAX_FOLDS):
+        if not _fold_batch(client, sessions, messages, session_id, rollups):
+            break
+
+
+def _fold_batch(client, sessions, messages, session_id, rollups):
+    """Fold the next batch; False when there is nothing to fold or another worker got there first"""
+    session = sessions.find_one({"_id": session_id}, {"memory": 1})
+    if not session:
+        return False
+    memory = session.get("memory") or {}
+    done = memory.get("summarized_count", 0)
+
+    batch = max(SUMMARY_BATCH, 1)
+    if count_messages(messages, session_id) - CONTEXT_TURNS - done < batch:
+        return False
+
+    turns = "\n".join(
+        f"Q: {_clip(t.get('question'), TURN_MAX_CHARS)}\nA: {_clip(t.get('answer'), TURN_MAX_CHARS)}"
+        for t in session_messages(messages, session_id, skip=done, limit=batch)
+    )
+    prompt = (
+        "Update the running summary of a conversation between a user and an assistant.\n"
+        f"Keep it under {SUMMARY_MAX_CHARS} characters and keep facts, names and open questions.\n\n"
+        f"Current summary:\n{_clip(memory.get('summary'), SUMMARY_MAX_CHARS) or '(empty)'}\n\n"
+        f"New turns:\n{turns}\n\n"
+        "Updated summary:"
+    )
+    completion = client.chat.completions.create(
+        messages=[ChatMessage(content=prompt, role="user")],
+        model=SUMMARY_MODEL,
+    )
+    summary = _clip(completion.choices[0].message.content.strip(), SUMMARY_MAX_CHARS)
+    if rollups is not None:
+        llm_usage.add_call(rollups, session_id, SUMMARY_MODEL, getattr(completion, "usage", None))
+
+    # Only apply if nobody folded these turns in the meantime
+    guard = {"memory.summarized_count": done} if done else {"memory.summarized_count": {"$in": [0, None]}}
+    result = sessions.update_one(
+        {"_id": session_id, **guard},
+        {"$set": {"memory": {
+            "summary": summary,
+            "summarized_count": done + batch,
+            "updated_at": datetime.now(timezone.utc)
+        }}}
+    )
+    return result.modified_count == 1
+
+
+def seed_summary(turns):
+    """
+    Memory for a session whose `turns` (oldest first) predate summaries: a
+    digest of their questions, newest kept when they don't all fit
+    """
+    lines, size = [], 0
+    for turn in reversed(turns):
+        line = f"- {_clip(turn.get('question'), 200)}"
+        if size + len(line) + 1 > SUMMARY_MAX_CHARS - 40:
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return {
+        "summary": "Questions asked earlier:\n" + "\n".join(reversed(lines)),
+        "summarized_count": len(turns),
+        "updated_at": datetime.now(timezone.utc)
+    }
+
+
+def _finished(session_id, future):
+    with _scheduled_lock:
+        _scheduled.discard(session_id)
+    if future.exception() is not None:
+        print("Summary update error:", future.exception())
+
+
+def schedule_summary_update(client, sessions, messages, session_id, rollups=None):
+    """Update the summary off the request path, unless an update for the session is already pending"""
+    with _scheduled_lock:
+        if session_id in _scheduled:
+            return
+        _scheduled.add(session_id)
+    task = tracing.bind(update_summary, "summary_update")  # stays in the request's trace
+    future = _summary_executor.submit(task, client, sessions, messages, session_id, rollups)
+    future.add_done_callback(lambda f: _finished(session_id, f))
@@ -0,0 +1,439 @@
+"""
+Shared MongoDB / GridFS access for the Flask app and the CLI scripts.
+
+One MongoClient per process, created on first use from the environment:
+
+    MONGO_URI                          connection string (default mongodb://localhost:27017)
+    MONGO_DB                           database name (default chat_history_db)
+    MONGO_MAX_POOL_SIZE                connections per server (default 50)
+    MONGO_MIN_POOL_SIZE                connections kept warm (default 0)
+    MONGO_MAX_IDLE_MS                  idle connections are closed after this (default 60000)
+    MONGO_WAIT_QUEUE_TIMEOUT_MS        how long a request waits for a free connection (default 5000)
+    MONGO_CONNECT_TIMEOUT_MS           TCP connect timeout (default 5000)
+    MONGO_SERVER_SELECTION_TIMEOUT_MS  how long to look for a usable server (default 5000)
+    MONGO_SOCKET_TIMEOUT_MS            per-operation socket timeout, 0 = none (default 30000)
+    MONGO_WRITE_CONCERN                w: "majority" or a number (default 1)
+    MONGO_WRITE_TIMEOUT_MS             wtimeout for the write concern (default 10000)
+    MONGO_READ_CONCERN                 local / majority / ... (default local)
+    VERSION_CACHE_TTL_MS               how long a process trusts its cached version counters (default 1000)
+
+The client is keyed by process id: a worker forked from a parent that had
+already connected builds its own client instead of sharing sockets and
+monitor threads with the parent. `sessions`, `messages` and `fs` are
+module-level handles that resolve against the current process's client on
+every use, so they can be imported at module scope safely.
+
+The repository functions below are the common session / document / message
+operations; anything more specialised can still use the handles directly.
+Every write through them bumps the session's `version` and the session-list
+version in `counters`, which http_cache turns into ETags. Writes made in this
+process take effect on the cached versions immediately; writes made by other
+processes are seen within VERSION_CACHE_TTL_MS (0 = always read the counter).
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, TypedDict
+
+from bson import ObjectId
+from dotenv import load_dotenv
+
+import llm_usage
+import metrics
+import tracing
+from chat_messages import MESSAGES_COLLECTION, append_message, delete_session_messages
+from chat_messages import ensure_indexes as ensure_message_indexes
+
+load_dotenv()
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB = os.getenv("MONGO_DB", "chat_history_db")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_MS = int(os.getenv("MONGO_MAX_IDLE_MS", "60000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000"))
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN", "1")
+MONGO_WRITE_TIMEOUT_MS = int(os.getenv("MONGO_WRITE_TIMEOUT_MS", "10000"))
+MONGO_READ_CONCERN = os.getenv("MONGO_READ_CONCERN", "local")
+VERSION_CACHE_TTL_MS = int(os.getenv("VERSION_CACHE_TTL_MS", "1000"))
+
+SESSIONS_COLLECTION = "chat_sessions"
+COUNTERS_COLLECTION = "counters"
+SESSION_LIST_COUNTER = "session_list"
+RATE_LIMITS_COLLECTION = "rate_limits"  # see rate_limit.py
+LLM_SLOTS_COLLECTION = "llm_slots"
+USAGE_ROLLUPS_COLLECTION = llm_usage.USAGE_ROLLUPS_COLLECTION
+
+
+# ------------------------------
+# Record shapes
+# ------------------------------
+class DocumentRef(TypedDict, total=False):
+    filename: str
+    gridfs_id: str
+    type: str
+    uploaded_at: datetime
+    # Set by the ingest CLI: content hash, size in bytes and the GridFS id of the extracted text
+    sha256: str
+    size: int
+    text_id: str
+
+
+Session = TypedDict("Session", {
+    "_id": str,
+    "description": str,
+    "created_at": datetime,
+    "mode": str,
+    "documents": List[DocumentRef],
+    "doc_count": int,
+    "message_count": int,
+    "last_activity": datetime,
+    "memory": dict,
+    "version": int,
+}, total=False)
+
+Message = TypedDict("Message", {
+    "_id": ObjectId,
+    "session_id": Optional[str],
+    "question": str,
+    "answer": str,
+    "mode": Optional[str],
+    "timestamp": datetime,
+    # Token accounting (llm_usage.py); model is None for answers that needed no LLM call
+    "model": Optional[str],
+    "llm_calls": int,
+    "prompt_tokens": int,
+    "completion_tokens": int,
+    "cost_usd": float,
+}, total=False)
+
+
+# ------------------------------
+# Connections
+# ------------------------------
+_lock = threading.Lock()
+_state = {"pid": None, "client": None, "fs": None}
+
+
+def _connect():
+    # The driver loads here, on the first database call, not when a script starts
+    from pymongo import MongoClient
+    from pymongo.read_concern import ReadConcern
+    from pymongo.write_concern import WriteConcern
+
+    w = int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN
+    client = MongoClient(
+        MONGO_URI,
+        connect=False,  # sockets open on the first operation, never in a pre-fork parent by accident
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS or None,
+        retryWrites=True,
+        appname="ai-chatbot",
+        # Times every command as the mongo / gridfs stage of the current request (and traces it)
+        event_listeners=[metrics.command_listener()] if metrics.METRICS_ENABLED or tracing.enabled() else [],
+    )
+    db = client.get_database(
+        MONGO_DB,
+        write_concern=WriteConcern(w=w, wtimeout=MONGO_WRITE_TIMEOUT_MS),
+        read_concern=ReadConcern(MONGO_READ_CONCERN),
+    )
+    return client, db
+
+
+def get_client():
+    """The MongoClient of the current process"""
+    return _current()[0]
+
+
+def get_db():
+    """The chat database, with the configured read/write concerns"""
+    return _current()[1]
+
+
+def get_fs():
+    """GridFS on the chat database"""
+    _current()
+    with _lock:
+        if _state["fs"] is None:
+            import gridfs
+            _state["fs"] = gridfs.GridFS(_state["db"])
+        return _state["fs"]
+
+
+def _current():
+    pid = os.getpid()
+    if _state["pid"] != pid:
+        with _lock:
+            if _state["pid"] != pid:
+                # Inherited clients are abandoned rather than closed: their sockets belong to the parent
+                _state["client"], _state["db"] = _connect()
+                _state["fs"] = None
+                _state["pid"] = pid
+    return _state["client"], _state["db"]
+
+
+class _Handle:
+    """Stand-in that forwards to the current process's collection / GridFS on every use"""
+
+    def __init__(self, resolve, name):
+        self._resolve = resolve
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return f"<datastore {self._name}>"
+
+
+sessions = _Handle(lambda: get_db()[SESSIONS_COLLECTION], SESSIONS_COLLECTION)
+messages = _Handle(lambda: get_db()[MESSAGES_COLLECTION], MESSAGES_COLLECTION)
+counters = _Handle(lambda: get_db()[COUNTERS_COLLECTION], COUNTERS_COLLECTION)
+rate_limits = _Handle(lambda: get_db()[RATE_LIMITS_COLLECTION], RATE_LIMITS_COLLECTION)
+llm_slots = _Handle(lambda: get_db()[LLM_SLOTS_COLLECTION], LLM_SLOTS_COLLECTION)
+usage_rollups = _Handle(lambda: get_db()[USAGE_ROLLUPS_COLLECTION], USAGE_ROLLUPS_COLLECTION)
+fs = _Handle(get_fs, "gridfs")
+
+
+def ensure_indexes():
+    ensure_message_indexes(messages)
+    # /session/list pages newest-first off this index
+    sessions.create_index([("created_at", -1), ("_id", -1)], name="created_at")
+    # Idle rate-limit buckets expire on their own
+    rate_limits.create_index("expires_at", name="expires_at", expireAfterSeconds=0)
+    llm_usage.ensure_indexes(usage_rollups)
+
+
+# ------------------------------
+# Sessions
+# ------------------------------
+def create_session(description, session_id=None, mode="local") -> str:
+    """Insert an empty session and return its id"""
+    session_id = session_id or str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    sessions.insert_one({
+        "_id": session_id,
+        "description": description,
+        "created_at": now,
+        "documents": [],
+        "mode": mode,
+        # Summary fields kept up to date on every write, so listing never reads the arrays
+        "doc_count": 0,
+        "message_count": 0,
+        "last_activity": now,
+        "version": 0
+    })
+    touch_sessions()
+    return session_id
+
+
+def get_session(session_id, fields=None) -> Optional[Session]:
+    """The session, or None; `fields` is a list of fields to load (default: all)"""
+    projection = {f: 1 for f in fields} if fields else None
+    return sessions.find_one({"_id": session_id}, projection)
+
+
+def recent_sessions(fields=("description", "created_at")) -> List[Session]:
+    """All sessions, newest first, with only `fields` loaded"""
+    return list(sessions.find({}, {f: 1 for f in fields}).sort([("created_at", -1), ("_id", -1)]))
+
+
+def set_mode(session_id, mode) -> None:
+    sessions.update_one({"_id": session_id}, {"$set": {"mode": mode}, "$inc": {"version": 1}})
+    touch_sessions([session_id])
+
+
+def delete_session(session_id) -> bool:
+    """Delete a session and its messages; False if it did not exist"""
+    if not sessions.delete_one({"_id": session_id}).deleted_count:
+        return False
+    delete_session_messages(messages, session_id)
+    touch_sessions([session_id])
+    return True
+
+
+# ------------------------------
+# Documents
+# ------------------------------
+def store_file(data, filename) -> str:
+    """Put bytes or a file object into GridFS; returns the id as a string"""
+    return str(fs.put(data, filename=filename))
+
+
+def store_text(text, filename) -> str:
+    """Put a document's extracted text into GridFS (as <filename>.txt); returns the id"""
+    return str(fs.put(text.encode("utf-8"), filename=f"{filename}.txt", contentType="text/plain; charset=utf-8"))
+
+
+def read_file(gridfs_id) -> bytes:
+    return fs.get(ObjectId(gridfs_id)).read()
+
+
+def delete_file(gridfs_id) -> None:
+    fs.delete(ObjectId(gridfs_id))
+
+
+def delete_document_files(document: DocumentRef) -> None:
+    """Delete a document's blob and, if it has one, its extracted text"""
+    for key in ("gridfs_id", "text_id"):
+        if document.get(key):
+            delete_file(document[key])
+
+
+def document_ref(filename, gridfs_id, file_type=None, **extra) -> DocumentRef:
+    """A session's reference to a stored file; `extra` adds the optional sha256 / size / text_id"""
+    return {
+        "filename": filename,
+        "gridfs_id": gridfs_id,
+        "type": file_type or filename.rsplit(".", 1)[-1].lower(),
+        "uploaded_at": datetime.now(timezone.utc),
+        **{k: v for k, v in extra.items() if v is not None},
+    }
+
+
+def add_documents(session_id, documents: Iterable[DocumentRef]) -> None:
+    """Attach uploaded documents to a session and bump its summary fields"""
+    documents = list(documents)
+    if not documents:
+        return
+    sessions.update_one(
+        {"_id": session_id},
+        {"$push": {"documents": {"$each": documents}},
+         "$inc": {"doc_count": len(documents), "version": 1},
+         "$set": {"last_activity": datetime.now(timezone.utc)}}
+    )
+    touch_sessions([session_id])
+
+
+def remove_documents(session_id, filenames: Iterable[str]) -> List[DocumentRef]:
+    """
+    Detach documents by filename and return the removed refs; their GridFS
+    files are left for the caller to delete (see delete_document_files).
+    """
+    filenames = set(filenames)
+    if not filenames:
+        return []
+    before = sessions.find_one_and_update(
+        {"_id": session_id},
+        {"$pull": {"documents": {"filename": {"$in": list(filenames)}}},
+         "$inc": {"version": 1},
+         "$set": {"last_activity": datetime.now(timezone.utc)}},
+        projection={"documents": 1},
+    )
+    removed = [d for d in (before or {}).get("documents", []) if d.get("filename") in filenames]
+    if removed:
+        sessions.update_one({"_id": session_id}, {"$inc": {"doc_count": -len(removed)}})
+    touch_sessions([session_id])
+    return removed
+
+
+def delete_documents(session_id, filenames: Iterable[str]) -> List[DocumentRef]:
+    """Detach documents by filename and delete their GridFS files; returns the removed refs"""
+    removed = remove_documents(session_id, filenames)
+    for document in removed:
+        try:
+            delete_document_files(document)
+        except Exception as e:
+            print("GridFS delete error:", e)
+    return removed
+
+
+def set_documents(session_id, documents: List[DocumentRef]) -> None:
+    """Replace a session's document list (after removing some)"""
+    sessions.update_one(
+        {"_id": session_id},
+        {"$set": {
+            "documents": documents,
+            "doc_count": len(documents),
+            "last_activity": datetime.now(timezone.utc)
+        }, "$inc": {"version": 1}}
+    )
+    touch_sessions([session_id])
+
+
+# ------------------------------
+# Messages
+# ------------------------------
+def save_message(session_id, question, answer, mode=None, **extra) -> Message:
+    """Store one Q&A turn synchronously and bump the session's summary fields (and token rollups)"""
+    record = append_message(messages, session_id, question, answer, mode, **extra)
+    llm_usage.record_rollups(usage_rollups, [record])
+    if session_id is not None:
+        sessions.update_one(
+            {"_id": session_id},
+            {"$inc": {"message_count": 1, "version": 1}, "$set": {"last_activity": record["timestamp"]}}
+        )
+        touch_sessions([session_id])
+    return record
+
+
+# ------------------------------
+# Version counters (ETags)
+# ------------------------------
+_versions = {}  # ("session", id) / ("list",) -> (version, monotonic time read)
+_generations = {}  # same keys -> how many times touch_sessions() invalidated them
+_epoch = 0  # bumped when both maps are cleared, so generations from before can't match again
+_versions_lock = threading.Lock()
+
+
+def touch_sessions(session_ids=()):
+    """
+    Record that sessions changed: bump the session-list counter and drop this
+    process's cached versions. Callers bump the sessions' own `version`
+    field in the same update that changes them.
+    """
+    counters.update_one({"_id": SESSION_LIST_COUNTER}, {"$inc": {"version": 1}}, upsert=True)
+    with _versions_lock:
+        for key in [("list",)] + [("session", session_id) for session_id in session_ids]:
+            _versions.pop(key, None)
+            _generations[key] = _generations.get(key, 0) + 1
+
+
+def _cached_version(key, load):
+    global _epoch
+    now = time.monotonic()
+    with _versions_lock:
+        entry = _versions.get(key)
+        generation = (_epoch, _generations.get(key, 0))
+    if entry and now - entry[1] < VERSION_CACHE_TTL_MS / 1000:
+        metrics.record_cache("version", True)
+        return entry[0]
+    metrics.record_cache("version", False)
+    version = load()
+    if version is None:
+        return None
+    with _versions_lock:
+        # A touch_sessions() while loading may mean `version` predates the change: don't keep it
+        if (_epoch, _generations.get(key, 0)) == generation:
+            _versions[key] = (version, now)
+        if len(_versions) > 10000 or len(_generations) > 10000:
+            _versions.clear()
+            _generations.clear()
+            _epoch += 1
+    return version
+
+
+def session_version(session_id) -> Optional[int]:
+    """Current version of a session, or None if it does not exist"""
+    def load():
+        doc = sessions.find_one({"_id": session_id}, {"version": 1})
+        return None if doc is None else doc.get("version", 0)
+    return _cached_version(("session", session_id), load)
+
+
+def session_list_version() -> int:
+    """Changes whenever any session is created, deleted or modified"""
+    def load():
+        doc = counters.find_one({"_id": SESSION_LIST_COUNTER})
+        return doc["version"] if doc else 0
+    return _cached_version(("list",), load)
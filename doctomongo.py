@@ -1,39 +1,35 @@
-import fitz
 import os
 import uuid
-import gridfs
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import datastore
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
+from llm_client import get_llm_client
+from llm_provider import ChatMessage
+from lazy_imports import lazy_import
+
+# Heavy parsers, loaded on first use
+fitz = lazy_import("fitz")
 
 
 # Load environment variables
 load_dotenv()
 
-# Get API key and MongoDB URI from environment
+# Get API key from environment
 api_key = os.getenv('AI21_API_KEY')
-mongo_client = MongoClient("mongodb://localhost:27017")  # Update if using Atlas
-db = mongo_client["chat_history_db"]
-fs = gridfs.GridFS(db)  # Create a GridFS instance
-chat_collection = db["cat_talk"]
-session_collection = db["chat_sessions"]
 
 # Upload pdf file to MongoDB using GridFS
 file_path = "4thsemcorrected.pdf"  # Change this to your file name
 with open(file_path, "rb") as f:
-    file_id = fs.put(f, filename="4thsemcorrected.pdf")
+    file_id = datastore.store_file(f, "4thsemcorrected.pdf")
 
 # Upload txt file to MongoDB using GridFS
 file_path = "cat.txt"  # Change this to your file name
 with open(file_path, "rb") as f:
-    file_id = fs.put(f, filename="cat.txt")
+    file_id = datastore.store_file(f, "cat.txt")
 
 # Upload doc file to MongoDB using GridFS
 file_path = "Bff.docx"  # Change this to your file name
 with open(file_path, "rb") as f:
-    file_id = fs.put(f, filename="Bff.docx")    
+    file_id = datastore.store_file(f, "Bff.docx")    
 
 print("File uploaded successfully with ID:", file_id)
 
@@ -42,15 +38,11 @@ session_choice = input("Start a new session? (yes/no): ").strip().lower()
 if session_choice == "yes":
     session_id = str(uuid.uuid4())
     session_description = input("Enter a short description for this session: ").strip()
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(timezone.utc)
-    })
+    datastore.create_session(session_description, session_id)
     print(f"✅ New session created with ID: {session_id}")
 else:
     session_id = input("Enter existing session ID: ").strip()
-    existing = session_collection.find_one({"_id": session_id})
+    existing = datastore.get_session(session_id, ["_id"])
     if not existing:
         print("❌ Session ID not found. Exiting.")
         exit()
@@ -58,7 +50,7 @@ else:
 # Upload cat.txt to GridFS and read it
 try:
     with open("cat.txt", "rb") as txt_file:
-        txt_file_id = fs.put(txt_file, filename="cat.txt")
+        txt_file_id = datastore.store_file(txt_file, "cat.txt")
         print(f"✅ Uploaded cat.txt to GridFS with ID: {txt_file_id}")
         txt_file.seek(0)
         txt_content = txt_file.read().decode("utf-8")
@@ -71,7 +63,7 @@ pdf_path = "4thsemcorrected.pdf"
 pdf_content = ""
 if os.path.exists(pdf_path):
     with open(pdf_path, "rb") as pdf_file:
-        pdf_file_id = fs.put(pdf_file, filename="4thsemcorrected.pdf")
+        pdf_file_id = datastore.store_file(pdf_file, "4thsemcorrected.pdf")
         print(f"✅ Uploaded PDF to GridFS with ID: {pdf_file_id}")
 
     # Extract pdf text using PyMuPDF
@@ -87,7 +79,7 @@ doc_content = txt_content + "\n\n" + pdf_content
   
 
 # Initialize AI21 client
-client = AI21Client(api_key=api_key)
+client = get_llm_client(api_key)
 
 # Ask mode for every question
 mode = input("Choose mode: (1) Local documents or (2) Global knowledge: ").strip()
@@ -134,10 +126,4 @@ while True:
     print("\n🧠 AI Response:", response)
 
     # Save to MongoDB
-    chat_record = {
-        "session_id": session_id,
-        "question": user_input,
-        "answer": response,
-        "timestamp": datetime.now(timezone.utc)
-    }
-    chat_collection.insert_one(chat_record)
\ No newline at end of file
+    datastore.save_message(session_id, user_input, response, "local" if mode == "1" else "global")
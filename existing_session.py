@@ -1,23 +1,20 @@
-import fitz
 import os
 import uuid
-import gridfs
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import datastore
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
-from docx import Document   # <-- for DOCX text extraction
+from llm_client import get_llm_client
+from llm_provider import ChatMessage
+from lazy_imports import lazy_import
+
+# Heavy parsers, loaded on first use
+fitz = lazy_import("fitz")
+docx = lazy_import("docx")   # <-- for DOCX text extraction
 
 # Load environment variables
 load_dotenv()
 
-# Get API key and MongoDB URI
+# Get API key
 api_key = os.getenv('AI21_API_KEY')
-mongo_client = MongoClient("mongodb://localhost:27017")  # Update if using Atlas
-db = mongo_client["chat_history_db"]
-fs = gridfs.GridFS(db)  
-session_collection = db["chat_sessions"]
 
 # ------------------------------
 # Create or Continue a Session
@@ -27,18 +24,12 @@ session_choice = input("Do you want to (1) Create a new session or (2) Use exist
 if session_choice == "1":   # New session
     session_id = str(uuid.uuid4())
     session_description = input("Enter a short description for this session: ").strip()
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(timezone.utc),
-        "documents": [],
-        "chat_history": []
-    })
+    datastore.create_session(session_description, session_id)
     print(f"✅ New session created with ID: {session_id}")
 
 elif session_choice == "2":  # Use existing session
     print("\n📂 Available Sessions:")
-    sessions = list(session_collection.find({}))
+    sessions = datastore.recent_sessions()
     if not sessions:
         print("❌ No existing sessions found. Exiting.")
         exit()
@@ -74,14 +65,10 @@ if upload_choice == "yes":
     # TXT
     try:
         with open("cat.txt", "rb") as txt_file:
-            txt_file_id = fs.put(txt_file, filename="cat.txt")
+            txt_file_id = datastore.store_file(txt_file, "cat.txt")
             txt_file.seek(0)
             txt_content = txt_file.read().decode("utf-8")
-            documents_uploaded.append({
-                "filename": "cat.txt",
-                "gridfs_id": str(txt_file_id),
-                "type": "txt"
-            })
+            documents_uploaded.append(datastore.document_ref("cat.txt", txt_file_id, "txt"))
             print(f"✅ Uploaded cat.txt with ID {txt_file_id}")
     except FileNotFoundError:
         print("❌ cat.txt not found.")
@@ -92,12 +79,8 @@ if upload_choice == "yes":
     pdf_path = "4thsemcorrected.pdf"
     if os.path.exists(pdf_path):
         with open(pdf_path, "rb") as pdf_file:
-            pdf_file_id = fs.put(pdf_file, filename="4thsemcorrected.pdf")
-            documents_uploaded.append({
-                "filename": "4thsemcorrected.pdf",
-                "gridfs_id": str(pdf_file_id),
-                "type": "pdf"
-            })
+            pdf_file_id = datastore.store_file(pdf_file, "4thsemcorrected.pdf")
+            documents_uploaded.append(datastore.document_ref("4thsemcorrected.pdf", pdf_file_id, "pdf"))
             print(f"✅ Uploaded PDF with ID {pdf_file_id}")
 
         # Extract text
@@ -113,17 +96,13 @@ if upload_choice == "yes":
     docx_path = "Bff.docx"
     if os.path.exists(docx_path):
         with open(docx_path, "rb") as docx_file:
-            docx_file_id = fs.put(docx_file, filename="Bff.docx")
-            documents_uploaded.append({
-                "filename": "Bff.docx",
-                "gridfs_id": str(docx_file_id),
-                "type": "docx"
-            })
+            docx_file_id = datastore.store_file(docx_file, "Bff.docx")
+            documents_uploaded.append(datastore.document_ref("Bff.docx", docx_file_id, "docx"))
             print(f"✅ Uploaded Bff.docx with ID {docx_file_id}")
 
         # Extract text from docx
         try:
-            doc = Document(docx_path)
+            doc = docx.Document(docx_path)
             for para in doc.paragraphs:
                 docx_content += para.text + "\n"
         except Exception as e:
@@ -132,10 +111,7 @@ if upload_choice == "yes":
         print("❌ Bff.docx not found.")
 
     # Update session with embedded document info
-    session_collection.update_one(
-        {"_id": session_id},
-        {"$push": {"documents": {"$each": documents_uploaded}}}
-    )
+    datastore.add_documents(session_id, documents_uploaded)
 
     # Combine all text
     doc_content = txt_content + "\n\n" + pdf_content + "\n\n" + docx_content
@@ -143,7 +119,7 @@ if upload_choice == "yes":
 # ------------------------------
 # Chatbot Q&A Loop
 # ------------------------------
-client = AI21Client(api_key=api_key)
+client = get_llm_client(api_key)
 
 while True:
     ask_choice = input("\nDo you want to ask a question? (yes/exit): ").strip().lower()
@@ -189,15 +165,5 @@ while True:
     response = chat_completions.choices[0].message.content
     print("\n🧠 AI Response:", response)
 
-    # Store Q&A inside embedded chat_history
-    session_collection.update_one(
-        {"_id": session_id},
-        {"$push": {
-            "chat_history": {
-                "question": user_input,
-                "answer": response,
-                "mode": "local" if mode == "1" else "global",
-                "timestamp": datetime.now(timezone.utc)
-            }
-        }}
-    )
+    # Store Q&A in the chat_messages collection
+    datastore.save_message(session_id, user_input, response, "local" if mode == "1" else "global")
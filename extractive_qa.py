@@ -0,0 +1,132 @@
+"""
+Extractive question answering: a zero-LLM fast path for local mode.
+
+Every sentence of a session's documents is scored against the question by
+IDF-weighted term coverage (0..1). When the best sentence shares at least
+EXTRACTIVE_MIN_TERMS terms with the question and scores at least
+EXTRACTIVE_MIN_SCORE it is returned as the answer together with its source
+span, and the jamba-large call is skipped entirely. Questions with fewer
+terms than that always go to the model: one shared word is too weak a
+signal however rare it is.
+
+Sentence indexes are cached per set of GridFS ids (EXTRACTIVE_CACHE_SIZE
+sessions), so repeated questions don't re-read or re-parse the documents.
+An index built while some document couldn't be read is used once and not
+cached.
+"""
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+EXTRACTIVE_QA = os.getenv("EXTRACTIVE_QA", "1") == "1"
+EXTRACTIVE_MIN_SCORE = float(os.getenv("EXTRACTIVE_MIN_SCORE", "0.75"))
+EXTRACTIVE_MIN_TERMS = int(os.getenv("EXTRACTIVE_MIN_TERMS", "2"))
+EXTRACTIVE_CACHE_SIZE = int(os.getenv("EXTRACTIVE_CACHE_SIZE", "64"))
+
+_SENTENCE = re.compile(r"[^.!?\n]+[.!?]*")
+_WORD = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "of", "to", "in", "on", "for",
+    "and", "or", "what", "whats", "which", "who", "whom", "when", "where", "why", "how", "do",
+    "does", "did", "can", "could", "i", "you", "it", "its", "this", "that", "with", "as", "at",
+    "by", "from", "my", "your", "me", "about", "there", "s", "tell", "please",
+}
+
+
+def _terms(text):
+    return [w for w in _WORD.findall(text.lower()) if w not in STOPWORDS]
+
+
+class SentenceIndex:
+    """Sentences of a set of documents, with document frequencies for IDF weighting"""
+
+    def __init__(self, documents):
+        # documents: list of (filename, text)
+        self.documents = documents
+        self.sentences = []  # (filename, start, end, text, term set)
+        df = Counter()
+        for filename, text in documents:
+            for match in _SENTENCE.finditer(text):
+                raw = match.group(0)
+                sentence = raw.strip()
+                terms = set(_terms(sentence))
+                if not terms:
+                    continue
+                start = match.start() + len(raw) - len(raw.lstrip())
+                self.sentences.append((filename, start, start + len(sentence), sentence, terms))
+                df.update(terms)
+        n = len(self.sentences)
+        self.idf = {term: math.log((n + 1) / (count + 1)) + 1 for term, count in df.items()}
+        self._default_idf = math.log(n + 1) + 1
+
+    @property
+    def texts(self):
+        return [text for _, text in self.documents]
+
+    def best_match(self, question):
+        """Return (score, sentence tuple) of the best-covering sentence, or (0, None)"""
+        question_terms = set(_terms(question))
+        if not question_terms:
+            return 0.0, None
+        weights = {t: self.idf.get(t, self._default_idf) for t in question_terms}
+        total = sum(weights.values())
+
+        best_score, best = 0.0, None
+        for sentence in self.sentences:
+            matched = question_terms & sentence[4]
+            if len(matched) < EXTRACTIVE_MIN_TERMS:
+                continue
+            score = sum(weights[t] for t in matched) / total
+            if score > best_score:
+                best_score, best = score, sentence
+        return best_score, best
+
+
+# ------------------------------
+# Index cache
+# ------------------------------
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_index(key, load_documents):
+    """
+    Return the cached SentenceIndex for `key`, building it on a miss from
+    load_documents() -> (documents, complete); incomplete ones aren't cached
+    """
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            metrics.record_cache("sentence_index", True)
+            return _cache[key]
+    metrics.record_cache("sentence_index", False)
+    documents, complete = load_documents()
+    index = SentenceIndex(documents)
+    if not complete:
+        return index
+    with _cache_lock:
+        _cache[key] = index
+        while len(_cache) > EXTRACTIVE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return index
+
+
+def extract_answer(index, question, min_score=EXTRACTIVE_MIN_SCORE):
+    """Answer from a single document sentence if confident enough, else None"""
+    score, sentence = index.best_match(question)
+    if sentence is None or score < min_score:
+        return None
+    filename, start, end, text, _ = sentence
+    return {
+        "answer": f"(From local source) {text}",
+        "score": round(score, 3),
+        "source": {"filename": filename, "start": start, "end": end, "text": text},
+    }
@@ -0,0 +1,90 @@
+"""
+Tiny stand-in for the AI21 chat completions API.
+
+Run it and point the app at it:
+
+    python fake_ai21_server.py --port 8001 --latency-ms 300 --error-rate 0.1
+    AI21_API_HOST=http://127.0.0.1:8001/studio/v1 AI21_API_KEY=fake python app_flask.py
+
+Useful for exercising timeouts, retries, hedging and the circuit breaker in
+llm_client.py over real HTTP. Answers, latency and failures come from
+llm_provider.FakeProvider, so FAKE_LLM_* environment variables apply too;
+use LLM_PROVIDER=fake instead to skip HTTP entirely.
+"""
+import argparse
+import json
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_provider import FakeProvider, ProviderError
+
+
+def make_handler(provider):
+    class FakeAI21Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not self.path.endswith("/chat/completions"):
+                self._reply(404, {"detail": "Not found"})
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            messages = body.get("messages", [])
+            model = body.get("model", "")
+
+            try:
+                if body.get("stream"):
+                    chunks = provider.stream(messages, model)
+                else:
+                    completion = provider.complete(messages, model)
+            except ProviderError as e:
+                self._reply(e.status_code, {"detail": e.details})
+                return
+
+            if body.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(f"data: {json.dumps(asdict(chunk))}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                return
+
+            self._reply(200, asdict(completion))
+
+        def _reply(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeAI21Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake AI21 chat completions server")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-dist", default=None, help="fixed | uniform | normal | lognormal")
+    parser.add_argument("--latency-ms", type=float, default=None)
+    parser.add_argument("--latency-spread", type=float, default=None, help="fraction of --latency-ms")
+    parser.add_argument("--error-rate", type=float, default=None)
+    parser.add_argument("--error-status", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    provider = FakeProvider(
+        latency_dist=args.latency_dist,
+        latency_ms=args.latency_ms,
+        latency_spread=args.latency_spread,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(provider))
+    print(f"🧪 Fake AI21 server listening on http://127.0.0.1:{args.port}/studio/v1")
+    server.serve_forever()
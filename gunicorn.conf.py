@@ -0,0 +1,49 @@
+"""
+Production serving profile for app_flask.py.
+
+    pip install gunicorn            # plus gevent for GUNICORN_WORKER_CLASS=gevent
+    gunicorn -c gunicorn.conf.py
+
+Each worker process calls create_app() after the fork (preload_app is off),
+so it builds its own LLM client, message writer and MongoDB pool. Most of
+an /ask request is spent waiting on the LLM, so workers are threaded:
+
+    GUNICORN_BIND           default 0.0.0.0:5000
+    GUNICORN_WORKERS        processes (default: CPU count, at least 2)
+    GUNICORN_WORKER_CLASS   gthread (default) or gevent
+    GUNICORN_THREADS        threads per gthread worker (default 8)
+    GUNICORN_CONNECTIONS    concurrent requests per gevent worker (default 200)
+    GUNICORN_TIMEOUT        seconds before a silent worker is restarted (default 180)
+
+Keep MONGO_MAX_POOL_SIZE at or above the per-worker concurrency (threads or
+connections), and GUNICORN_TIMEOUT above the worst-case LLM call
+(LLM_TIMEOUT_SEC x (LLM_MAX_RETRIES + 1) plus backoff). Set
+RATE_LIMIT_BACKEND=mongo so rate limits and the LLM concurrency cap are
+shared by all workers, and METRICS_DIR so /metrics reports all of them.
+"""
+import multiprocessing
+import os
+
+wsgi_app = "app_flask:create_app()"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", str(max(2, multiprocessing.cpu_count()))))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_connections = int(os.getenv("GUNICORN_CONNECTIONS", "200"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+# Time for a stopping worker to finish requests and flush queued chat messages
+graceful_timeout = 30
+keepalive = 5
+preload_app = False
+
+# Recycle workers now and then so a slow leak can't grow without bound
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.getenv("GUNICORN_ACCESSLOG", "-")
+
+
+def child_exit(server, worker):
+    # Runs in the master: drop the exited worker's /metrics snapshot (METRICS_DIR mode)
+    import metrics
+    metrics.remove_snapshot(worker.pid)
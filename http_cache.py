@@ -0,0 +1,146 @@
+"""
+Conditional responses and compression for the read-heavy endpoints.
+
+/session/list, /document/list and /chat/history are polled by script.js and
+usually return what the client already has. Those routes compute a strong
+ETag from version counters kept by datastore, which are cached in-process so
+a repeat request is answered with 304 before any MongoDB read. Responses
+carry `Cache-Control: no-cache`, so clients always revalidate.
+
+Bodies of at least COMPRESS_MIN_BYTES are compressed with brotli (when the
+optional `brotli` package is installed and the client accepts it) or gzip.
+A compressed variant gets its own ETag (`<etag>-br` / `<etag>-gzip`), and
+If-None-Match accepts any variant of the current tag. Streamed responses
+(see json_provider.stream_response) are compressed chunk by chunk as they
+are sent.
+
+    COMPRESS_MIN_BYTES   smallest body worth compressing (default 1024)
+    GZIP_LEVEL           1..9 (default 6)
+    BROTLI_QUALITY       0..11 (default 5)
+"""
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import zlib
+
+from dotenv import load_dotenv
+from flask import current_app, request
+
+import metrics
+
+load_dotenv()
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+COMPRESSIBLE = ("application/json", "text/")
+ENCODINGS = ("br", "gzip")
+HAS_BROTLI = importlib.util.find_spec("brotli") is not None
+
+
+# ------------------------------
+# ETags
+# ------------------------------
+def make_etag(*parts):
+    """Strong ETag for a representation identified by `parts` (versions, query parameters, ...)"""
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def _base_tag(tag):
+    for encoding in ENCODINGS:
+        if tag.endswith(f"-{encoding}"):
+            return tag[:-len(encoding) - 1]
+    return tag
+
+
+def not_modified(etag):
+    """A 304 response if the client's If-None-Match covers `etag`, otherwise None"""
+    for tag in request.if_none_match.as_set():
+        if tag == "*" or _base_tag(tag) == etag:
+            response = current_app.response_class(status=304)
+            response.set_etag(tag if tag != "*" else etag)
+            response.headers["Cache-Control"] = "no-cache"
+            response.vary.add("Accept-Encoding")
+            metrics.record_cache("http_etag", True)
+            return response
+    metrics.record_cache("http_etag", False)
+    return None
+
+
+def tagged(response, etag):
+    """Attach `etag` to a full response"""
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+# ------------------------------
+# Compression
+# ------------------------------
+def _choose_encoding():
+    accepted = request.accept_encodings
+    if HAS_BROTLI and accepted.quality("br") > 0:
+        return "br"
+    if accepted.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+def _compress_stream(chunks, encoding):
+    """Compress an iterable of byte chunks incrementally"""
+    if encoding == "br":
+        import brotli
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        compress, finish = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            out = compress(chunk)
+            if out:
+                yield out
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    """after_request hook: compress large text/JSON bodies"""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE)):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        # Only large bodies are streamed; never buffer one just to measure it
+        encoding = _choose_encoding()
+        if not encoding:
+            return response
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        encoding = _choose_encoding() if len(data) >= COMPRESS_MIN_BYTES else None
+        if not encoding:
+            return response
+        if encoding == "br":
+            import brotli
+            body = brotli.compress(data, quality=BROTLI_QUALITY)
+        else:
+            body = gzip.compress(data, compresslevel=GZIP_LEVEL)
+        response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
@@ -0,0 +1,376 @@
+"""
+Bulk ingestion of document folders into a session (`python cli.py ingest`).
+
+Walks directories and glob patterns, keeps the supported types (--types),
+and for each file, on a pool of --workers threads:
+
+  1. skips it if the session already holds this filename with the same
+     SHA-256 (files whose size and mtime match the state file aren't even
+     re-read)
+  2. extracts its text; PDFs are parsed on --processes worker processes
+     (default: one per CPU), since PDF parsing is CPU-bound and PyMuPDF
+     can't parse in several threads of one process at once; they are
+     started with forkserver (spawn where that's missing), never forked
+     from this process with its threads and MongoClient already running
+  3. stores the file and its extracted text in GridFS
+
+Stored files are attached to the session in batches of --batch, replacing
+earlier versions with the same filename. Each attached file is appended to
+the state file (default .ingest_state/<session>.jsonl), so an interrupted
+run started again with --session <id> resumes where it stopped.
+
+Files are named by their path relative to the directory given (or to the
+part of a glob before its first wildcard). With several paths, names start
+with a label for the path they came from, the directory's name or as much
+of its path as tells it apart from the others: `ingest shared/contracts
+shared/policies` stores contracts/a.txt and policies/a.txt. Two files never
+end up under the same name; a file that would is reported as failed.
+
+    python cli.py ingest archive/ --new-session "Contracts archive" --workers 16
+    python cli.py ingest "scans/**/*.pdf" --session <id> --processes 4
+"""
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import datastore
+
+SUPPORTED_TYPES = ("txt", "pdf", "docx")
+STATE_DIR = ".ingest_state"
+
+
+# ------------------------------
+# Finding files
+# ------------------------------
+def file_type(path):
+    return path.rsplit(".", 1)[-1].lower() if "." in os.path.basename(path) else ""
+
+
+def _target_base(target):
+    """The directory names of files under `target` are relative to"""
+    if os.path.isdir(target):
+        return target
+    return (os.path.dirname(target) or ".") if os.path.isfile(target) else _glob_base(target)
+
+
+def root_labels(roots):
+    """
+    Name prefixes for several root directories: the shortest trailing part of
+    each path that still tells the roots apart ("contracts", or "a/docs" and
+    "b/docs"); the same directory always gets the same label.
+    """
+    paths = [os.path.abspath(r) for r in roots]
+    parts = [p.strip(os.sep).split(os.sep) for p in paths]
+    for depth in range(1, max(len(p) for p in parts) + 1):
+        labels = ["/".join(p[-depth:]) for p in parts]
+        if len(set(labels)) == len(set(paths)):
+            return labels
+    return ["/".join(p) for p in parts]
+
+
+def document_name(path, base, label=""):
+    name = os.path.relpath(path, base).replace(os.sep, "/")
+    return f"{label}/{name}" if label else name
+
+
+def discover(targets, types=SUPPORTED_TYPES):
+    """Yield (path, name) for every file of `types` under the directories / globs / files in `targets`"""
+    targets = list(targets)
+    bases = [_target_base(t) for t in targets]
+    labels = root_labels(bases) if len(targets) > 1 else [""]
+    seen = set()
+    for target, base, label in zip(targets, bases, labels):
+        if os.path.isdir(target):
+            paths = _walk(target)
+        else:
+            paths = sorted(p for p in glob.iglob(target, recursive=True) if os.path.isfile(p))
+        for path in paths:
+            real = os.path.realpath(path)
+            if file_type(path) not in types or real in seen:
+                continue
+            seen.add(real)
+            yield path, document_name(path, base, label)
+
+
+def _glob_base(pattern):
+    """The directory part of a glob pattern before its first wildcard"""
+    parts = []
+    for part in pattern.replace(os.sep, "/").split("/")[:-1]:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return "/".join(parts) or "."
+
+
+def _walk(directory):
+    """Files under `directory` in a stable (sorted) order"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for f in sorted(files):
+            yield os.path.join(root, f)
+
+
+def sha256_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# ------------------------------
+# Extraction
+# ------------------------------
+def extract(path, kind):
+    """Text of a file on disk (module-level, so it can run in a worker process)"""
+    from app_flask import extract_text_from_file
+    return extract_text_from_file(path, kind)
+
+
+def _process_context():
+    """Start method for the extraction processes: a clean interpreter, not a fork of this one"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+# ------------------------------
+# Resume state
+# ------------------------------
+def state_path_for(session_id):
+    return os.path.join(STATE_DIR, f"{session_id}.jsonl")
+
+
+class State:
+    """
+    Append-only record of the files attached to a session: name -> {path, size, mtime_ns, sha256}.
+    Every re-ingest of a file appends a line, so a file mostly made of superseded lines is
+    rewritten with the current entries when loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by the interruption
+                    self.files[entry["name"]] = entry
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if lines > 2 * len(self.files):
+            self._compact()
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def _compact(self):
+        partial = self.path + ".tmp"
+        with open(partial, "w", encoding="utf-8") as f:
+            for entry in self.files.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(partial, self.path)
+
+    def unchanged(self, name, stat):
+        entry = self.files.get(name)
+        return entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+    def add(self, entries):
+        with self._lock:
+            for entry in entries:
+                self.files[entry["name"]] = entry
+                self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# ------------------------------
+# Progress
+# ------------------------------
+class Progress:
+    def __init__(self, stream=sys.stderr, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.started = time.monotonic()
+        self.counts = {"seen": 0, "stored": 0, "unchanged": 0, "failed": 0}
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._last = 0.0
+
+    def add(self, outcome, size=0):
+        with self._lock:
+            self.counts[outcome] += 1
+            self.bytes += size
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.print(end="\r")
+
+    def seen(self):
+        with self._lock:
+            self.counts["seen"] += 1
+
+    def line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        c = self.counts
+        done = c["stored"] + c["unchanged"] + c["failed"]
+        return (f"{done}/{c['seen']} files  stored {c['stored']}  unchanged {c['unchanged']}  failed {c['failed']}  "
+                f"{done / elapsed:.1f} files/s  {self.bytes / elapsed / 1e6:.1f} MB/s")
+
+    def print(self, end="\n"):
+        print(self.line().ljust(100), end=end, file=self.stream, flush=True)
+
+
+# ------------------------------
+# Ingest
+# ------------------------------
+class Ingester:
+    def __init__(self, session_id, workers=8, processes=0, batch=200, state_path=None, dry_run=False,
+                 progress=None, state=None):
+        session = datastore.get_session(session_id, ["documents"])
+        if session is None:
+            raise LookupError(f"Session {session_id} not found")
+        self.session_id = session_id
+        self.documents = {d["filename"]: d for d in session.get("documents", [])}
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.batch = max(1, batch)
+        self.dry_run = dry_run
+        # A State passed in (the watcher's, open for its lifetime) is left open after run()
+        self.state = state or State(state_path or state_path_for(session_id))
+        self._owns_state = state is None
+        self.progress = progress or Progress()
+        self.failures = []  # (path, error)
+        self._extract_pool = None
+        self._names = {}  # name -> path, so two files can't claim one document
+
+    def run(self, files):
+        """Ingest (path, name) pairs; returns the progress counters"""
+        if self.processes:
+            self._extract_pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=_process_context())
+        pending, ready = set(), []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ingest") as pool:
+                try:
+                    for path, name in files:
+                        self.progress.seen()
+                        if self._names.setdefault(name, path) != path:
+                            self.failures.append((path, f"same name as {self._names[name]}: {name}"))
+                            self.progress.add("failed")
+                            continue
+                        pending.add(pool.submit(self._one, path, name))
+                        # Bounded in-flight work: discovery never runs far ahead of the uploads
+                        if len(pending) >= self.workers * 4:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            ready.extend(self._collect(done))
+                        if len(ready) >= self.batch:
+                            self._attach(ready)
+                            ready = []
+                except KeyboardInterrupt:
+                    for future in pending:
+                        future.cancel()
+                    raise
+                finally:
+                    # Files already stored are attached (and recorded) even when interrupted
+                    done, _ = wait(pending)
+                    ready.extend(self._collect(done))
+                    self._attach(ready)
+        finally:
+            if self._extract_pool:
+                self._extract_pool.shutdown()
+            if self._owns_state:
+                self.state.close()
+        self.progress.print()
+        return dict(self.progress.counts)
+
+    def _one(self, path, name):
+        """Hash, extract and store one file; returns (ref, state entry) or None when skipped"""
+        try:
+            stat = os.stat(path)
+            current = self.documents.get(name)
+            if current and self.state.unchanged(name, stat) and current.get("sha256") == self.state.files[name]["sha256"]:
+                self.progress.add("unchanged")
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = sha256_of(data)
+            entry = {"name": name, "path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+            if current and current.get("sha256") == digest:
+                self.state.add([entry])  # same content, new mtime: remember it to skip the read next time
+                self.progress.add("unchanged")
+                return None
+            kind = file_type(path)
+            if self._extract_pool and kind == "pdf":
+                text = self._extract_pool.submit(extract, path, kind).result()
+            else:
+                text = extract(path, kind)
+            if self.dry_run:
+                self.progress.add("stored", len(data))
+                return None
+            gridfs_id = datastore.store_file(data, name)
+            text_id = datastore.store_text(text, name)
+            ref = datastore.document_ref(name, gridfs_id, kind, sha256=digest, size=len(data), text_id=text_id)
+            self.progress.add("stored", len(data))
+            return ref, entry
+        except Exception as e:
+            self.failures.append((path, f"{type(e).__name__}: {e}"))
+            self.progress.add("failed")
+            return None
+
+    def _collect(self, futures):
+        return [f.result() for f in futures if not f.cancelled() and f.result() is not None]
+
+    def _attach(self, ready):
+        """Attach one batch to the session, replacing older versions, then record it as done"""
+        if not ready:
+            return
+        refs = [ref for ref, _ in ready]  # names are unique: run() turns duplicates away
+        replaced = [ref["filename"] for ref in refs if ref["filename"] in self.documents]
+        datastore.delete_documents(self.session_id, replaced)
+        datastore.add_documents(self.session_id, refs)
+        self.documents.update((ref["filename"], ref) for ref in refs)
+        self.state.add([entry for _, entry in ready])
+
+
+def run(args):
+    """`cli.py ingest`"""
+    types = tuple(t.strip().lower().lstrip(".") for t in args.types.split(",") if t.strip())
+    unsupported = set(types) - set(SUPPORTED_TYPES)
+    if unsupported:
+        raise SystemExit(f"Unsupported types: {', '.join(sorted(unsupported))} (supported: {', '.join(SUPPORTED_TYPES)})")
+
+    session_id = args.session
+    if not session_id:
+        session_id = datastore.create_session(args.new_session or "Ingested documents")
+        print(f"Created session {session_id} (resume with --session {session_id})", file=sys.stderr)
+
+    try:
+        ingester = Ingester(session_id, workers=args.workers, processes=args.processes, batch=args.batch,
+                            state_path=args.state, dry_run=args.dry_run)
+    except LookupError as e:
+        raise SystemExit(str(e))
+    counts = ingester.run(discover(args.paths, types))
+    for path, error in ingester.failures:
+        print(f"failed: {path}: {error}", file=sys.stderr)
+    print(json.dumps({"session_id": session_id, **counts}))
+    return 1 if ingester.failures else 0
+
+
+def add_arguments(parser):
+    parser.add_argument("paths", nargs="+", help="directories, files or glob patterns (quote ** globs)")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--session", help="add to this existing session")
+    target.add_argument("--new-session", metavar="DESCRIPTION", help="create a session with this description")
+    parser.add_argument("--types", default=",".join(SUPPORTED_TYPES), help="comma-separated file types")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent hash/extract/upload workers")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="parse PDFs on this many processes (default: CPU count; 0 = in the workers, one at a time)")
+    parser.add_argument("--batch", type=int, default=200, help="files attached to the session per update")
+    parser.add_argument("--state", help=f"resume state file (default {STATE_DIR}/<session>.jsonl)")
+    parser.add_argument("--dry-run", action="store_true", help="hash and extract, but store nothing")
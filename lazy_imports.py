@@ -0,0 +1,49 @@
+"""
+Deferred imports for heavy optional dependencies (PyMuPDF, python-docx, pymongo, ...).
+
+    fitz = lazy_import("fitz")   # nothing is loaded yet
+    fitz.open(path)              # the real import happens here, once
+
+The stand-in imports the module with a plain importlib.import_module under
+a lock on first attribute access, then forwards to it. importlib's
+LazyLoader is not used: before Python 3.12.3 two threads touching a lazy
+module at the same time could see it half-executed, and request threads,
+the write-behind flusher and the LLM workers all reach these first.
+A module that isn't installed still fails at lazy_import() time.
+"""
+import importlib
+import importlib.util
+import sys
+import threading
+
+
+class LazyModule:
+    """Stand-in for a module, imported on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded yet"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name):
+    """Return `name` as a module that is imported on first attribute access"""
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    return LazyModule(name)
@@ -0,0 +1,324 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from dotenv import load_dotenv
+
+import llm_usage
+import metrics
+from llm_provider import get_provider
+
+# ------------------------------
+# Configuration
+# ------------------------------
+# All knobs come from the environment (or .env) so the Flask app and the
+# CLI scripts share the same behaviour. Use LLM_PROVIDER=fake (see
+# llm_provider.py) or point AI21_API_HOST at fake_ai21_server.py to exercise
+# this without network.
+load_dotenv()
+
+LLM_TIMEOUT_SEC = float(os.getenv("LLM_TIMEOUT_SEC", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE_SEC = float(os.getenv("LLM_BACKOFF_BASE_SEC", "0.5"))
+LLM_BACKOFF_MAX_SEC = float(os.getenv("LLM_BACKOFF_MAX_SEC", "8"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))  # 0 = hedging off
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SEC = float(os.getenv("LLM_BREAKER_RESET_SEC", "30"))
+
+# HTTP statuses worth another attempt; everything else (400, 401, 422...) is final
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+# ------------------------------
+# Errors
+# ------------------------------
+class LLMUnavailableError(Exception):
+    """The provider could not produce an answer (down, timing out, or circuit open)"""
+
+
+class LLMTimeoutError(LLMUnavailableError):
+    """A single provider call exceeded its timeout"""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised without calling the provider while the circuit breaker is open"""
+
+
+def is_retryable(error):
+    """Decide whether a provider error is transient"""
+    # httpx is only loaded once the AI21 SDK is; an error can't be one of its types before that
+    httpx = sys.modules.get("httpx")
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, (LLMTimeoutError, ConnectionError, TimeoutError)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+
+# ------------------------------
+# Circuit breaker
+# ------------------------------
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker.
+    After `failure_threshold` consecutive retryable failures every call fails
+    fast for `reset_timeout` seconds, then a single trial call is let through.
+    """
+
+    def __init__(self, failure_threshold=LLM_BREAKER_FAILURES, reset_timeout=LLM_BREAKER_RESET_SEC):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_neutral(self):
+        """A call that says nothing about upstream health (e.g. a 4xx): frees the half-open trial only"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+
+# ------------------------------
+# Latency tracking (for hedging)
+# ------------------------------
+class LatencyTracker:
+    """Sliding window of recent successful call latencies"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct, min_samples=1):
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+# ------------------------------
+# Resilient client
+# ------------------------------
+class _Completions:
+    def __init__(self, create):
+        self.create = create
+
+
+class _Chat:
+    def __init__(self, create):
+        self.completions = _Completions(create)
+
+
+class ResilientLLMClient:
+    """
+    Drop-in replacement for AI21Client's `chat.completions.create`, backed
+    by any provider from llm_provider.py.
+
+    Every call gets a hard timeout, jittered exponential backoff on retryable
+    errors and fails fast through a shared circuit breaker. When
+    `hedge_percentile` is set, a second identical request is fired once the
+    first has been outstanding longer than that latency percentile (and a
+    worker is free to send it), and whichever finishes first wins. The
+    remaining time is handed to the provider as `timeout` so that a call
+    nobody waits for any more stops on its own. With an `admission` limiter (see
+    rate_limit.ConcurrencyLimiter) each logical call holds one of its slots,
+    retries included, and rate_limit.RateLimited is raised when none frees up.
+    """
+
+    def __init__(self, provider, timeout=LLM_TIMEOUT_SEC, max_retries=LLM_MAX_RETRIES,
+                 backoff_base=LLM_BACKOFF_BASE_SEC, backoff_max=LLM_BACKOFF_MAX_SEC,
+                 hedge_percentile=LLM_HEDGE_PERCENTILE, hedge_min_samples=LLM_HEDGE_MIN_SAMPLES,
+                 breaker=None, max_workers=32, admission=None):
+        self.provider = provider
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = LatencyTracker()
+        self.admission = admission
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.chat = _Chat(self.create)
+
+    def create(self, messages, model, timeout=None, **kwargs):
+        """
+        Call the provider with timeout, retries, hedging and circuit breaking;
+        `timeout` caps the whole call, retries included, below the client's
+        own per-attempt timeout
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with metrics.stage("llm"):
+            if self.admission is None:
+                result = self._create(messages, model, kwargs, deadline)
+            else:
+                with self.admission.slot():
+                    result = self._create(messages, model, kwargs, deadline)
+        if kwargs.get("stream"):
+            # Bound now: the caller may consume the stream outside the tally that made the call
+            return self._counted(result, model, llm_usage.bind(llm_usage.record))
+        metrics.record_tokens(model, getattr(result, "usage", None))
+        llm_usage.record(model, getattr(result, "usage", None))
+        return result
+
+    @staticmethod
+    def _counted(chunks, model, record):
+        """Pass a stream through, counting the usage its last chunk carries once the caller gets there"""
+        for chunk in chunks:
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                metrics.record_tokens(model, usage)
+                record(model, usage)
+            yield chunk
+
+    def _create(self, messages, model, kwargs, deadline=None):
+        attempt = 0
+        while True:
+            if deadline is not None and deadline <= time.monotonic():
+                raise LLMTimeoutError("LLM call ran out of time before its next attempt")
+            if not self.breaker.allow():
+                raise CircuitOpenError("LLM provider circuit is open, failing fast")
+            try:
+                result = self._attempt(messages, model, kwargs, deadline)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The provider answered, just not happily: neither a failure nor proof of health
+                    self.breaker.record_neutral()
+                    raise
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    if isinstance(e, LLMUnavailableError):
+                        raise
+                    raise LLMUnavailableError(f"LLM provider failed after {attempt + 1} attempts: {e}") from e
+                pause = self._backoff(attempt)
+                if deadline is not None:
+                    pause = min(pause, max(0.0, deadline - time.monotonic()))
+                time.sleep(pause)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _backoff(self, attempt):
+        """Full-jitter exponential backoff"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _call(self, messages, model, kwargs, deadline):
+        started = time.monotonic()
+        kwargs = dict(kwargs)  # hedged calls share the caller's kwargs
+        # The provider gives up by itself at the deadline, so an abandoned call frees its worker
+        kwargs["timeout"] = max(0.001, deadline - started)
+        try:
+            if kwargs.pop("stream", False):
+                # Only time-to-stream is covered by the timeout; chunks are consumed by the caller
+                result = self.provider.stream(messages, model, **kwargs)
+            else:
+                result = self.provider.complete(messages, model, **kwargs)
+        except TimeoutError as e:
+            raise LLMTimeoutError(f"LLM call timed out after {kwargs['timeout']:.1f}s") from e
+        self.latencies.add(time.monotonic() - started)
+        return result
+
+    def _submit(self, messages, model, kwargs, deadline):
+        with self._lock:
+            self._in_flight += 1
+        future = self._executor.submit(self._call, messages, model, kwargs, deadline)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _has_idle_worker(self):
+        with self._lock:
+            return self._in_flight < self.max_workers
+
+    def _attempt(self, messages, model, kwargs, call_deadline=None):
+        """One logical attempt: a primary request plus an optional hedge"""
+        timeout = self.timeout
+        if call_deadline is not None:
+            timeout = max(0.001, min(timeout, call_deadline - time.monotonic()))
+        deadline = time.monotonic() + timeout
+        futures = [self._submit(messages, model, kwargs, deadline)]
+
+        hedge_after = None
+        if self.hedge_percentile:
+            hedge_after = self.latencies.percentile(self.hedge_percentile, self.hedge_min_samples)
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            # A hedge that would queue behind other calls only adds load; skip it when every worker is busy
+            if not done and self._has_idle_worker():
+                futures.append(self._submit(messages, model, kwargs, deadline))
+
+        error = None
+        pending = set(futures)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+
+        if pending:
+            for future in pending:
+                future.cancel()
+            raise LLMTimeoutError(f"LLM call timed out after {timeout:.1f}s")
+        raise error
+
+
+def get_llm_client(api_key=None, provider=None, **options):
+    """Build a ResilientLLMClient around the provider selected by LLM_PROVIDER"""
+    if provider is None:
+        if os.getenv("LLM_PROVIDER", "ai21").lower() == "ai21":
+            provider = get_provider("ai21", api_key=api_key, timeout=options.get("timeout", LLM_TIMEOUT_SEC))
+        else:
+            provider = get_provider()
+    return ResilientLLMClient(provider, **options)
@@ -0,0 +1,268 @@
+"""
+LLM provider backends.
+
+The rest of the code only talks to a provider through `complete()` (and
+`stream()`), so the real AI21 API can be swapped for a local fake when load
+testing. The backend is picked with LLM_PROVIDER=ai21|fake (default ai21).
+Both take an optional per-call `timeout` (seconds) and raise TimeoutError
+rather than run past it.
+
+The fake backend is deterministic for a given FAKE_LLM_SEED and simulates
+latency distributions, streaming, token usage and injected failures:
+
+    FAKE_LLM_LATENCY_DIST      fixed | uniform | normal | lognormal
+    FAKE_LLM_LATENCY_MS        median time to first token
+    FAKE_LLM_LATENCY_SPREAD    relative spread (default 0.4): +/- that fraction of the
+                               latency for uniform, its sigma as a fraction for normal,
+                               the log-space sigma for lognormal
+    FAKE_LLM_TOKENS_PER_SEC    generation speed after the first token (0 = instant)
+    FAKE_LLM_COMPLETION_TOKENS length of generated answers
+    FAKE_LLM_ERROR_RATE        fraction of calls failing with FAKE_LLM_ERROR_STATUS
+    FAKE_LLM_HANG_RATE         fraction of calls that stall for FAKE_LLM_HANG_SEC
+                               (or until the call's timeout, whichever is shorter)
+"""
+import math
+
+import os
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# ------------------------------
+# Response shapes (mirror ai21's ChatCompletionResponse)
+# ------------------------------
+@dataclass
+class Message:
+    role: str
+    content: str
+
+
+# Request messages have the same shape. Callers build them with
+# ChatMessage(content=..., role=...) as with the SDK, without importing ai21.
+ChatMessage = Message
+
+
+@dataclass
+class Choice:
+    index: int
+    message: Optional[Message] = None
+    delta: Optional[Message] = None
+    finish_reason: Optional[str] = None
+
+
+@dataclass
+class Usage:
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+
+@dataclass
+class ChatCompletion:
+    id: str
+    choices: List[Choice]
+    usage: Optional[Usage] = None
+    model: str = ""
+
+
+class ProviderError(Exception):
+    """Error raised by a provider backend, carrying an HTTP-like status code"""
+
+    def __init__(self, status_code, details=""):
+        super().__init__(f"Provider failed with status {status_code}: {details}")
+        self.status_code = status_code
+        self.details = details
+
+
+def count_tokens(text):
+    """Cheap token estimate (~4 characters per token), good enough for accounting"""
+    return max(1, len(text) // 4) if text else 0
+
+
+def _role_and_content(message):
+    """Accept ai21 ChatMessage objects as well as plain dicts"""
+    if isinstance(message, dict):
+        return message.get("role", "user"), message.get("content", "")
+    return getattr(message, "role", "user"), getattr(message, "content", "")
+
+
+# ------------------------------
+# Provider interface
+# ------------------------------
+class LLMProvider:
+    """Base class: turn a list of chat messages into a completion"""
+
+    name = "base"
+
+    def complete(self, messages, model, timeout=None, **kwargs):
+        raise NotImplementedError
+
+    def stream(self, messages, model, timeout=None, **kwargs):
+        """Yield ChatCompletion chunks whose choices carry a `delta`"""
+        raise NotImplementedError
+
+
+class AI21Provider(LLMProvider):
+    """The real AI21 Studio API (honours AI21_API_HOST for self-hosted endpoints)"""
+
+    name = "ai21"
+
+    def __init__(self, api_key=None, timeout=None):
+        self.api_key = api_key or os.getenv("AI21_API_KEY")
+        self.timeout = timeout
+        self._sdks = {}
+        self._lock = threading.Lock()
+
+    def _client(self, timeout=None):
+        # The SDK only takes a timeout when the client is built, so keep one client per whole
+        # second of timeout (rounded up; a handful at most, each with its own connection pool)
+        timeout = math.ceil(timeout) if timeout is not None else self.timeout
+        sdk = self._sdks.get(timeout)
+        if sdk is None:
+            with self._lock:
+                sdk = self._sdks.get(timeout)
+                if sdk is None:
+                    # The SDK (and its pydantic/httpx stack) loads on the first call, not at startup
+                    from ai21 import AI21Client
+                    sdk = self._sdks[timeout] = AI21Client(
+                        api_key=self.api_key,
+                        timeout_sec=timeout,
+                        num_retries=0,  # retries are handled by llm_client with backoff and the breaker
+                    )
+        return sdk
+
+    @staticmethod
+    def _messages(messages):
+        from ai21.models.chat import ChatMessage as AI21ChatMessage
+        return [AI21ChatMessage(role=role, content=content) for role, content in map(_role_and_content, messages)]
+
+    def complete(self, messages, model, timeout=None, **kwargs):
+        return self._client(timeout).chat.completions.create(
+            messages=self._messages(messages), model=model, **kwargs
+        )
+
+    def stream(self, messages, model, timeout=None, **kwargs):
+        return self._client(timeout).chat.completions.create(
+            messages=self._messages(messages), model=model, stream=True, **kwargs
+        )
+
+
+class FakeProvider(LLMProvider):
+    """Deterministic offline backend for load tests and local development"""
+
+    name = "fake"
+
+    def __init__(self, latency_dist=None, latency_ms=None, latency_spread=None,
+                 tokens_per_sec=None, completion_tokens=None, error_rate=None,
+                 error_status=None, hang_rate=None, hang_sec=None, seed=None):
+        env = os.getenv
+        self.latency_dist = latency_dist or env("FAKE_LLM_LATENCY_DIST", "lognormal")
+        self.latency_ms = float(latency_ms if latency_ms is not None else env("FAKE_LLM_LATENCY_MS", "400"))
+        self.latency_spread = float(latency_spread if latency_spread is not None else env("FAKE_LLM_LATENCY_SPREAD", "0.4"))
+        self.tokens_per_sec = float(tokens_per_sec if tokens_per_sec is not None else env("FAKE_LLM_TOKENS_PER_SEC", "0"))
+        self.completion_tokens = int(completion_tokens if completion_tokens is not None else env("FAKE_LLM_COMPLETION_TOKENS", "40"))
+        self.error_rate = float(error_rate if error_rate is not None else env("FAKE_LLM_ERROR_RATE", "0"))
+        self.error_status = int(error_status if error_status is not None else env("FAKE_LLM_ERROR_STATUS", "503"))
+        self.hang_rate = float(hang_rate if hang_rate is not None else env("FAKE_LLM_HANG_RATE", "0"))
+        self.hang_sec = float(hang_sec if hang_sec is not None else env("FAKE_LLM_HANG_SEC", "120"))
+        self._random = random.Random(int(seed if seed is not None else env("FAKE_LLM_SEED", "0")))
+        self._lock = threading.Lock()
+
+    def _draw(self):
+        """Draw (first-token latency, fail?, hang?) from the shared seeded RNG"""
+        with self._lock:
+            r = self._random
+            if self.latency_dist == "fixed":
+                latency = self.latency_ms
+            elif self.latency_dist == "uniform":
+                spread = self.latency_ms * self.latency_spread
+                latency = r.uniform(self.latency_ms - spread, self.latency_ms + spread)
+            elif self.latency_dist == "normal":
+                latency = r.gauss(self.latency_ms, self.latency_ms * self.latency_spread)
+            else:  # lognormal: median latency_ms, long right tail like real providers
+                latency = r.lognormvariate(0, self.latency_spread) * self.latency_ms
+            return max(0.0, latency) / 1000.0, r.random() < self.error_rate, r.random() < self.hang_rate
+
+    def _answer(self, messages):
+        system, question = "", ""
+        for message in messages:
+            role, content = _role_and_content(message)
+            if role == "system":
+                system = content
+            elif role == "user":
+                question = content
+        source = "(From local source)" if "external knowledge" in system else "(From Global source)"
+        words = f"{source} Fake answer to: {question}".split()
+        filler = ["lorem", "ipsum", "dolor", "sit", "amet"]
+        while count_tokens(" ".join(words)) < self.completion_tokens:
+            words.append(filler[len(words) % len(filler)])
+        return " ".join(words), sum(count_tokens(_role_and_content(m)[1]) for m in messages)
+
+    def _prelude(self, timeout):
+        latency, fail, hang = self._draw()
+        if hang:
+            latency += self.hang_sec
+        if timeout is not None and latency > timeout:
+            # Like an HTTP client with a read timeout: wait that long, then give up
+            time.sleep(timeout)
+            raise TimeoutError(f"Fake LLM call timed out after {timeout:.1f}s")
+        time.sleep(latency)
+        if fail:
+            raise ProviderError(self.error_status, "Injected failure")
+
+    def complete(self, messages, model, timeout=None, **kwargs):
+        self._prelude(timeout)
+        answer, prompt_tokens = self._answer(messages)
+        completion_tokens = count_tokens(answer)
+        if self.tokens_per_sec:
+            time.sleep(completion_tokens / self.tokens_per_sec)
+        return ChatCompletion(
+            id=str(uuid.uuid4()),
+            choices=[Choice(index=0, message=Message("assistant", answer), finish_reason="stop")],
+            usage=Usage(prompt_tokens, completion_tokens, prompt_tokens + completion_tokens),
+            model=model,
+        )
+
+    def stream(self, messages, model, timeout=None, **kwargs):
+        # Latency and failures happen before the first chunk, like a real HTTP stream
+        self._prelude(timeout)
+        answer, prompt_tokens = self._answer(messages)
+        return self._chunks(answer, prompt_tokens, model)
+
+    def _chunks(self, answer, prompt_tokens, model):
+        completion_id = str(uuid.uuid4())
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            if self.tokens_per_sec and i:
+                time.sleep(count_tokens(word) / self.tokens_per_sec)
+            piece = word if i == 0 else " " + word
+            yield ChatCompletion(id=completion_id, model=model,
+                                 choices=[Choice(index=0, delta=Message("assistant", piece))])
+        completion_tokens = count_tokens(answer)
+        yield ChatCompletion(
+            id=completion_id, model=model,
+            choices=[Choice(index=0, delta=Message("assistant", ""), finish_reason="stop")],
+            usage=Usage(prompt_tokens, completion_tokens, prompt_tokens + completion_tokens),
+        )
+
+
+PROVIDERS = {
+    "ai21": AI21Provider,
+    "fake": FakeProvider,
+}
+
+
+def get_provider(name=None, **options):
+    """Instantiate the backend named by `name` or LLM_PROVIDER"""
+    name = (name or os.getenv("LLM_PROVIDER", "ai21")).lower()
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown LLM_PROVIDER '{name}' (choose from: {', '.join(PROVIDERS)})")
+    return PROVIDERS[name](**options)
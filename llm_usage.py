@@ -0,0 +1,253 @@
+"""
+Token and cost accounting for LLM calls.
+
+Every completion reports its prompt / completion token counts. /ask
+collects them for the length of the request with `collect()` (map-reduce
+calls on worker threads join in through `bind()`), and the chat turn stores
+the totals and the model used:
+
+    {"question": ..., "answer": ..., "model": "jamba-large", "llm_calls": 1,
+     "prompt_tokens": 5321, "completion_tokens": 88, "cost_usd": 0.011346}
+
+Extractive answers are stored with model None and zero tokens.
+
+When turns are written (write_behind.py batches, or datastore.save_message)
+the per-session, per-UTC-day counters in the `usage_rollups` collection are
+incremented in the same pass, so reports read a few small pre-aggregated
+documents instead of scanning the messages:
+
+    {"_id": "2026-10-19/<session_id>", "session_id": ..., "day": "2026-10-19",
+     "messages": 12, "llm_calls": 14, "prompt_tokens": ..., "completion_tokens": ...,
+     "cost_usd": ..., "models": {"jamba-large": {"llm_calls": ..., "prompt_tokens": ..., ...}}}
+
+Background summary updates (conversation_memory.py) count toward the same
+rollups without adding a message.
+
+    LLM_PRICES   USD per million tokens, "model=prompt:completion,..."; a model
+                 not listed is priced by its longest listed prefix, else at 0
+                 (default jamba-large=2:8,jamba-mini=0.2:0.4)
+"""
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from lazy_imports import lazy_import
+
+pymongo = lazy_import("pymongo")
+
+load_dotenv()
+
+USAGE_ROLLUPS_COLLECTION = "usage_rollups"
+
+COUNTERS = ("messages", "llm_calls", "prompt_tokens", "completion_tokens", "cost_usd")
+REPORT_GROUPS = ("session", "day", "model")
+REPORT_SORTS = ("cost_usd", "total_tokens", "prompt_tokens", "completion_tokens", "llm_calls", "messages")
+
+
+def _parse_prices(spec):
+    prices = {}
+    for item in spec.split(","):
+        model, _, rates = item.strip().partition("=")
+        if model and rates:
+            prompt, _, completion = rates.partition(":")
+            prices[model.strip()] = (float(prompt), float(completion or prompt))
+    return prices
+
+
+LLM_PRICES = _parse_prices(os.getenv("LLM_PRICES", "jamba-large=2:8,jamba-mini=0.2:0.4"))
+
+
+def price(model):
+    """(prompt, completion) USD per million tokens for `model`"""
+    if model in LLM_PRICES:
+        return LLM_PRICES[model]
+    prefixes = [m for m in LLM_PRICES if model and model.startswith(m)]
+    return LLM_PRICES[max(prefixes, key=len)] if prefixes else (0.0, 0.0)
+
+
+def cost(model, prompt_tokens, completion_tokens):
+    prompt_rate, completion_rate = price(model)
+    return round((prompt_tokens * prompt_rate + completion_tokens * completion_rate) / 1e6, 6)
+
+
+# ------------------------------
+# Collecting per request
+# ------------------------------
+class Tally:
+    """Token counts of the LLM calls made on behalf of one request"""
+
+    def __init__(self):
+        self.models = {}  # model -> [calls, prompt tokens, completion tokens]
+        self._lock = threading.Lock()
+
+    def add(self, model, prompt_tokens, completion_tokens):
+        with self._lock:
+            counts = self.models.setdefault(model, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += prompt_tokens
+            counts[2] += completion_tokens
+
+    def fields(self):
+        """The usage fields stored on a chat turn"""
+        with self._lock:
+            models = {m: list(c) for m, c in self.models.items()}
+        # Requests use one model; should several show up, the turn names the one that read the most
+        model = max(models, key=lambda m: models[m][1]) if models else None
+        return {
+            "model": model,
+            "llm_calls": sum(c[0] for c in models.values()),
+            "prompt_tokens": sum(c[1] for c in models.values()),
+            "completion_tokens": sum(c[2] for c in models.values()),
+            "cost_usd": round(sum(cost(m, c[1], c[2]) for m, c in models.items()), 6),
+        }
+
+
+_current = contextvars.ContextVar("llm_usage", default=None)
+
+
+@contextmanager
+def collect():
+    """Count every LLM call made inside the block (and in callables wrapped with `bind()`)"""
+    tally = Tally()
+    token = _current.set(tally)
+    try:
+        yield tally
+    finally:
+        _current.reset(token)
+
+
+def record(model, usage):
+    """Add one completion's `usage` (as returned by the provider, may be None) to the current tally"""
+    tally = _current.get()
+    if tally is None or usage is None:
+        return
+    tally.add(model, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+
+def bind(fn):
+    """Wrap `fn` so that, on whichever thread it runs, its LLM calls count toward the current tally"""
+    tally = _current.get()
+    if tally is None:
+        return fn
+
+    def counted(*args, **kwargs):
+        token = _current.set(tally)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return counted
+
+
+# ------------------------------
+# Rollups
+# ------------------------------
+def ensure_indexes(rollups):
+    rollups.create_index([("session_id", 1), ("day", 1)], name="session_day")
+    rollups.create_index([("day", 1)], name="day")
+
+
+def _model_key(model):
+    # Model names become field names: no dots, no leading $
+    return (model or "none").replace(".", "_").lstrip("$") or "none"
+
+
+def rollup_ops(records):
+    """Upserts adding chat turns (and their token fields) to the session/day rollups"""
+    totals = {}
+    for record in records:
+        if "prompt_tokens" not in record:
+            continue  # written before accounting, or by a script that doesn't count
+        key = (record["session_id"], record["timestamp"].strftime("%Y-%m-%d"))
+        inc = totals.setdefault(key, {})
+        model = _model_key(record.get("model"))
+        inc["messages"] = inc.get("messages", 0) + 1
+        for field in COUNTERS[1:]:
+            value = record.get(field) or 0
+            inc[field] = inc.get(field, 0) + value
+            if record.get("llm_calls"):
+                inc[f"models.{model}.{field}"] = inc.get(f"models.{model}.{field}", 0) + value
+    return [
+        pymongo.UpdateOne(
+            {"_id": f"{day}/{session_id}"},
+            {"$setOnInsert": {"session_id": session_id, "day": day}, "$inc": inc},
+            upsert=True,
+        )
+        for (session_id, day), inc in totals.items()
+    ]
+
+
+def record_rollups(rollups, records):
+    ops = rollup_ops(records)
+    if ops:
+        rollups.bulk_write(ops, ordered=False)
+
+
+def add_call(rollups, session_id, model, usage):
+    """Count one LLM call that produced no chat turn (e.g. a summary update) toward today's rollup"""
+    if usage is None:
+        return
+    from datetime import datetime, timezone
+    tally = Tally()
+    tally.add(model, getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+    fields = tally.fields()
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    inc = {f: fields[f] for f in COUNTERS[1:]}
+    inc.update({f"models.{_model_key(model)}.{f}": fields[f] for f in COUNTERS[1:]})
+    rollups.update_one(
+        {"_id": f"{day}/{session_id}"},
+        {"$setOnInsert": {"session_id": session_id, "day": day, "messages": 0}, "$inc": inc},
+        upsert=True,
+    )
+
+
+# ------------------------------
+# Reports
+# ------------------------------
+def _finish(row):
+    row["cost_usd"] = round(row.get("cost_usd", 0), 6)
+    row["total_tokens"] = row.get("prompt_tokens", 0) + row.get("completion_tokens", 0)
+    if row.get("messages"):
+        row["prompt_tokens_per_message"] = round(row.get("prompt_tokens", 0) / row["messages"], 1)
+    return row
+
+
+def report(rollups, group="session", session_id=None, start=None, end=None, sort="cost_usd", limit=50):
+    """
+    Usage grouped by session, day or model over the days start..end
+    (YYYY-MM-DD, inclusive), biggest `sort` first. Returns (rows, totals).
+    """
+    match = {}
+    if session_id:
+        match["session_id"] = session_id
+    if start or end:
+        match["day"] = {**({"$gte": start} if start else {}), **({"$lte": end} if end else {})}
+
+    sums = {f: {"$sum": f"${f}"} for f in COUNTERS}
+    if group == "model":
+        # Per-model counters live in the `models` sub-document; messages aren't split by model
+        pipeline = [
+            {"$match": match},
+            {"$project": {"models": {"$objectToArray": "$models"}}},
+            {"$unwind": "$models"},
+            {"$group": {"_id": "$models.k", **{f: {"$sum": f"$models.v.{f}"} for f in COUNTERS[1:]}}},
+        ]
+    else:
+        pipeline = [{"$match": match}, {"$group": {"_id": f"${'day' if group == 'day' else 'session_id'}", **sums}}]
+    # Sort and cut in MongoDB: only `limit` rows ever leave the server
+    pipeline += [
+        {"$addFields": {"total_tokens": {"$add": [{"$ifNull": ["$prompt_tokens", 0]},
+                                                  {"$ifNull": ["$completion_tokens", 0]}]}}},
+        {"$sort": {sort: -1, "_id": -1}},
+        {"$limit": max(1, limit)},
+    ]
+    rows = [_finish(row) for row in rollups.aggregate(pipeline)]
+    for row in rows:
+        row[group] = row.pop("_id")
+
+    totals = next(iter(rollups.aggregate([{"$match": match}, {"$group": {"_id": None, **sums}}])), {})
+    totals.pop("_id", None)
+    return rows, _finish({f: totals.get(f, 0) for f in COUNTERS})
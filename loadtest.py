@@ -0,0 +1,169 @@
+"""
+Closed-loop load test for the Flask API.
+
+Creates one session with an uploaded document per client, then drives each
+endpoint in turn with --concurrency keep-alive clients for --duration
+seconds and reports requests/sec and latency percentiles:
+
+    session_list       GET  /session/list
+    search_documents   POST /search/documents
+    ask                POST /ask (global mode, so every request reaches the LLM)
+
+Run it against a stubbed LLM so the numbers measure the server, not AI21,
+and with the /ask rate limits (rate_limit.py) off: every client comes from
+the same IP, so even with a session each the per-IP bucket would turn most
+requests into 429s, which are reported as "limited" rather than timed:
+
+    export LLM_PROVIDER=fake FAKE_LLM_LATENCY_MS=200 RATE_LIMIT_SESSION_PER_MIN=0 RATE_LIMIT_IP_PER_MIN=0
+
+    # 1. development server (what `python app_flask.py` runs)
+    python app_flask.py
+    python loadtest.py --json dev.json
+
+    # 2. production profile
+    gunicorn -c gunicorn.conf.py
+    python loadtest.py --compare dev.json
+"""
+import argparse
+import base64
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+DOCUMENT = (
+    "Cats are small carnivorous mammals. The domestic cat sleeps up to sixteen hours a day. "
+    "Cats communicate by meowing, purring, hissing and body language.\n"
+) * 50
+
+
+class Client:
+    """One keep-alive HTTP connection"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host, self.port, self.timeout = parts.hostname, parts.port or 80, timeout
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            self.conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except Exception:
+            self.conn.close()
+            self.conn = None
+            raise
+        return response.status, data
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def setup(url, timeout, count=1):
+    """Create `count` sessions with one document each; returns their ids"""
+    client = Client(url, timeout)
+    session_ids = []
+    for _ in range(count):
+        status, data = client.request("POST", "/session/create", {"description": "loadtest"})
+        session_id = json.loads(data)["session_id"]
+        client.request("POST", "/document/upload", {
+            "session_id": session_id,
+            "filename": "loadtest.txt",
+            "file_content": base64.b64encode(DOCUMENT.encode("utf-8")).decode("ascii"),
+        })
+        session_ids.append(session_id)
+    return session_ids
+
+
+def scenarios(session_ids):
+    """name -> (method, path, bodies); client i sends bodies[i % len(bodies)]"""
+    return {
+        "session_list": ("GET", "/session/list?limit=50", [None]),
+        "search_documents": ("POST", "/search/documents",
+                             [{"session_id": sid, "q": "purring"} for sid in session_ids]),
+        # One session per client, so the per-session /ask limit doesn't serialize them
+        "ask": ("POST", "/ask", [{"session_id": sid, "question": "How long do cats sleep?", "mode": "global"}
+                                 for sid in session_ids]),
+    }
+
+
+def run(url, method, path, bodies, concurrency, duration, timeout):
+    latencies, errors, limited = [], [0], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(body):
+        client = Client(url, timeout)
+        mine, failed, refused = [], 0, 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status, _ = client.request(method, path, body)
+            except Exception:
+                status = None
+            if status is not None and status < 400:
+                mine.append((time.perf_counter() - start) * 1000)
+            elif status == 429:
+                refused += 1
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+            limited[0] += refused
+
+    threads = [threading.Thread(target=worker, args=(bodies[i % len(bodies)],)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "limited": limited[0],
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the chatbot API")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15, help="seconds per endpoint")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--endpoints", default="session_list,search_documents,ask")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    available = scenarios(setup(args.url, args.timeout, args.concurrency))
+    baseline = json.load(open(args.compare)) if args.compare else {}
+
+    results = {}
+    print(f"{'endpoint':<18}{'requests':>10}{'errors':>8}{'limited':>9}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name in args.endpoints.split(","):
+        method, path, bodies = available[name]
+        results[name] = r = run(args.url, method, path, bodies, args.concurrency, args.duration, args.timeout)
+        line = (f"{name:<18}{r['requests']:>10}{r['errors']:>8}{r['limited']:>9}{r['rps']:>10}"
+                f"{r['p50_ms']:>10}{r['p99_ms']:>10}")
+        if name in baseline:
+            b = baseline[name]
+            line += f"   vs baseline: req/s x{r['rps'] / max(b['rps'], 0.1):.2f}, p99 {b['p99_ms']} -> {r['p99_ms']} ms"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
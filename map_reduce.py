@@ -0,0 +1,178 @@
+"""
+Map-reduce answering for sessions whose documents don't fit in one prompt.
+
+The corpus is split into chunks of MAP_REDUCE_CHUNK_CHARS, the chunks most
+related to the question are queried in parallel (map), and the partial
+answers are merged by one final call (reduce). Cost and latency are capped by:
+
+    MAP_REDUCE_CHUNK_CHARS   size of each chunk sent to the model
+    MAP_REDUCE_MAX_CHUNKS    most chunks queried per question (the rest are dropped by relevance)
+    MAP_REDUCE_CONCURRENCY   map calls in flight at once
+    MAP_REDUCE_DEADLINE_SEC  map stage wall-clock budget; late chunks are skipped, and each
+                             map call gets what is left of it as its timeout
+
+A map call refused by the LLM admission limit (rate_limit.RateLimited)
+aborts the whole answer, so the client gets a 429 rather than a partial
+answer or a 503.
+"""
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from dotenv import load_dotenv
+from llm_provider import ChatMessage
+
+from llm_client import LLMUnavailableError
+import llm_usage
+import tracing
+from rate_limit import RateLimited
+
+load_dotenv()
+
+MAP_REDUCE_CHUNK_CHARS = int(os.getenv("MAP_REDUCE_CHUNK_CHARS", "24000"))
+MAP_REDUCE_MAX_CHUNKS = int(os.getenv("MAP_REDUCE_MAX_CHUNKS", "16"))
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", "4"))
+MAP_REDUCE_DEADLINE_SEC = float(os.getenv("MAP_REDUCE_DEADLINE_SEC", "60"))
+
+NOT_AVAILABLE = "Not available in the document."
+
+_WORD = re.compile(r"\w+")
+
+
+# ------------------------------
+# Chunking
+# ------------------------------
+def split_into_chunks(doc_parts, chunk_chars=MAP_REDUCE_CHUNK_CHARS):
+    """Split document texts into chunks of at most `chunk_chars`, on paragraph boundaries where possible"""
+    chunks = []
+    for text in doc_parts:
+        current = ""
+        for paragraph in text.split("\n\n"):
+            while len(paragraph) > chunk_chars:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(paragraph[:chunk_chars])
+                paragraph = paragraph[chunk_chars:]
+            if len(current) + len(paragraph) + 2 > chunk_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+        if current.strip():
+            chunks.append(current)
+    return [c for c in chunks if c.strip()]
+
+
+def rank_chunks(chunks, question, limit):
+    """Keep the `limit` chunks sharing the most words with the question, in document order"""
+    if len(chunks) <= limit:
+        return list(range(len(chunks)))
+    terms = {w.lower() for w in _WORD.findall(question) if len(w) > 2}
+    scores = []
+    for i, chunk in enumerate(chunks):
+        words = _WORD.findall(chunk.lower())
+        scores.append((sum(1 for w in words if w in terms), -i))
+    best = sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True)[:limit]
+    return sorted(best)
+
+
+# ------------------------------
+# Map / reduce
+# ------------------------------
+def _map_chunk(client, question, chunk, model, deadline):
+    system = (
+        "You are an assistant that must only answer using the following excerpt of a larger document. "
+        "Do not use any external knowledge.\n\n"
+        f"{chunk}\n\n"
+        "Instructions:\n"
+        "- Answer with every fact from the excerpt that helps answer the question, concisely.\n"
+        f"- If the excerpt contains nothing relevant, respond with exactly: '{NOT_AVAILABLE}'"
+    )
+    completion = client.chat.completions.create(
+        messages=[ChatMessage(content=system, role="system"), ChatMessage(content=question, role="user")],
+        model=model,
+        timeout=max(0.001, deadline - time.perf_counter()),  # a call that can't finish in time isn't waited for
+    )
+    return completion.choices[0].message.content.strip()
+
+
+def _reduce(client, question, partials, model):
+    notes = "\n\n".join(f"Excerpt {i + 1}:\n{p}" for i, p in enumerate(partials))
+    system = (
+        "You are an assistant combining partial answers, each taken from a different part of the same document. "
+        "Do not use any external knowledge.\n\n"
+        f"{notes}\n\n"
+        "Instructions:\n"
+        "- Merge them into one consistent answer and respond with '(From local source)' followed by the answer.\n"
+        f"- If they don't answer the question, respond with exactly: '{NOT_AVAILABLE}'"
+    )
+    completion = client.chat.completions.create(
+        messages=[ChatMessage(content=system, role="system"), ChatMessage(content=question, role="user")],
+        model=model,
+    )
+    return completion.choices[0].message.content.strip()
+
+
+def map_reduce_answer(client, question, doc_parts, model="jamba-large",
+                      chunk_chars=MAP_REDUCE_CHUNK_CHARS, max_chunks=MAP_REDUCE_MAX_CHUNKS,
+                      concurrency=MAP_REDUCE_CONCURRENCY, deadline_sec=MAP_REDUCE_DEADLINE_SEC):
+    """
+    Answer `question` over `doc_parts` with bounded parallel map calls and one reduce call.
+    Returns (answer, stats) where stats holds chunk counts and per-stage timings in ms.
+    Raises LLMUnavailableError if every map call (or the reduce call) fails,
+    and RateLimited as soon as a map call is refused admission.
+    """
+    started = time.perf_counter()
+    chunks = split_into_chunks(doc_parts, chunk_chars)
+    selected = rank_chunks(chunks, question, max_chunks)
+    split_done = time.perf_counter()
+
+    partials = {}
+    failed = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="map")
+    map_chunk = llm_usage.bind(tracing.bind(_map_chunk, "map_chunk"))
+    deadline = split_done + deadline_sec
+    futures = {executor.submit(map_chunk, client, question, chunks[i], model, deadline): i for i in selected}
+    pending = set(futures)
+    try:
+        while pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if isinstance(future.exception(), RateLimited):
+                    raise future.exception()
+                if future.exception() is not None:
+                    failed += 1
+                elif NOT_AVAILABLE.lower() not in future.result().lower():
+                    partials[futures[future]] = future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    map_done = time.perf_counter()
+
+    if selected and failed == len(selected):
+        raise LLMUnavailableError("All map calls failed")
+
+    ordered = [partials[i] for i in sorted(partials)]
+    if not ordered:
+        answer = NOT_AVAILABLE
+    else:
+        answer = _reduce(client, question, ordered, model)
+    reduce_done = time.perf_counter()
+
+    stats = {
+        "chunks_total": len(chunks),
+        "chunks_queried": len(selected),
+        "chunks_answered": len(ordered),
+        "chunks_failed": failed,
+        "chunks_timed_out": len(pending),
+        "timings_ms": {
+            "split": round((split_done - started) * 1000, 1),
+            "map": round((map_done - split_done) * 1000, 1),
+            "reduce": round((reduce_done - map_done) * 1000, 1),
+            "total": round((reduce_done - started) * 1000, 1),
+        },
+    }
+    return answer, stats
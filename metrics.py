@@ -0,0 +1,375 @@
+"""
+Request and stage latency metrics, served at /metrics in the Prometheus
+text format.
+
+    chatbot_requests_total{route, method, status}         counter
+    chatbot_request_duration_seconds{route, method}       histogram
+    chatbot_stage_duration_seconds{route, stage}          histogram, per request
+    chatbot_llm_tokens_total{model, kind}                 counter (prompt / completion)
+    chatbot_cache_requests_total{cache, result}           counter (hit / miss)
+    chatbot_cache_hit_ratio{cache}                        gauge
+
+Stages are mongo and gridfs (timed by a pymongo command listener, so every
+query counts without wrapping call sites), extraction, retrieval,
+prompt_build, llm and persistence (timed with `stage()`). Stage times are
+exclusive: MongoDB time inside a `stage("persistence")` block counts as
+mongo, not twice. Work done outside a request (the write-behind flusher,
+summary updates, map-reduce worker threads) is recorded under
+route="background".
+
+Each process keeps its own numbers. With several gunicorn workers set
+METRICS_DIR to a directory shared by them: every worker writes a snapshot
+there each METRICS_FLUSH_SEC, and /metrics serves the sum of all of them.
+A worker's snapshot is removed when it exits (gunicorn's child_exit hook,
+see gunicorn.conf.py); snapshots of processes that are gone or that haven't
+been refreshed for METRICS_SNAPSHOT_TTL_SEC are pruned on every scrape, so
+recycled workers and earlier deployments don't pile up or count forever.
+
+    METRICS_ENABLED          0 = no instrumentation and no /metrics (default 1)
+    METRICS_DIR              snapshot directory for multi-process mode (default unset)
+    METRICS_FLUSH_SEC        snapshot interval (default 5)
+    METRICS_SNAPSHOT_TTL_SEC age after which a snapshot is stale (default 12 x METRICS_FLUSH_SEC)
+"""
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+import tracing
+
+load_dotenv()
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DIR = os.getenv("METRICS_DIR") or None
+METRICS_FLUSH_SEC = float(os.getenv("METRICS_FLUSH_SEC", "5"))
+METRICS_SNAPSHOT_TTL_SEC = float(os.getenv("METRICS_SNAPSHOT_TTL_SEC", str(12 * METRICS_FLUSH_SEC)))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BACKGROUND = "background"
+GRIDFS_COLLECTIONS = ("fs.files", "fs.chunks")
+
+HELP = {
+    "chatbot_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "chatbot_request_duration_seconds": ("histogram", "HTTP request latency"),
+    "chatbot_stage_duration_seconds": ("histogram", "Time spent per stage of a request (exclusive)"),
+    "chatbot_llm_tokens_total": ("counter", "LLM tokens used"),
+    "chatbot_cache_requests_total": ("counter", "Cache lookups by result"),
+    "chatbot_cache_hit_ratio": ("gauge", "Cache hits / lookups since start"),
+}
+
+
+# ------------------------------
+# Storage
+# ------------------------------
+class Registry:
+    """Counters and fixed-bucket histograms keyed by (name, label pairs)"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}  # key -> [per-bucket counts..., +Inf count, sum]
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, name, labels, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        key = (name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[n, list(map(list, l)), v] for (n, l), v in self.counters.items()],
+                "histograms": [[n, list(map(list, l)), list(h)] for (n, l), h in self.histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        for name, labels, value in snapshot["counters"]:
+            self.counters[(name, tuple(map(tuple, labels)))] += value
+        for name, labels, h in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            current = self.histograms.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, v in enumerate(h):
+                current[i] += v
+
+
+registry = Registry()
+
+# Stage times of the request being handled in this thread
+_request = contextvars.ContextVar("metrics_request", default=None)
+
+
+# ------------------------------
+# Recording
+# ------------------------------
+def _add_stage(stage, seconds):
+    ctx = _request.get()
+    if ctx is None:
+        registry.observe("chatbot_stage_duration_seconds", (("route", BACKGROUND), ("stage", stage)), seconds)
+        return
+    ctx["stages"][stage] += seconds
+    if ctx["children"]:
+        ctx["children"][-1] += seconds  # the enclosing stage doesn't count this time
+
+
+@contextmanager
+def stage(name):
+    """Time a block of the current request as stage `name` (and trace it as a span)"""
+    if not METRICS_ENABLED:
+        with tracing.span(name):
+            yield
+        return
+    ctx = _request.get()
+    if ctx is not None:
+        ctx["children"].append(0.0)
+    started = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if ctx is None:
+            _add_stage(name, elapsed)
+        else:
+            own = elapsed - ctx["children"].pop()
+            ctx["stages"][name] += own
+            if ctx["children"]:
+                ctx["children"][-1] += elapsed
+
+
+def record_tokens(model, usage):
+    """Count the tokens of one completion (`usage` as returned by the provider, may be None)"""
+    if not METRICS_ENABLED or usage is None:
+        return
+    for kind in ("prompt", "completion"):
+        tokens = getattr(usage, f"{kind}_tokens", None)
+        if tokens:
+            registry.inc("chatbot_llm_tokens_total", (("model", model), ("kind", kind)), tokens)
+
+
+def record_cache(cache, hit):
+    if METRICS_ENABLED:
+        registry.inc("chatbot_cache_requests_total", (("cache", cache), ("result", "hit" if hit else "miss")))
+
+
+def command_listener():
+    """
+    A pymongo CommandListener that times every command as the mongo or gridfs
+    stage and records it as a span of the current trace.
+    """
+    from pymongo import monitoring
+
+    class _Listener(monitoring.CommandListener):
+        def __init__(self):
+            self._targets = {}  # request_id -> collection of commands started in a traced / timed context
+
+        def started(self, event):
+            target = event.command.get(event.command_name)
+            self._targets[event.request_id] = target if isinstance(target, str) else None
+
+        def _finished(self, event, error=None):
+            collection = self._targets.pop(event.request_id, None)
+            stage_name = "gridfs" if collection in GRIDFS_COLLECTIONS else "mongo"
+            if METRICS_ENABLED:
+                _add_stage(stage_name, event.duration_micros / 1e6)
+            tracing.record_span(f"{stage_name}.{event.command_name}", event.duration_micros * 1000, error,
+                                **{"db.collection": collection or ""})
+
+        def succeeded(self, event):
+            self._finished(event)
+
+        def failed(self, event):
+            self._finished(event, str(event.failure))
+
+    return _Listener()
+
+
+# ------------------------------
+# Multi-process snapshots
+# ------------------------------
+_flusher = {"pid": None}
+
+
+def _snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, f"metrics-{pid or os.getpid()}.json")
+
+
+def write_snapshot():
+    tmp = _snapshot_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp, _snapshot_path())
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SEC)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print("Metrics snapshot error:", e)
+
+
+def _ensure_flusher():
+    pid = os.getpid()
+    if METRICS_DIR and _flusher["pid"] != pid:
+        _flusher["pid"] = pid
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+def remove_snapshot(pid):
+    """Forget an exited worker (called from gunicorn's child_exit hook)"""
+    if METRICS_DIR:
+        try:
+            os.remove(_snapshot_path(pid))
+        except OSError:
+            pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True  # exists, just not ours to signal
+    return True
+
+
+def _stale(path, pid, now):
+    """A snapshot left by a process that is gone, or not refreshed within the TTL"""
+    try:
+        age = now - os.path.getmtime(path)
+    except OSError:
+        return False
+    return age > METRICS_SNAPSHOT_TTL_SEC or (pid != os.getpid() and not _pid_alive(pid))
+
+
+def collect():
+    """This process's registry, or the sum over every live process's snapshot in METRICS_DIR"""
+    if not METRICS_DIR:
+        return registry
+    write_snapshot()
+    total = Registry(registry.buckets)
+    now = time.time()
+    for name in os.listdir(METRICS_DIR):
+        if not (name.startswith("metrics-") and name.endswith(".json")):
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            pid = int(name[len("metrics-"):-len(".json")])
+        except ValueError:
+            continue
+        if _stale(path, pid, now):
+            remove_snapshot(pid)
+            continue
+        try:
+            with open(path, encoding="utf-8") as f:
+                total.merge(json.load(f))
+        except (OSError, ValueError):
+            continue  # being replaced right now
+    return total
+
+
+# ------------------------------
+# Exposition
+# ------------------------------
+def _labels(pairs, extra=()):
+    parts = [f'{k}="{_escape(v)}"' for k, v in (*pairs, *extra)]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(reg=None):
+    """Prometheus text exposition format (0.0.4)"""
+    reg = reg or collect()
+    families = defaultdict(list)
+
+    hits = defaultdict(lambda: [0, 0])
+    for (name, labels), value in sorted(reg.counters.items()):
+        families[name].append(f"{name}{_labels(labels)} {value:g}")
+        if name == "chatbot_cache_requests_total":
+            label = dict(labels)
+            hits[label["cache"]][0 if label["result"] == "hit" else 1] += value
+    for cache, (hit, miss) in sorted(hits.items()):
+        families["chatbot_cache_hit_ratio"].append(
+            f"chatbot_cache_hit_ratio{_labels((('cache', cache),))} {hit / (hit + miss):.4f}"
+        )
+
+    for (name, labels), h in sorted(reg.histograms.items()):
+        lines, cumulative = families[name], 0
+        for bound, count in zip((*reg.buckets, "+Inf"), h[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, (('le', bound),))} {cumulative:g}")
+        lines.append(f"{name}_sum{_labels(labels)} {h[-1]:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {cumulative:g}")
+
+    out = []
+    for name in sorted(families):
+        kind, text = HELP.get(name, ("untyped", name))
+        out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}", *families[name]]
+    return "\n".join(out) + "\n"
+
+
+# ------------------------------
+# Flask integration
+# ------------------------------
+def _before_request():
+    from flask import g
+    g.metrics_token = _request.set({"started": time.perf_counter(), "stages": defaultdict(float), "children": []})
+
+
+def _after_request(response):
+    from flask import request
+    ctx = _request.get()
+    if ctx is None or request.endpoint == "metrics":
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    elapsed = time.perf_counter() - ctx["started"]
+    registry.inc("chatbot_requests_total",
+                 (("route", route), ("method", request.method), ("status", str(response.status_code))))
+    registry.observe("chatbot_request_duration_seconds", (("route", route), ("method", request.method)), elapsed)
+    for name, seconds in ctx["stages"].items():
+        registry.observe("chatbot_stage_duration_seconds", (("route", route), ("stage", name)), seconds)
+    _ensure_flusher()
+    return response
+
+
+def _teardown_request(error=None):
+    from flask import g
+    token = g.pop("metrics_token", None)
+    if token is not None:
+        _request.reset(token)
+
+
+def metrics_endpoint():
+    from flask import current_app
+    return current_app.response_class(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def init_app(app):
+    """Time every request of `app` and serve /metrics (no-op when METRICS_ENABLED=0)"""
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint, methods=["GET"])
@@ -0,0 +1,288 @@
+"""
+Microbenchmarks for the request hot paths, with stored baselines.
+
+Fixtures are generated on first use and cached in --fixtures: a PDF of
+--pdf-pages pages, a DOCX of --docx-paragraphs paragraphs, a plain-text
+file and a chat history of --chat-turns turns. Cases:
+
+    extract.{txt,pdf,docx}     extract_text_from_file
+    document.{txt,pdf,docx}    extract_document, the branch read_documents runs per stored file
+    highlight                  highlight over every line of the PDF text
+    search.lines               search_lines, the scan behind /search/documents
+    prompt.local / .global     system_prompt + build_chat_messages, as /ask assembles them
+    route.search_documents     POST /search/documents end to end (GridFS + extraction + scan)
+    route.search_chat          POST /search/chat on the big history
+
+The route.* cases need MongoDB (datastore settings; MONGO_DB defaults to
+chatbot_microbench here) and are skipped when it can't be reached.
+
+    python microbench.py --save-baseline        # record bench_baseline.json
+    python microbench.py                        # compare; exit 1 on a regression
+    python microbench.py -k extract --threshold 0.1
+
+The committed bench_baseline.json is a reference run of the local cases with
+the default parameters (its "machine" and "python" fields say where); it has
+no route.* entries, which are only compared once a baseline with MongoDB
+reachable is saved. Timings only compare on like hardware, so record your
+own with --save-baseline before judging a change on another machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Keep benchmark data away from the real database, and fail fast without a server
+os.environ.setdefault("MONGO_DB", "chatbot_microbench")
+os.environ.setdefault("MONGO_SERVER_SELECTION_TIMEOUT_MS", "1500")
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("WRITE_BEHIND", "0")
+
+import app_flask  # noqa: E402
+import datastore  # noqa: E402
+from conversation_memory import build_chat_messages  # noqa: E402
+
+WORDS = (
+    "agreement renewal term payment invoice party notice clause liability warranty delivery "
+    "schedule termination confidential obligation service level credit dispute jurisdiction"
+).split()
+QUERY = "renewal"
+
+
+# ------------------------------
+# Fixtures
+# ------------------------------
+def _sentence(i):
+    words = [WORDS[(i * 7 + k * 3) % len(WORDS)] for k in range(12 + i % 9)]
+    return " ".join(words).capitalize() + "."
+
+
+def _lines(count):
+    return [f"{i}. {_sentence(i)} {_sentence(i + 1)}" for i in range(count)]
+
+
+def make_pdf(path, pages):
+    import fitz
+    doc = fitz.open()
+    lines = _lines(50)
+    for page_no in range(pages):
+        page = doc.new_page()
+        for i, line in enumerate(lines):
+            page.insert_text((36, 40 + i * 15), f"p{page_no} {line}", fontsize=7)
+    doc.save(path)
+    doc.close()
+
+
+def make_docx(path, paragraphs):
+    import docx
+    document = docx.Document()
+    for line in _lines(paragraphs):
+        document.add_paragraph(line)
+    document.save(path)
+
+
+def make_txt(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(_lines(lines)))
+
+
+def fixtures(directory, pdf_pages, docx_paragraphs, txt_lines):
+    """Paths of the generated files, building any that are missing"""
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    paths = {
+        "pdf": os.path.join(directory, f"bench-{pdf_pages}p.pdf"),
+        "docx": os.path.join(directory, f"bench-{docx_paragraphs}para.docx"),
+        "txt": os.path.join(directory, f"bench-{txt_lines}lines.txt"),
+    }
+    for kind, make, size in (("pdf", make_pdf, pdf_pages), ("docx", make_docx, docx_paragraphs),
+                             ("txt", make_txt, txt_lines)):
+        if not os.path.exists(paths[kind]):
+            started = time.perf_counter()
+            make(paths[kind], size)
+            print(f"generated {paths[kind]} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return paths
+
+
+def chat_turns(count):
+    return [{"question": f"What does clause {i} say? {_sentence(i)}",
+             "answer": f"(From local source) {_sentence(i + 3)} {_sentence(i + 5)}"} for i in range(count)]
+
+
+# ------------------------------
+# Cases
+# ------------------------------
+def local_cases(paths):
+    """name -> zero-argument callable; no database needed"""
+    data = {kind: open(path, "rb").read() for kind, path in paths.items()}
+    pdf_text = app_flask.extract_text_from_file(paths["pdf"], "pdf")
+    parts = [pdf_text, data["txt"].decode("utf-8")]
+    lines = pdf_text.split("\n")
+    turns = chat_turns(10)
+    memory = {"summary": " ".join(_sentence(i) for i in range(40))}
+
+    cases = {}
+    for kind in ("txt", "pdf", "docx"):
+        cases[f"extract.{kind}"] = lambda kind=kind: app_flask.extract_text_from_file(paths[kind], kind)
+        cases[f"document.{kind}"] = lambda kind=kind: app_flask.extract_document(data[kind], kind)
+    cases["highlight"] = lambda: [app_flask.highlight(line, QUERY) for line in lines]
+    cases["search.lines"] = lambda: app_flask.search_lines(parts, QUERY)
+    for mode in ("local", "global"):
+        cases[f"prompt.{mode}"] = lambda mode=mode: build_chat_messages(
+            app_flask.system_prompt(mode, parts), memory, turns, "When does the agreement renew?"
+        )
+    return cases
+
+
+def mongo_available():
+    try:
+        datastore.get_client().admin.command("ping")
+        return True
+    except Exception as e:
+        print(f"MongoDB unavailable, skipping route.* cases: {e.__class__.__name__}", file=sys.stderr)
+        return False
+
+
+def route_cases(paths, turns):
+    """End-to-end cases through the Flask test client; returns (cases, cleanup)"""
+    from llm_client import get_llm_client
+    from llm_provider import get_provider
+
+    app = app_flask.create_app({"LLM_CLIENT": get_llm_client(provider=get_provider("fake")),
+                                "RATE_LIMIT_BACKEND": "memory"})
+    client = app.test_client()
+    session_id = datastore.create_session("microbench")
+    refs = []
+    for kind, path in paths.items():
+        with open(path, "rb") as f:
+            refs.append(datastore.document_ref(os.path.basename(path), datastore.store_file(f, os.path.basename(path))))
+    datastore.add_documents(session_id, refs)
+    for start in range(0, len(turns), 1000):
+        records = [app_flask.new_message(session_id, t["question"], t["answer"], "local")
+                   for t in turns[start:start + 1000]]
+        datastore.messages.insert_many(records)
+
+    def post(path, body):
+        response = client.post(path, json=body)
+        assert response.status_code == 200, (path, response.status_code)
+        return response
+
+    cases = {
+        "route.search_documents": lambda: post("/search/documents", {"session_id": session_id, "q": QUERY}),
+        "route.search_chat": lambda: post("/search/chat", {"session_id": session_id, "q": QUERY}),
+    }
+
+    def cleanup():
+        for ref in refs:
+            datastore.delete_file(ref["gridfs_id"])
+        datastore.delete_session(session_id)
+    return cases, cleanup
+
+
+# ------------------------------
+# Timing and baselines
+# ------------------------------
+def measure(fn, repeat, min_time):
+    """(best, median) seconds per call over `repeat` rounds of at least `min_time` each"""
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number + 1, int(number * min_time / max(elapsed, 1e-9) * 1.1))
+    runs = [elapsed / number] + [t / number for t in timer.repeat(repeat - 1, number)]
+    return min(runs), statistics.median(runs)
+
+
+def _fmt(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds * 1e6:.1f} us"
+
+
+def compare(results, baseline, threshold):
+    """Print the report; returns the names of regressed cases"""
+    base = (baseline or {}).get("results", {})
+    regressed = []
+    print(f"{'case':<26}{'best':>12}{'median':>12}{'baseline':>12}{'change':>10}")
+    for name, (best, median) in results.items():
+        line = f"{name:<26}{_fmt(best):>12}{_fmt(median):>12}"
+        if name in base:
+            change = best / base[name]["best_s"] - 1
+            flag = "  REGRESSION" if change > threshold else ""
+            line += f"{_fmt(base[name]['best_s']):>12}{change:>+9.0%}{flag}"
+            if flag:
+                regressed.append(name)
+        print(line)
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks with baseline comparison")
+    parser.add_argument("-k", "--filter", default="", help="only cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing round")
+    parser.add_argument("--pdf-pages", type=int, default=300)
+    parser.add_argument("--docx-paragraphs", type=int, default=5000)
+    parser.add_argument("--txt-lines", type=int, default=50000)
+    parser.add_argument("--chat-turns", type=int, default=10000)
+    parser.add_argument("--fixtures", default=os.path.join(HERE, ".bench_fixtures"))
+    parser.add_argument("--baseline", default=os.path.join(HERE, "bench_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown vs baseline (0.2 = 20%%)")
+    parser.add_argument("--no-routes", action="store_true", help="skip the MongoDB-backed route.* cases")
+    args = parser.parse_args()
+
+    params = {"pdf_pages": args.pdf_pages, "docx_paragraphs": args.docx_paragraphs,
+              "txt_lines": args.txt_lines, "chat_turns": args.chat_turns}
+    paths = fixtures(args.fixtures, args.pdf_pages, args.docx_paragraphs, args.txt_lines)
+
+    cases, cleanup = local_cases(paths), None
+    if not args.no_routes and any(args.filter in name for name in ("route.search_documents", "route.search_chat")):
+        if mongo_available():
+            extra, cleanup = route_cases(paths, chat_turns(args.chat_turns))
+            cases.update(extra)
+
+    results = {}
+    try:
+        for name, fn in cases.items():
+            if args.filter in name:
+                results[name] = measure(fn, args.repeat, args.min_time)
+    finally:
+        if cleanup:
+            cleanup()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != params:
+            print(f"baseline was recorded with {baseline.get('params')}, not comparing", file=sys.stderr)
+            baseline = None
+
+    regressed = compare(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        stored = baseline["results"] if baseline else {}
+        stored.update({name: {"best_s": best, "median_s": median} for name, (best, median) in results.items()})
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "saved_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "machine": f"{platform.system()} {platform.machine()} {platform.processor()}".strip(),
+                "params": params,
+                "results": stored,
+            }, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    elif regressed:
+        print(f"{len(regressed)} regression(s) over {args.threshold:.0%}: {', '.join(regressed)}")
+        sys.exit(1)
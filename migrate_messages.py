@@ -0,0 +1,167 @@
+"""
+One-off migration of chat history into the chat_messages collection.
+
+Moves:
+  - every session's embedded `chat_history` array (written by app_flask.py,
+    embedded.py, existing_session.py and search_index.py), then unsets it
+  - the legacy `cat_talk` and `"cat talk"` collections written by upload.py,
+    pdf.py, doctomongo.py and the task scripts
+
+and then backfills the session summary fields used by /session/list
+(doc_count, message_count, last_activity), and seeds the conversation
+memory of sessions with more history than a prompt carries verbatim (see
+conversation_memory.seed_summary) so /ask doesn't start with a backlog of
+turns that are neither in the prompt nor in the summary.
+
+Migrated messages get ObjectIds like every other message (the keyset
+cursors and the (timestamp, _id) order assume them) and keep a deterministic
+`legacy_id` under a unique index, so the script can be re-run safely after
+an interruption. Messages moved by earlier versions of this script, which
+used that key as a string _id, are re-keyed the same way. Usage:
+
+    python migrate_messages.py [--batch 1000] [--drop-legacy]
+"""
+import argparse
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import datastore
+from chat_messages import session_messages
+from conversation_memory import CONTEXT_TURNS, MAX_VERBATIM_TURNS, seed_summary
+
+LEGACY_COLLECTIONS = ["cat_talk", "cat talk"]
+DUPLICATE_KEY = 11000
+
+
+def flush(messages, ops):
+    """bulk_write that tolerates messages already migrated by an earlier run"""
+    if not ops:
+        return 0
+    try:
+        return messages.bulk_write(ops, ordered=False).inserted_count
+    except BulkWriteError as e:
+        if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]):
+            raise
+        return e.details["nInserted"]
+    finally:
+        ops.clear()
+
+
+def migrate_embedded(sessions, messages, batch):
+    """Copy each session's chat_history into messages, then drop the array"""
+    migrated = 0
+    cursor = sessions.find({"chat_history.0": {"$exists": True}}, {"chat_history": 1}, batch_size=50)
+    for session in cursor:
+        ops = []
+        for i, turn in enumerate(session["chat_history"]):
+            ops.append(InsertOne({
+                "_id": ObjectId(), "legacy_id": f"{session['_id']}:{i}", "session_id": session["_id"], **turn
+            }))
+            if len(ops) >= batch:
+                migrated += flush(messages, ops)
+        migrated += flush(messages, ops)
+        sessions.update_one({"_id": session["_id"]}, {"$unset": {"chat_history": ""}})
+    # Sessions created with an empty array
+    sessions.update_many({"chat_history": {"$size": 0}}, {"$unset": {"chat_history": ""}})
+    return migrated
+
+
+def migrate_legacy(db, messages, batch, drop):
+    """Copy the flat cat_talk / "cat talk" records into messages"""
+    migrated = 0
+    existing = db.list_collection_names()
+    for name in LEGACY_COLLECTIONS:
+        if name not in existing:
+            continue
+        ops = []
+        for record in db[name].find({}, batch_size=batch):
+            legacy_id = record.pop("_id")
+            record.setdefault("session_id", None)  # task3.py never recorded a session
+            ops.append(InsertOne({"_id": ObjectId(), "legacy_id": f"{name}:{legacy_id}", **record}))
+            if len(ops) >= batch:
+                migrated += flush(messages, ops)
+        migrated += flush(messages, ops)
+        if drop:
+            db.drop_collection(name)
+    return migrated
+
+
+def rekey_string_ids(messages):
+    """Give messages migrated with a string _id an ObjectId, keeping the old key as legacy_id"""
+    rekeyed = 0
+    for message in messages.find({"_id": {"$type": "string"}}).sort([("session_id", 1), ("timestamp", 1), ("_id", 1)]):
+        legacy_id = message["_id"]
+        try:
+            messages.insert_one({**message, "_id": ObjectId(), "legacy_id": legacy_id})
+            rekeyed += 1
+        except DuplicateKeyError:
+            pass  # copied by an interrupted earlier run
+        messages.delete_one({"_id": legacy_id})
+    return rekeyed
+
+
+def backfill_session_summaries(sessions, messages, batch):
+    """Recompute doc_count / message_count / last_activity for every session"""
+    stats = {
+        row["_id"]: row for row in messages.aggregate([
+            {"$group": {"_id": "$session_id", "n": {"$sum": 1}, "last": {"$max": "$timestamp"}}}
+        ])
+    }
+    updated = 0
+    ops = []
+    for session in sessions.find({}, {"_id": 1}, batch_size=batch):
+        row = stats.get(session["_id"], {})
+        ops.append(UpdateOne({"_id": session["_id"]}, [{"$set": {
+            "doc_count": {"$size": {"$ifNull": ["$documents", []]}},
+            "message_count": row.get("n", 0),
+            "last_activity": {"$max": [
+                "$created_at", {"$max": "$documents.uploaded_at"}, {"$literal": row.get("last")}
+            ]},
+        }}]))
+        if len(ops) >= batch:
+            updated += sessions.bulk_write(ops, ordered=False).modified_count
+            ops.clear()
+    if ops:
+        updated += sessions.bulk_write(ops, ordered=False).modified_count
+    return updated
+
+
+def seed_memories(sessions, messages):
+    """Give sessions that have no memory yet but a long history a seeded summary of their older turns"""
+    seeded = 0
+    query = {"memory": {"$exists": False}, "message_count": {"$gt": MAX_VERBATIM_TURNS}}
+    for session in sessions.find(query, {"message_count": 1}, batch_size=50):
+        older = session_messages(messages, session["_id"], limit=session["message_count"] - CONTEXT_TURNS)
+        result = sessions.update_one(
+            {"_id": session["_id"], "memory": {"$exists": False}},
+            {"$set": {"memory": seed_summary(older)}}
+        )
+        seeded += result.modified_count
+    return seeded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move chat history into the chat_messages collection")
+    parser.add_argument("--uri", help="MongoDB connection string (default: MONGO_URI)")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--drop-legacy", action="store_true", help="drop cat_talk / 'cat talk' afterwards")
+    args = parser.parse_args()
+
+    if args.uri:
+        datastore.MONGO_URI = args.uri
+    db, messages = datastore.get_db(), datastore.messages
+    datastore.ensure_indexes()
+    messages.create_index("legacy_id", unique=True, sparse=True)
+
+    rekeyed = rekey_string_ids(messages)
+    print(f"✅ Re-keyed {rekeyed} messages migrated with string ids")
+    embedded = migrate_embedded(datastore.sessions, messages, args.batch)
+    print(f"✅ Migrated {embedded} embedded chat_history messages")
+    legacy = migrate_legacy(db, messages, args.batch, args.drop_legacy)
+    print(f"✅ Migrated {legacy} legacy cat_talk messages")
+    summaries = backfill_session_summaries(datastore.sessions, messages, args.batch)
+    print(f"✅ Backfilled summary fields on {summaries} sessions")
+    seeded = seed_memories(datastore.sessions, messages)
+    print(f"✅ Seeded conversation memory on {seeded} sessions")
@@ -1,36 +1,30 @@
-import fitz
 import os
 import uuid
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import datastore
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
+from llm_client import get_llm_client
+from llm_provider import ChatMessage
+from lazy_imports import lazy_import
+
+# Heavy parsers, loaded on first use
+fitz = lazy_import("fitz")
 
 # Load environment variables
 load_dotenv()
 
-# Get API key and MongoDB URI from environment
+# Get API key from environment
 api_key = os.getenv('AI21_API_KEY')
-mongo_client = MongoClient("mongodb://localhost:27017")  # Update if using Atlas
-db = mongo_client["chat_history_db"]
-chat_collection = db["cat_talk"]
-session_collection = db["chat_sessions"]
 
 # Create or continue a session
 session_choice = input("Start a new session? (yes/no): ").strip().lower()
 if session_choice == "yes":
     session_id = str(uuid.uuid4())
     session_description = input("Enter a short description for this session: ").strip()
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(timezone.utc)
-    })
+    datastore.create_session(session_description, session_id)
     print(f"✅ New session created with ID: {session_id}")
 else:
     session_id = input("Enter existing session ID: ").strip()
-    existing = session_collection.find_one({"_id": session_id})
+    existing = datastore.get_session(session_id, ["_id"])
     if not existing:
         print("❌ Session ID not found. Exiting.")
         exit()
@@ -58,7 +52,7 @@ else:
 doc_content = txt_content + "\n\n" + pdf_content    
 
 # Initialize AI21 client
-client = AI21Client(api_key=api_key)
+client = get_llm_client(api_key)
 
 # Ask mode for every question
 mode = input("Choose mode: (1) Local documents or (2) Global knowledge: ").strip()
@@ -105,10 +99,4 @@ while True:
     print("\n🧠 AI Response:", response)
 
     # Save to MongoDB
-    chat_record = {
-        "session_id": session_id,
-        "question": user_input,
-        "answer": response,
-        "timestamp": datetime.now(timezone.utc)
-    }
-    chat_collection.insert_one(chat_record)
\ No newline at end of file
+    datastore.save_message(session_id, user_input, response, "local" if mode == "1" else "global")
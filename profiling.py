@@ -0,0 +1,205 @@
+"""
+On-demand profiling of a single request.
+
+A request carrying the profiling token, either as a header
+
+    X-Profile: <PROFILE_TOKEN>
+
+or as the query parameter `?profile=<PROFILE_TOKEN>`, is run under a
+profiler. The result is saved in PROFILE_DIR, keyed by the request id (the
+X-Request-ID header, else the trace id, else a fresh id), and the response
+names it in `X-Profile-File`. Every other request is untouched. With
+PROFILE_TOKEN unset nothing is registered at all.
+
+Modes (PROFILE_MODE, or per request with the `X-Profile-Mode` header):
+
+    sample    a sampling profiler (every PROFILE_INTERVAL_MS) over the request's
+              thread; writes <id>.speedscope.json (open in https://www.speedscope.app)
+              and <id>.folded (flamegraph.pl / speedscope)
+    cprofile  deterministic cProfile; writes <id>.prof (python -m pstats, snakeviz)
+
+    PROFILE_TOKEN        shared secret that enables profiling (default unset = off)
+    PROFILE_DIR          output directory (default profiles)
+    PROFILE_MODE         sample (default) or cprofile
+    PROFILE_INTERVAL_MS  sampling interval (default 1)
+"""
+import cProfile
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN") or None
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+
+MAX_STACK_DEPTH = 256
+
+
+# ------------------------------
+# Sampling profiler
+# ------------------------------
+class StackSampler:
+    """Samples one thread's Python stack from a helper thread"""
+
+    def __init__(self, thread_id, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()  # root-first tuple of (function, file, line) -> samples
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self.started = self.elapsed = 0.0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def folded(self):
+        """Brendan Gregg's collapsed-stack format"""
+        return "".join(
+            ";".join(f"{name} ({os.path.basename(file)}:{line})" for name, file, line in stack) + f" {count}\n"
+            for stack, count in self.stacks.most_common()
+        )
+
+    def speedscope(self, name):
+        """A speedscope 'sampled' profile, weights in milliseconds"""
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, count in self.stacks.items():
+            ids = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                ids.append(index[frame])
+            samples.append(ids)
+            weights.append(round(count * self.interval * 1000, 3))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled", "name": name, "unit": "milliseconds",
+                "startValue": 0, "endValue": round(sum(weights), 3),
+                "samples": samples, "weights": weights,
+            }],
+            "name": name,
+            "activeProfileIndex": 0,
+            "exporter": "ai-chatbot profiling.py",
+        }
+
+
+# ------------------------------
+# One profiled request
+# ------------------------------
+class RequestProfile:
+    def __init__(self, request_id, mode=PROFILE_MODE, label=""):
+        self.request_id = request_id
+        self.mode = mode if mode in ("sample", "cprofile") else PROFILE_MODE
+        self.label = label
+        self._profiler = None
+
+    def start(self):
+        if self.mode == "cprofile":
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+                return self
+            except ValueError:
+                # Python 3.12+ allows one active cProfile per process; sample instead
+                self.mode = "sample"
+        self._profiler = StackSampler(threading.get_ident()).start()
+        return self
+
+    @property
+    def path(self):
+        suffix = ".prof" if self.mode == "cprofile" else ".speedscope.json"
+        return os.path.join(PROFILE_DIR, f"{self.request_id}{suffix}")
+
+    def stop_and_save(self):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if self.mode == "cprofile":
+            self._profiler.disable()
+            self._profiler.dump_stats(self.path)
+            return self.path
+        self._profiler.stop()
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self._profiler.speedscope(f"{self.label} ({self.request_id})"), f)
+        with open(os.path.join(PROFILE_DIR, f"{self.request_id}.folded"), "w", encoding="utf-8") as f:
+            f.write(self._profiler.folded())
+        return self.path
+
+
+def authorized(supplied):
+    return bool(PROFILE_TOKEN and supplied) and hmac.compare_digest(supplied.encode(), PROFILE_TOKEN.encode())
+
+
+# ------------------------------
+# Flask integration
+# ------------------------------
+def _request_id():
+    from flask import g, request
+    return g.get("request_id") or request.headers.get("X-Request-ID") or uuid.uuid4().hex
+
+
+def _before_request():
+    from flask import g, request
+    if not authorized(request.headers.get("X-Profile") or request.args.get("profile")):
+        return
+    # Request ids end up in a file name
+    request_id = "".join(c for c in _request_id() if c.isalnum() or c in "-_")[:64] or uuid.uuid4().hex
+    label = f"{request.method} {request.path}"
+    g.profile = RequestProfile(request_id, request.headers.get("X-Profile-Mode", PROFILE_MODE), label).start()
+
+
+def _after_request(response):
+    from flask import g
+    profile = g.get("profile")
+    if profile is not None:
+        response.headers["X-Profile-File"] = profile.path
+        response.headers["X-Request-ID"] = profile.request_id
+    return response
+
+
+def _teardown_request(error=None):
+    from flask import g
+    profile = g.pop("profile", None)
+    if profile is not None:
+        try:
+            profile.stop_and_save()
+        except OSError as e:
+            print("Profile save error:", e)
+
+
+def init_app(app):
+    """Register the profiling hook (only when PROFILE_TOKEN is set)"""
+    if not PROFILE_TOKEN:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
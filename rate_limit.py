@@ -0,0 +1,282 @@
+"""
+Admission control for the expensive endpoints.
+
+Two mechanisms, both answered with 429 + Retry-After when they say no:
+
+  - token buckets per session and per client IP, checked before /ask does
+    any work (RequestLimits)
+  - a global cap on in-flight LLM provider calls with a bounded wait
+    queue (ConcurrencyLimiter, used by llm_client.ResilientLLMClient)
+
+State lives in a backend shared by everything that should see the same
+limits: MemoryBackend for a single process, MongoBackend (the
+`rate_limits` / `llm_slots` collections) to share them across gunicorn
+workers and hosts.
+
+    RATE_LIMIT_BACKEND          memory (default) or mongo
+    RATE_LIMIT_SESSION_PER_MIN  sustained /ask rate per session, 0 = off (default 20)
+    RATE_LIMIT_SESSION_BURST    requests a session may make back to back (default 5)
+    RATE_LIMIT_IP_PER_MIN       sustained /ask rate per client IP, 0 = off (default 60)
+    RATE_LIMIT_IP_BURST         (default 20)
+    RATE_LIMIT_TRUST_PROXY      1 = take the client IP from X-Forwarded-For (default 0)
+    LLM_MAX_CONCURRENCY         in-flight provider calls, 0 = unlimited (default 16)
+    LLM_QUEUE_SIZE              calls allowed to wait for a slot, per process (default 32)
+    LLM_QUEUE_TIMEOUT_SEC       longest wait for a slot (default 10)
+    LLM_SLOT_LEASE_SEC          a slot held longer than this is presumed leaked (default 300)
+    LLM_BUSY_RETRY_AFTER_SEC    Retry-After sent when the queue is full (default 5)
+"""
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_SESSION_PER_MIN = float(os.getenv("RATE_LIMIT_SESSION_PER_MIN", "20"))
+RATE_LIMIT_SESSION_BURST = int(os.getenv("RATE_LIMIT_SESSION_BURST", "5"))
+RATE_LIMIT_IP_PER_MIN = float(os.getenv("RATE_LIMIT_IP_PER_MIN", "60"))
+RATE_LIMIT_IP_BURST = int(os.getenv("RATE_LIMIT_IP_BURST", "20"))
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "32"))
+LLM_QUEUE_TIMEOUT_SEC = float(os.getenv("LLM_QUEUE_TIMEOUT_SEC", "10"))
+LLM_SLOT_LEASE_SEC = float(os.getenv("LLM_SLOT_LEASE_SEC", "300"))
+LLM_BUSY_RETRY_AFTER_SEC = float(os.getenv("LLM_BUSY_RETRY_AFTER_SEC", "5"))
+
+
+class RateLimited(Exception):
+    """A request was refused; `retry_after` is a hint in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# ------------------------------
+# Backends
+# ------------------------------
+class MemoryBackend:
+    """Limits for this process only"""
+
+    max_buckets = 100_000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, time)
+        self._slots = {}    # name -> {token: lease expiry}
+
+    def take(self, key, rate, burst):
+        """Take one token from bucket `key`; returns (allowed, seconds until a token is available)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return False, (1 - tokens) / rate
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets.clear()  # idle buckets are full anyway
+            self._buckets[key] = (tokens - 1, now)
+            return True, 0.0
+
+    def try_acquire(self, name, limit, lease_sec):
+        now = time.monotonic()
+        with self._lock:
+            held = self._slots.setdefault(name, {})
+            for token, expires in list(held.items()):
+                if expires < now:
+                    del held[token]
+            if len(held) >= limit:
+                return None
+            token = uuid.uuid4().hex
+            held[token] = now + lease_sec
+            return token
+
+    def release(self, name, token):
+        with self._lock:
+            self._slots.get(name, {}).pop(token, None)
+
+
+class MongoBackend:
+    """
+    Limits shared by every process using the same database.
+    Buckets are updated with compare-and-set on their last refill time;
+    concurrency slots are `limit` lease documents per limiter name.
+    """
+
+    cas_attempts = 5
+
+    def __init__(self):
+        import datastore
+        self._buckets = datastore.rate_limits
+        self._slots = datastore.llm_slots
+        self._created = set()
+
+    def take(self, key, rate, burst):
+        from pymongo.errors import DuplicateKeyError
+
+        for _ in range(self.cas_attempts):
+            now = time.time()
+            doc = self._buckets.find_one({"_id": key})
+            tokens = burst if doc is None else min(burst, doc["tokens"] + (now - doc["ts"]) * rate)
+            if tokens < 1:
+                return False, (1 - tokens) / rate
+            update = {
+                "tokens": tokens - 1, "ts": now,
+                # TTL index: a bucket idle long enough to be full again is just deleted
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=burst / rate),
+            }
+            if doc is None:
+                try:
+                    self._buckets.insert_one({"_id": key, **update})
+                    return True, 0.0
+                except DuplicateKeyError:
+                    continue
+            if self._buckets.update_one({"_id": key, "ts": doc["ts"]}, {"$set": update}).matched_count:
+                return True, 0.0
+        # Heavy contention on one key: refusing is the safe answer
+        return False, 1 / rate
+
+    def _slot_ids(self, name, limit):
+        ids = [f"{name}:{i}" for i in range(limit)]
+        if (name, limit) not in self._created:
+            from pymongo.errors import BulkWriteError
+            try:
+                self._slots.insert_many([{"_id": i, "holder": None} for i in ids], ordered=False)
+            except BulkWriteError:
+                pass  # already created by another process
+            self._created.add((name, limit))
+        return ids
+
+    def try_acquire(self, name, limit, lease_sec):
+        token = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        slot = self._slots.find_one_and_update(
+            {"_id": {"$in": self._slot_ids(name, limit)},
+             "$or": [{"holder": None}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": token, "expires_at": now + timedelta(seconds=lease_sec)}},
+            projection={"_id": 1}
+        )
+        return None if slot is None else (slot["_id"], token)
+
+    def release(self, name, token):
+        slot_id, holder = token
+        self._slots.update_one({"_id": slot_id, "holder": holder}, {"$set": {"holder": None}})
+
+
+def get_backend(name=None):
+    name = (name or RATE_LIMIT_BACKEND).lower()
+    if name == "memory":
+        return MemoryBackend()
+    if name == "mongo":
+        return MongoBackend()
+    raise ValueError(f"Unknown rate limit backend: {name}")
+
+
+# ------------------------------
+# Token buckets
+# ------------------------------
+class RequestLimits:
+    """Per-session and per-IP token buckets"""
+
+    def __init__(self, backend, session_per_min=RATE_LIMIT_SESSION_PER_MIN, session_burst=RATE_LIMIT_SESSION_BURST,
+                 ip_per_min=RATE_LIMIT_IP_PER_MIN, ip_burst=RATE_LIMIT_IP_BURST):
+        self.backend = backend
+        self.rules = [
+            ("ip", ip_per_min / 60, max(1, ip_burst)),
+            ("session", session_per_min / 60, max(1, session_burst)),
+        ]
+
+    def check(self, route, session_id=None, ip=None):
+        """Take a token from each applicable bucket; raises RateLimited"""
+        subjects = {"ip": ip, "session": session_id}
+        for kind, rate, burst in self.rules:
+            subject = subjects[kind]
+            if not rate or not subject:
+                continue
+            allowed, wait = self.backend.take(f"{route}:{kind}:{subject}", rate, burst)
+            if not allowed:
+                raise RateLimited(f"Too many requests for this {kind}", wait)
+
+
+def client_ip(request):
+    """The caller's address (the first X-Forwarded-For hop when RATE_LIMIT_TRUST_PROXY is set)"""
+    if RATE_LIMIT_TRUST_PROXY and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr
+
+
+# ------------------------------
+# Concurrency cap
+# ------------------------------
+class ConcurrencyLimiter:
+    """
+    At most `limit` holders of a slot at a time, across everything sharing the
+    backend. Up to `queue_size` callers per process wait (at most
+    `wait_timeout` seconds) for a slot; anyone beyond that is refused at once.
+    """
+
+    poll_interval = 0.05  # another process's release is noticed within this (Mongo backend)
+
+    def __init__(self, backend, name="llm", limit=LLM_MAX_CONCURRENCY, queue_size=LLM_QUEUE_SIZE,
+                 wait_timeout=LLM_QUEUE_TIMEOUT_SEC, lease_sec=LLM_SLOT_LEASE_SEC,
+                 busy_retry_after=LLM_BUSY_RETRY_AFTER_SEC):
+        self.backend = backend
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait_timeout = wait_timeout
+        self.lease_sec = lease_sec
+        self.busy_retry_after = busy_retry_after
+        self._cond = threading.Condition()
+        self._waiting = 0
+
+    def acquire(self):
+        token = self.backend.try_acquire(self.name, self.limit, self.lease_sec)
+        if token is not None:
+            return token
+        with self._cond:
+            if self._waiting >= self.queue_size:
+                raise RateLimited("AI provider is at capacity, try again later", self.busy_retry_after)
+            self._waiting += 1
+        try:
+            deadline = time.monotonic() + self.wait_timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RateLimited("Timed out waiting for the AI provider", self.busy_retry_after)
+                with self._cond:
+                    self._cond.wait(min(self.poll_interval, remaining))
+                token = self.backend.try_acquire(self.name, self.limit, self.lease_sec)
+                if token is not None:
+                    return token
+        finally:
+            with self._cond:
+                self._waiting -= 1
+
+    def release(self, token):
+        self.backend.release(self.name, token)
+        with self._cond:
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        """Hold one slot for the duration of the block (no-op when limit is 0)"""
+        if self.limit <= 0:
+            yield
+            return
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
@@ -0,0 +1,319 @@
+"""
+Replay captured traffic (see capture.py) as a load test.
+
+Reads the NDJSON capture (default requests.jsonl; lines that are not
+captured requests are skipped), maps every pseudonymous session to a fresh
+session, replaces uploads with synthetic files of the recorded type and
+size, and sends the requests in their recorded order:
+
+    --speed 1      at the recorded pace (2 = twice as fast)
+    --rate 50      at a fixed 50 requests/sec
+    (neither)      as fast as --concurrency workers can go
+
+Each route is reported with throughput, p50/p95/p99 latency and error
+rates (5xx and transport failures as errors, 4xx counted separately).
+
+The replay sessions and synthetic uploads are all made before the clock
+starts, so only the replayed requests themselves are timed. With --speed
+or --rate, latency is measured from when each request was due, not when a
+worker got to send it, so a backed-up server isn't hidden by the replay
+slowing down with it (coordinated omission).
+
+By default the app runs in-process with the fake LLM provider
+(LLM_PROVIDER=fake, FAKE_LLM_LATENCY_MS sets its latency) and the /ask rate
+limits off, against the chatbot_replay database unless MONGO_DB says
+otherwise, so the numbers measure our server, not AI21 or the 429 path.
+The sessions a replay creates are deleted afterwards (--keep leaves them).
+--url targets a running server instead; start it with
+RATE_LIMIT_SESSION_PER_MIN=0 RATE_LIMIT_IP_PER_MIN=0 for the same reason.
+
+    python replay.py --concurrency 16
+    FAKE_LLM_LATENCY_MS=800 python replay.py --speed 4 --json replay.json
+    python replay.py --url http://127.0.0.1:5000 --rate 20 --duration 120
+"""
+import argparse
+import base64
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+os.environ.setdefault("LLM_PROVIDER", "fake")
+# Keep replayed sessions out of the real database (in-process mode)
+os.environ.setdefault("MONGO_DB", "chatbot_replay")
+
+from loadtest import Client, percentile  # noqa: E402
+
+SENTENCE = "The agreement renews for one year unless either party gives written notice. "
+
+
+# ------------------------------
+# Input
+# ------------------------------
+def load_capture(path, routes=None):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(entry, dict) or "method" not in entry or "path" not in entry:
+                continue  # not a captured request
+            if routes and not entry["path"].startswith(tuple(routes)):
+                continue
+            entries.append(entry)
+    entries.sort(key=lambda e: e.get("captured_at", ""))
+    return entries
+
+
+def _offsets(entries):
+    """Seconds since the first request, from captured_at"""
+    from datetime import datetime
+    stamps = [datetime.fromisoformat(e["captured_at"]).timestamp() if e.get("captured_at") else None
+              for e in entries]
+    first = next((s for s in stamps if s is not None), 0)
+    return [(s - first) if s is not None else 0 for s in stamps]
+
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def synthetic_upload(file_type, size):
+    """
+    Base64 of a parseable document of roughly `size` bytes, as /document/upload
+    takes it (cached per type and size bucket, so uploads share one string)
+    """
+    bucket = max(1024, 1 << max(0, int(size) - 1).bit_length())  # next power of two
+    key = (file_type, bucket)
+    with _documents_lock:  # held while generating: PyMuPDF is not thread-safe
+        if key not in _documents:
+            _documents[key] = base64.b64encode(_generate(file_type, bucket)).decode("ascii")
+        return _documents[key]
+
+
+def _generate(file_type, bucket):
+    text = (SENTENCE * (bucket // len(SENTENCE) + 1))[:bucket]
+    if file_type == "pdf":
+        import fitz
+        doc = fitz.open()
+        for start in range(0, len(text), 3000):  # ~3 kB of text per page
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), text[start:start + 3000], fontsize=8)
+        data = doc.tobytes()
+        doc.close()
+    elif file_type == "docx":
+        import io
+        import docx
+        document = docx.Document()
+        for start in range(0, len(text), 400):
+            document.add_paragraph(text[start:start + 400])
+        out = io.BytesIO()
+        document.save(out)
+        data = out.getvalue()
+    else:
+        data = text.encode("utf-8")
+    return data
+
+
+# ------------------------------
+# Transports
+# ------------------------------
+class InProcess:
+    """Requests through a Flask test client of an app built here"""
+
+    _app = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        with InProcess._lock:
+            if InProcess._app is None:
+                import app_flask
+                # Every request comes from the test client's one IP: no per-IP / per-session buckets
+                InProcess._app = app_flask.create_app({"RATE_LIMITS": False})
+        self.client = InProcess._app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+
+    def delete_sessions(self, session_ids):
+        """Remove replay sessions with their documents, messages and usage rollups"""
+        import datastore
+        InProcess._app.extensions["chatbot"]["writer"].flush()
+        for session_id in session_ids:
+            session = datastore.get_session(session_id, ["documents"]) or {}
+            for document in session.get("documents", []):
+                datastore.delete_document_files(document)
+            datastore.delete_session(session_id)
+        datastore.usage_rollups.delete_many({"session_id": {"$in": list(session_ids)}})
+
+
+def _delete_over_http(conn, session_ids):
+    for session_id in session_ids:
+        conn.request("POST", "/session/delete", {"session_id": session_id})
+
+
+def transport(url, timeout):
+    return Client(url, timeout) if url else InProcess()
+
+
+# ------------------------------
+# Replay
+# ------------------------------
+class Replayer:
+    def __init__(self, url=None, timeout=120):
+        self.url = url
+        self.timeout = timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, conn, pseudonym):
+        """The real session standing in for a captured one (created on first use)"""
+        with self._lock:
+            if pseudonym in self._sessions:
+                return self._sessions[pseudonym]
+            status, data = conn.request("POST", "/session/create", {"description": f"replay {pseudonym}"})
+            self._sessions[pseudonym] = json.loads(data)["session_id"]
+            return self._sessions[pseudonym]
+
+    def build(self, conn, entry):
+        body = dict(entry.get("json") or {})
+        if "session_id" in body and body["session_id"]:
+            body["session_id"] = self.session(conn, body["session_id"])
+        upload = entry.get("upload")
+        if upload:
+            body["file_content"] = synthetic_upload(upload.get("type", "txt"), upload.get("bytes", 1024))
+        if entry["method"] == "GET":
+            return None
+        return body
+
+    def run(self, entries, concurrency, rate=0.0, speed=0.0, duration=0.0):
+        """Send `entries` (repeated until `duration` seconds have passed, if set); returns per-route results"""
+        offsets = _offsets(entries) if speed else None
+        work = queue.Queue(maxsize=concurrency * 4)
+        results = defaultdict(lambda: {"latencies": [], "errors": 0, "client_errors": 0})
+        results_lock = threading.Lock()
+        # Sessions and uploads are made here, before the clock starts: only the requests are timed
+        conn = transport(self.url, self.timeout)
+        bodies = [self.build(conn, entry) for entry in entries]
+
+        def worker():
+            conn = transport(self.url, self.timeout)
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                due, entry, body = item
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                route = entry.get("route") or entry["path"]
+                start = time.perf_counter()
+                try:
+                    status, _ = conn.request(entry["method"], entry["path"], body)
+                except Exception:
+                    status = None
+                # Scheduled requests count from when they were due: queueing behind a slow server is latency
+                elapsed = (time.perf_counter() - (due or start)) * 1000
+                with results_lock:
+                    r = results[route]
+                    r["latencies"].append(elapsed)
+                    if status is None or status >= 500:
+                        r["errors"] += 1
+                    elif status >= 400:
+                        r["client_errors"] += 1
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        started = time.perf_counter()
+        passes, sent = 0, 0
+        while True:
+            pass_start = time.perf_counter()
+            for i, entry in enumerate(entries):
+                if speed:
+                    due = pass_start + offsets[i] / speed
+                elif rate:
+                    due = started + sent / rate
+                else:
+                    due = 0
+                work.put((due, entry, bodies[i]))
+                sent += 1
+            passes += 1
+            if not duration or time.perf_counter() - started >= duration:
+                break
+        for _ in threads:
+            work.put(None)
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        return summarize(results, elapsed), {"passes": passes, "requests": sent, "seconds": round(elapsed, 2)}
+
+    def cleanup(self):
+        """Delete the sessions this replay created"""
+        with self._lock:
+            session_ids, self._sessions = list(self._sessions.values()), {}
+        if not session_ids:
+            return
+        conn = transport(self.url, self.timeout)
+        if isinstance(conn, InProcess):
+            conn.delete_sessions(session_ids)
+        else:
+            _delete_over_http(conn, session_ids)
+
+
+def summarize(results, elapsed):
+    summary = {}
+    for route, r in sorted(results.items()):
+        latencies, count = r["latencies"], len(r["latencies"])
+        summary[route] = {
+            "requests": count,
+            "rps": round(count / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "error_rate": round(r["errors"] / count, 4) if count else 0.0,
+            "client_error_rate": round(r["client_errors"] / count, 4) if count else 0.0,
+        }
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured requests as a load test")
+    parser.add_argument("--file", default="requests.jsonl", help="capture file (CAPTURE_FILE)")
+    parser.add_argument("--url", help="target a running server instead of an in-process app")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="requests/sec (0 = as fast as possible)")
+    parser.add_argument("--speed", type=float, default=0, help="replay at the recorded pace times this")
+    parser.add_argument("--duration", type=float, default=0, help="repeat the capture for this many seconds")
+    parser.add_argument("--routes", help="comma-separated path prefixes to replay")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the sessions the replay created")
+    args = parser.parse_args()
+
+    entries = load_capture(args.file, args.routes.split(",") if args.routes else None)
+    if not entries:
+        raise SystemExit(f"No captured requests in {args.file} (record some with CAPTURE_ENABLED=1)")
+
+    replayer = Replayer(args.url, args.timeout)
+    try:
+        results, totals = replayer.run(
+            entries, args.concurrency, rate=args.rate, speed=args.speed, duration=args.duration
+        )
+    finally:
+        if not args.keep:
+            replayer.cleanup()
+    print(f"replayed {totals['requests']} requests ({totals['passes']} pass(es)) in {totals['seconds']} s")
+    print(f"{'route':<22}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'5xx':>8}{'4xx':>8}")
+    for route, r in results.items():
+        print(f"{route:<22}{r['requests']:>9}{r['rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+              f"{r['error_rate']:>8.1%}{r['client_error_rate']:>8.1%}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"totals": totals, "routes": results}, f, indent=2)
@@ -1,25 +1,21 @@
-import fitz
 import os
 import uuid
-import gridfs
 import re                 # <-- added for keyword search
-from bson import ObjectId
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import datastore
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
-from docx import Document   # for DOCX text extraction
+from llm_client import get_llm_client
+from llm_provider import ChatMessage
+from lazy_imports import lazy_import
+
+# Heavy parsers, loaded on first use
+fitz = lazy_import("fitz")
+docx = lazy_import("docx")   # for DOCX text extraction
 
 # Load environment variables
 load_dotenv()
 
-# Get API key and MongoDB URI
+# Get API key
 api_key = os.getenv('AI21_API_KEY')
-mongo_client = MongoClient("mongodb://localhost:27017")  # Update if using Atlas
-db = mongo_client["chat_history_db"]
-fs = gridfs.GridFS(db)
-session_collection = db["chat_sessions"]
 
 doc_content = ""   # will hold extracted text
 
@@ -52,20 +48,18 @@ def search_documents(query, doc_text):
 #Helper: Search inside chat history (MongoDB)
 def search_chat_history(query, session_id):
     print(f"\n💬 Search Results in Chat History for '{query}':")
-    results = session_collection.find(
-        {"_id": session_id, "chat_history": {"$exists": True}},
-        {"chat_history": 1}
-    )
+    pattern = {"$regex": re.escape(query), "$options": "i"}
+    results = datastore.messages.find(
+        {"session_id": session_id, "$or": [{"question": pattern}, {"answer": pattern}]}
+    ).sort("timestamp", 1)
 
     found = False
-    for r in results:
-        for chat in r.get("chat_history", []):
-            if query.lower() in chat["question"].lower() or query.lower() in chat["answer"].lower():
-                q = highlight(chat["question"], query)
-                a = highlight(chat["answer"], query)
-                print(f"Q: {q}")
-                print(f"A: {a}\n---")
-                found = True
+    for chat in results:
+        q = highlight(chat["question"], query)
+        a = highlight(chat["answer"], query)
+        print(f"Q: {q}")
+        print(f"A: {a}\n---")
+        found = True
     if not found:
         print("❌ No matches found in chat history.")
 
@@ -79,13 +73,7 @@ session_choice = input("Do you want to (1) Create a new session or (2) Use exist
 if session_choice == "1":   
     session_id = str(uuid.uuid4())
     session_description = input("Enter a short description for this session: ").strip()
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(timezone.utc),
-        "documents": [],
-        "chat_history": []
-    })
+    datastore.create_session(session_description, session_id)
     print(f"✅ New session created with ID: {session_id}")
 
     # Upload documents
@@ -98,14 +86,10 @@ if session_choice == "1":
         # TXT
         try:
             with open("cat.txt", "rb") as txt_file:
-                txt_file_id = fs.put(txt_file, filename="cat.txt")
+                txt_file_id = datastore.store_file(txt_file, "cat.txt")
                 txt_file.seek(0)
                 txt_content = txt_file.read().decode("utf-8")
-                documents_uploaded.append({
-                    "filename": "cat.txt",
-                    "gridfs_id": str(txt_file_id),
-                    "type": "txt"
-                })
+                documents_uploaded.append(datastore.document_ref("cat.txt", txt_file_id, "txt"))
                 doc_content_parts.append(txt_content)
                 print(f"✅ Uploaded cat.txt with ID {txt_file_id}")
         except FileNotFoundError:
@@ -115,12 +99,8 @@ if session_choice == "1":
         pdf_path = "4thsemcorrected.pdf"
         if os.path.exists(pdf_path):
             with open(pdf_path, "rb") as pdf_file:
-                pdf_file_id = fs.put(pdf_file, filename="4thsemcorrected.pdf")
-                documents_uploaded.append({
-                    "filename": "4thsemcorrected.pdf",
-                    "gridfs_id": str(pdf_file_id),
-                    "type": "pdf"
-                })
+                pdf_file_id = datastore.store_file(pdf_file, "4thsemcorrected.pdf")
+                documents_uploaded.append(datastore.document_ref("4thsemcorrected.pdf", pdf_file_id, "pdf"))
                 print(f"✅ Uploaded PDF with ID {pdf_file_id}")
 
             pdf = fitz.open(pdf_path)
@@ -134,16 +114,12 @@ if session_choice == "1":
         docx_path = "Bff.docx"
         if os.path.exists(docx_path):
             with open(docx_path, "rb") as docx_file:
-                docx_file_id = fs.put(docx_file, filename="Bff.docx")
-                documents_uploaded.append({
-                    "filename": "Bff.docx",
-                    "gridfs_id": str(docx_file_id),
-                    "type": "docx"
-                })
+                docx_file_id = datastore.store_file(docx_file, "Bff.docx")
+                documents_uploaded.append(datastore.document_ref("Bff.docx", docx_file_id, "docx"))
                 print(f"✅ Uploaded Bff.docx with ID {docx_file_id}")
 
             try:
-                doc = Document(docx_path)
+                doc = docx.Document(docx_path)
                 docx_text = "\n".join([p.text for p in doc.paragraphs])
                 doc_content_parts.append(docx_text)
             except Exception as e:
@@ -151,17 +127,14 @@ if session_choice == "1":
 
         # Update session
         if documents_uploaded:
-            session_collection.update_one(
-                {"_id": session_id},
-                {"$push": {"documents": {"$each": documents_uploaded}}}
-            )
+            datastore.add_documents(session_id, documents_uploaded)
 
     doc_content = "\n\n".join(doc_content_parts)
 
 # Use existing session
 elif session_choice == "2":  
     print("\n📂 Available Sessions:")
-    sessions = list(session_collection.find({}))
+    sessions = datastore.recent_sessions()
     if not sessions:
         print("❌ No existing sessions found. Exiting.")
         exit()
@@ -172,8 +145,8 @@ elif session_choice == "2":
     try:
         choice = int(input("\nEnter the number of the session you want to continue: ").strip())
         if 1 <= choice <= len(sessions):
-            session = sessions[choice - 1]
-            session_id = session['_id']
+            session_id = sessions[choice - 1]['_id']
+            session = datastore.get_session(session_id, ["documents"])
             print(f"ℹ️ Continuing session {session_id}")
              # Load already uploaded documents
             doc_content_parts = []
@@ -187,8 +160,7 @@ elif session_choice == "2":
                 seen.add(key)
 
                 try:
-                    gridout = fs.get(ObjectId(d["gridfs_id"]))
-                    content = gridout.read()
+                    content = datastore.read_file(d["gridfs_id"])
 
                     if d["type"] == "txt":
                         text = content.decode("utf-8")
@@ -207,8 +179,8 @@ elif session_choice == "2":
                     elif d["type"] == "docx":
                         with open("temp.docx", "wb") as f:
                             f.write(content)
-                        docx = Document("temp.docx")
-                        docx_text = "\n".join([p.text for p in docx.paragraphs])
+                        docx_doc = docx.Document("temp.docx")
+                        docx_text = "\n".join([p.text for p in docx_doc.paragraphs])
                         doc_content_parts.append(docx_text)
 
                     print(f"- {d.get('filename','Unknown')} (Type: {d.get('type')})")
@@ -232,7 +204,7 @@ else:
 # ------------------------------
 # Chatbot Q&A Loop
 # ------------------------------
-client = AI21Client(api_key=api_key)
+client = get_llm_client(api_key)
 
 while True:
     action = input("\nWhat do you want to do? (ask/search_doc/search_chat/exit): ").strip().lower()
@@ -275,17 +247,8 @@ while True:
         response = chat_completions.choices[0].message.content
         print("\n🧠 AI Response:", response)
 
-        session_collection.update_one(
-            {"_id": session_id},
-            {"$push": {
-                "chat_history": {
-                    "question": user_input,
-                    "answer": response,
-                    "mode": "local" if mode == "1" else "global",
-                    "timestamp": datetime.now(timezone.utc)
-                }
-            }}
-        )
+        # Store Q&A in the chat_messages collection
+        datastore.save_message(session_id, user_input, response, "local" if mode == "1" else "global")
 
     elif action == "search_doc":
         query = input("Enter keyword to search in uploaded documents: ").strip()
@@ -0,0 +1,99 @@
+"""
+Cold-start benchmark for the server and the CLI scripts.
+
+Each target's imports are run in a fresh interpreter under `python -X importtime`
+(the scripts' own top-level import statements only, so nothing prompts or
+touches MongoDB). The run fails (exit code 1) if a target
+
+  - takes longer than its budget to import (best of --runs), or
+  - loads a heavy dependency that is supposed to be deferred to first use.
+
+    python startup_bench.py                  # all targets
+    python startup_bench.py app_flask pdf    # some of them
+    STARTUP_BUDGET_SCALE=2 python startup_bench.py   # slower machine / CI runner
+"""
+import argparse
+import ast
+import os
+import re
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = [
+    "doctomongo", "embedded", "existing_session", "pdf", "search_index",
+    "task3", "task4", "task5", "upload",
+]
+
+# Import-time budgets in milliseconds (measured cost plus headroom)
+BUDGETS_MS = {"app_flask": 450, **{name: 250 for name in SCRIPTS}}
+BUDGET_SCALE = float(os.getenv("STARTUP_BUDGET_SCALE", "1"))
+
+# Must only be loaded on first use, never at startup
+DEFERRED = {"fitz", "pymupdf", "docx", "ai21", "httpx", "pymongo", "gridfs"}
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def import_code(target):
+    """Python source that performs only the target's startup imports"""
+    if target == "app_flask":
+        return "import app_flask"
+    with open(os.path.join(HERE, f"{target}.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    keep = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            keep.append(node)
+        elif (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)
+              and getattr(node.value.func, "id", None) == "lazy_import"):
+            keep.append(node)
+    return ast.unparse(ast.Module(body=keep, type_ignores=[]))
+
+
+def measure(target):
+    """Return (total import ms, {top-level module: cumulative ms}, set of loaded modules)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", import_code(target)],
+        cwd=HERE, capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{target}: import failed\n{result.stderr[-2000:]}")
+    top, loaded = {}, set()
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        loaded.add(name.split(".")[0])
+        if not indent:
+            top[name] = int(cumulative) / 1000
+    return sum(top.values()), top, loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import-time startup benchmark")
+    parser.add_argument("targets", nargs="*", default=["app_flask"] + SCRIPTS)
+    parser.add_argument("--runs", type=int, default=3, help="best of N fresh interpreters")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'target':<18}{'import ms':>10}{'budget':>8}  result")
+    for target in args.targets:
+        runs = [measure(target) for _ in range(args.runs)]
+        total, top, loaded = min(runs, key=lambda r: r[0])
+        budget = BUDGETS_MS.get(target, 250) * BUDGET_SCALE
+        problems = []
+        if total > budget:
+            problems.append("over budget")
+        eager = sorted(DEFERRED & loaded)
+        if eager:
+            problems.append("loads " + ", ".join(eager) + " at startup")
+        print(f"{target:<18}{total:>10.1f}{budget:>8.0f}  {'; '.join(problems) or 'ok'}")
+        if problems:
+            failed = True
+            heaviest = sorted(top.items(), key=lambda kv: -kv[1])[:5]
+            print("    heaviest: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in heaviest))
+
+    sys.exit(1 if failed else 0)
@@ -1,16 +1,174 @@
 const BASE_URL = "http://127.0.0.1:5000";
 let currentSessionId = null;
 
-// Utility to add messages
-function addMessage(role, text) {
+// 📌 Conditional requests
+// Polled endpoints send an ETag; repeats send it back as If-None-Match and
+// reuse the cached body when the server answers 304 Not Modified.
+const RESPONSE_CACHE_SIZE = 200;
+const responseCache = new Map(); // "METHOD url body" -> { etag, data }
+
+async function cachedJson(url, options = {}) {
+  const key = `${options.method || "GET"} ${url} ${options.body || ""}`;
+  const cached = responseCache.get(key);
+  const headers = { ...(options.headers || {}) };
+  if (cached) headers["If-None-Match"] = cached.etag;
+
+  const res = await fetch(url, { ...options, headers, cache: "no-store" });
+  if (res.status === 304 && cached) {
+    responseCache.delete(key); // refresh its position in the LRU order
+    responseCache.set(key, cached);
+    return cached.data;
+  }
+  const data = await res.json();
+  const etag = res.headers.get("ETag");
+  if (res.ok && etag) {
+    responseCache.delete(key);
+    responseCache.set(key, { etag, data });
+    if (responseCache.size > RESPONSE_CACHE_SIZE) responseCache.delete(responseCache.keys().next().value);
+  }
+  return data;
+}
+
+// 📌 Virtualized chat window
+// Only the messages near the viewport are in the DOM; the rest are
+// represented by two spacers sized from measured (or estimated) heights.
+const HISTORY_PAGE_SIZE = 50;
+const ESTIMATED_ROW_HEIGHT = 60;
+const OVERSCAN_PX = 600;
+const LOAD_OLDER_THRESHOLD_PX = 200;
+
+let chatEntries = [];      // { role, text }
+let rowHeights = [];       // measured height per entry (incl. margins)
+let historySessionId = null;
+let oldestCursor = null;
+let newestCursor = null;
+let hasMoreBefore = false;
+let loadingOlder = false;
+let renderScheduled = false;
+
+function rowHeight(i) {
+  return rowHeights[i] || ESTIMATED_ROW_HEIGHT;
+}
+
+function renderChatWindow() {
+  renderScheduled = false;
+  const chatWindow = document.getElementById("chatWindow");
+  const viewTop = chatWindow.scrollTop - OVERSCAN_PX;
+  const viewBottom = chatWindow.scrollTop + chatWindow.clientHeight + OVERSCAN_PX;
+
+  let start = 0, topHeight = 0;
+  while (start < chatEntries.length && topHeight + rowHeight(start) < viewTop) {
+    topHeight += rowHeight(start);
+    start++;
+  }
+  let end = start, bottom = topHeight;
+  while (end < chatEntries.length && bottom < viewBottom) {
+    bottom += rowHeight(end);
+    end++;
+  }
+  let bottomHeight = 0;
+  for (let i = end; i < chatEntries.length; i++) bottomHeight += rowHeight(i);
+
+  const fragment = document.createDocumentFragment();
+  const topSpacer = document.createElement("div");
+  topSpacer.className = "chat-spacer";
+  topSpacer.style.height = `${topHeight}px`;
+  fragment.appendChild(topSpacer);
+  for (let i = start; i < end; i++) {
+    const div = document.createElement("div");
+    div.className = `message ${chatEntries[i].role}`;
+    div.dataset.index = i;
+    div.innerText = chatEntries[i].text;
+    fragment.appendChild(div);
+  }
+  const bottomSpacer = document.createElement("div");
+  bottomSpacer.className = "chat-spacer";
+  bottomSpacer.style.height = `${bottomHeight}px`;
+  fragment.appendChild(bottomSpacer);
+
+  const scrollTop = chatWindow.scrollTop;
+  chatWindow.replaceChildren(fragment);
+  chatWindow.querySelectorAll(".message").forEach(div => {
+    const style = getComputedStyle(div);
+    rowHeights[+div.dataset.index] = div.offsetHeight + parseFloat(style.marginTop) + parseFloat(style.marginBottom);
+  });
+  chatWindow.scrollTop = scrollTop;
+}
+
+function scheduleRender() {
+  if (renderScheduled) return;
+  renderScheduled = true;
+  requestAnimationFrame(renderChatWindow);
+}
+
+function scrollChatToBottom() {
   const chatWindow = document.getElementById("chatWindow");
-  const div = document.createElement("div");
-  div.className = `message ${role}`;
-  div.innerText = text;
-  chatWindow.appendChild(div);
+  renderChatWindow();
   chatWindow.scrollTop = chatWindow.scrollHeight;
+  renderChatWindow();
+  chatWindow.scrollTop = chatWindow.scrollHeight;
+}
+
+function resetChatWindow() {
+  chatEntries = [];
+  rowHeights = [];
+  historySessionId = null;
+  oldestCursor = newestCursor = null;
+  hasMoreBefore = false;
+  renderChatWindow();
 }
 
+// Utility to add messages
+function addMessage(role, text) {
+  chatEntries.push({ role, text });
+  scrollChatToBottom();
+}
+
+function historyToEntries(history) {
+  const entries = [];
+  history.forEach(c => {
+    entries.push({ role: "user", text: c.question });
+    entries.push({ role: "bot", text: c.answer });
+  });
+  return entries;
+}
+
+async function fetchHistoryPage(params) {
+  return cachedJson(`${BASE_URL}/chat/history`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ session_id: currentSessionId, limit: HISTORY_PAGE_SIZE, ...params })
+  });
+}
+
+// 📌 Load older messages when scrolling near the top
+async function loadOlderHistory() {
+  if (loadingOlder || !hasMoreBefore || !oldestCursor) return;
+  loadingOlder = true;
+  const sessionId = currentSessionId;
+  try {
+    const data = await fetchHistoryPage({ before: oldestCursor });
+    if (sessionId !== currentSessionId || !data.chat_history) return;
+    const older = historyToEntries(data.chat_history);
+    if (data.chat_history.length) oldestCursor = data.chat_history[0].cursor;
+    hasMoreBefore = data.has_more_before;
+
+    // Keep the visible messages in place while content is added above them
+    const chatWindow = document.getElementById("chatWindow");
+    chatEntries = older.concat(chatEntries);
+    rowHeights = new Array(older.length).concat(rowHeights);
+    chatWindow.scrollTop += older.length * ESTIMATED_ROW_HEIGHT;
+    renderChatWindow();
+  } finally {
+    loadingOlder = false;
+  }
+}
+
+document.getElementById("chatWindow").addEventListener("scroll", function () {
+  scheduleRender();
+  if (this.scrollTop < LOAD_OLDER_THRESHOLD_PX) loadOlderHistory();
+});
+
 // 📌 Create Session
 async function createSession() {
   const desc = prompt("Enter session description:", "My Chat Session");
@@ -24,6 +182,8 @@ async function createSession() {
 
   const data = await res.json();
   currentSessionId = data.session_id;
+  resetChatWindow();
+  historySessionId = currentSessionId; // a new session has no history to fetch
 
   // Auto-open session box after creating new session
   document.getElementById("sessionBox").classList.remove("hidden");
@@ -38,19 +198,40 @@ function toggleSessionList() {
 }
 
 // 📌 List Sessions
-async function listSessions() {
-  const res = await fetch(`${BASE_URL}/session/list`);
-  const data = await res.json();
+// Sessions come one page at a time (newest first); "Load more" fetches the next page.
+const SESSION_PAGE_SIZE = 50;
+let sessionCursor = null;
+let sessionFilterTimer = null;
+
+function filterSessions() {
+  clearTimeout(sessionFilterTimer);
+  sessionFilterTimer = setTimeout(() => listSessions(), 250);
+}
+
+async function listSessions(append = false) {
+  const params = new URLSearchParams({ limit: SESSION_PAGE_SIZE });
+  const filter = document.getElementById("sessionFilter").value.trim();
+  if (filter) params.set("q", filter);
+  if (append && sessionCursor) params.set("cursor", sessionCursor);
+
+  const data = await cachedJson(`${BASE_URL}/session/list?${params}`);
+  sessionCursor = data.next_cursor;
   const list = document.getElementById("sessionList");
-  list.innerHTML = "";
 
-  // Header row
-  const header = document.createElement("li");
-  header.className = "session-header";
-  header.innerHTML = `<span>Description</span><span>Mode</span><span>Delete</span>`;
-  list.appendChild(header);
+  if (append) {
+    const more = list.querySelector(".session-more");
+    if (more) more.remove();
+  } else {
+    list.innerHTML = "";
 
-  for (const s of data) {
+    // Header row
+    const header = document.createElement("li");
+    header.className = "session-header";
+    header.innerHTML = `<span>Description</span><span>Mode</span><span>Delete</span>`;
+    list.appendChild(header);
+  }
+
+  for (const s of data.sessions) {
     const li = document.createElement("li");
     li.className = "session-item";
     if (s._id === currentSessionId) li.classList.add("active");
@@ -58,6 +239,7 @@ async function listSessions() {
     // Description
     const desc = document.createElement("span");
     desc.innerText = s.description;
+    desc.title = `${s.doc_count ?? "?"} documents · ${s.message_count ?? "?"} messages`;
     desc.onclick = () => {
       currentSessionId = s._id;
       loadChatHistory();
@@ -89,7 +271,7 @@ async function listSessions() {
       alert(result.message);
       if (s._id === currentSessionId) {
         currentSessionId = null;
-        document.getElementById("chatWindow").innerHTML = "";
+        resetChatWindow();
       }
       listSessions();
     };
@@ -103,14 +285,13 @@ async function listSessions() {
     docList.className = "doc-list";
     li.appendChild(docList);
 
-    // Fetch docs for this session
-    try {
-      const docsRes = await fetch(`${BASE_URL}/document/list`, {
+    // Fetch docs for this session (skipped when the summary says there are none)
+    if (s.doc_count !== 0) try {
+      const docsData = await cachedJson(`${BASE_URL}/document/list`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({ session_id: s._id })
       });
-      const docsData = await docsRes.json();
 
       docsData.documents.forEach(doc => {
         const docItem = document.createElement("li");
@@ -140,6 +321,16 @@ async function listSessions() {
 
     list.appendChild(li);
   }
+
+  if (sessionCursor) {
+    const more = document.createElement("li");
+    more.className = "session-more";
+    const moreBtn = document.createElement("button");
+    moreBtn.innerText = "Load more";
+    moreBtn.onclick = () => listSessions(true);
+    more.appendChild(moreBtn);
+    list.appendChild(more);
+  }
 }
 
 // 📌 Upload Document
@@ -182,23 +373,46 @@ async function askQuestion() {
     body: JSON.stringify({ session_id: currentSessionId, question, mode })
   });
   const data = await res.json();
-  addMessage("bot", data.answer);
+  // 429: rate limited or the AI provider is saturated
+  const retry = res.status === 429 ? ` Please retry in ${res.headers.get("Retry-After") || data.retry_after}s.` : "";
+  addMessage("bot", data.answer || data.error + retry);
+  // The turn is already on screen; move the refresh cursor past it
+  if (data.cursor && historySessionId === currentSessionId) newestCursor = data.cursor;
 }
 
 // 📌 Load Chat History
+// Opening a session fetches only the latest page; re-opening the same
+// session only fetches messages newer than the ones already shown.
 async function loadChatHistory() {
-  const res = await fetch(`${BASE_URL}/chat/history`, {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ session_id: currentSessionId })
-  });
-  const data = await res.json();
-  const chatWindow = document.getElementById("chatWindow");
-  chatWindow.innerHTML = "";
-  data.chat_history.forEach(c => {
-    addMessage("user", c.question);
-    addMessage("bot", c.answer);
-  });
+  const sessionId = currentSessionId;
+
+  if (historySessionId === sessionId && newestCursor) {
+    let data;
+    do {
+      data = await fetchHistoryPage({ after: newestCursor });
+      if (sessionId !== currentSessionId || !data.chat_history) return;
+      if (data.chat_history.length) {
+        newestCursor = data.chat_history[data.chat_history.length - 1].cursor;
+        chatEntries = chatEntries.concat(historyToEntries(data.chat_history));
+      }
+    } while (data.has_more_after);
+    scrollChatToBottom();
+    return;
+  }
+
+  resetChatWindow();
+  const data = await fetchHistoryPage({});
+  if (sessionId !== currentSessionId || !data.chat_history) return;
+  historySessionId = sessionId;
+  chatEntries = historyToEntries(data.chat_history);
+  if (data.chat_history.length) {
+    oldestCursor = data.chat_history[0].cursor;
+    newestCursor = data.chat_history[data.chat_history.length - 1].cursor;
+  }
+  hasMoreBefore = data.has_more_before;
+  scrollChatToBottom();
+  // A short first page may not fill the window, so no scroll event would ask for more
+  if (document.getElementById("chatWindow").scrollTop < LOAD_OLDER_THRESHOLD_PX) loadOlderHistory();
 }
 
 // 📌 Search Documents
@@ -1,20 +1,16 @@
 import os
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import datastore
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
+from llm_client import get_llm_client
+from llm_provider import ChatMessage
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Get API key from environment
 api_key = os.getenv('AI21_API_KEY')
-mongo_client = MongoClient("mongodb://localhost:27017")  # change if using Atlas
-db = mongo_client["chat_history_db"]
-collection = db["cat talk"]
 
-client = AI21Client(api_key=api_key)
+client = get_llm_client(api_key)
 
 with open("cat.txt", "r", encoding="utf-8") as file:
     doc_content = file.read()
@@ -39,9 +35,5 @@ chat_completions = client.chat.completions.create(
 
 print(chat_completions.choices[0].message.content)
 
-chat_record = { 
-    "question": user_input,
-    "answer":chat_completions.choices[0].message.content,
-    "timestamp":datetime.now(timezone.utc)  
-}
-collection.insert_one(chat_record)
\ No newline at end of file
+# task3 answers outside any session
+datastore.save_message(None, user_input, chat_completions.choices[0].message.content, "local")
\ No newline at end of file
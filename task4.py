@@ -1,40 +1,31 @@
 import os
 import uuid
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import datastore
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
+from llm_client import get_llm_client
+from llm_provider import ChatMessage
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Get API key from environment
 api_key = os.getenv('AI21_API_KEY')
-mongo_client = MongoClient("mongodb://localhost:27017")  # change if using Atlas
-db = mongo_client["chat_history_db"]
-chat_collection = db["cat talk"]
-session_collection = db["chat_sessions"]
 
 session_choice = input("Start a new session? (yes/no): ").strip().lower()
 if session_choice == "yes":
     session_id = str(uuid.uuid4())
     session_description = input("Enter a short description for this session: ").strip()
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(timezone.utc)
-    })
+    datastore.create_session(session_description, session_id)
     print(f"New session created with ID: {session_id}")
 else:
     session_id = input("Enter existing session ID: ").strip()
-    existing = session_collection.find_one({"_id": session_id})
+    existing = datastore.get_session(session_id, ["_id"])
     if not existing:
         print("❌ Session ID not found. Exiting.")
         exit()
 
 
-client = AI21Client(api_key=api_key)
+client = get_llm_client(api_key)
 
 with open("cat.txt", "r", encoding="utf-8") as file:
     doc_content = file.read()
@@ -60,10 +51,4 @@ chat_completions = client.chat.completions.create(
 
 print(chat_completions.choices[0].message.content)
 
-chat_record = { 
-    "session_id": session_id,
-    "question": user_input,
-    "answer":chat_completions.choices[0].message.content,
-    "timestamp":datetime.now(timezone.utc)  
-}
-chat_collection.insert_one(chat_record)
\ No newline at end of file
+datastore.save_message(session_id, user_input, chat_completions.choices[0].message.content, "local")
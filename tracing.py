@@ -0,0 +1,372 @@
+"""
+Per-request tracing: a span tree for each sampled request, exported offline.
+
+Every request to the Flask app gets a root span; `metrics.stage()` blocks
+(extraction, retrieval, prompt_build, llm, persistence), every MongoDB /
+GridFS command and any `span()` block below it become child spans. Work
+handed to a thread pool keeps its place in the tree when the callable is
+wrapped with `bind()`; scripts and background jobs can open their own root
+with `start_trace()`.
+
+Sampling:
+
+    TRACE_SAMPLE_RATE    fraction of requests traced from the start, 0..1 (default 0)
+    TRACE_SLOW_MS        also keep any request slower than this, 0 = off (default 0).
+                         Spans are then recorded for every request and dropped at
+                         the end unless it turned out slow or failed.
+
+An incoming W3C `traceparent` header continues the caller's trace and
+follows its sampled flag. Responses carry `traceparent` and `X-Request-ID`
+(the incoming X-Request-ID, or the trace id).
+
+Export (from a background thread, so requests never wait on it):
+
+    TRACE_EXPORT         jsonl (default) or otlp
+    TRACE_FILE           JSONL file, one span per line (default traces.jsonl)
+    TRACE_OTLP_ENDPOINT  OTLP/HTTP JSON endpoint (default http://localhost:4318/v1/traces)
+    TRACE_SERVICE_NAME   service.name resource attribute (default ai-chatbot)
+    TRACE_QUEUE_SIZE     spans buffered for export; more are dropped (default 10000)
+"""
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "jsonl")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "ai-chatbot")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+
+EXPORT_BATCH = 512
+
+
+def enabled():
+    return TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+
+
+# ------------------------------
+# Spans
+# ------------------------------
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "end_ns", "_started", "attributes", "error")
+
+    def __init__(self, trace, name, parent_id, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self._started = time.perf_counter_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        self.end_ns = self.start_ns + time.perf_counter_ns() - self._started
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        self.trace.finished(self)
+
+    def as_dict(self):
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _Trace:
+    """The spans of one local root (a request, or a job running elsewhere in the same trace)"""
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled  # head decision; unsampled traces are only kept if slow or failed
+        self.root = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def finished(self, span):
+        with self._lock:
+            self.spans.append(span)
+        if span is not self.root:
+            return
+        slow = TRACE_SLOW_MS and (span.end_ns - span.start_ns) / 1e6 >= TRACE_SLOW_MS
+        if self.sampled or slow or span.error:
+            _exporter.submit(self.spans)
+
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+def current_span():
+    return _current.get()
+
+
+def start_trace(name, parent=None, **attributes):
+    """
+    Context manager opening a local root span. `parent` is a (trace_id,
+    parent span id, sampled) tuple to continue an existing trace. Yields the
+    span, or None when this trace is not recorded.
+    """
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id, sampled = os.urandom(16).hex(), None, random.random() < TRACE_SAMPLE_RATE
+    if not sampled and not TRACE_SLOW_MS:
+        return _noop()
+    trace = _Trace(trace_id, sampled)
+    trace.root = Span(trace, name, parent_id, attributes)
+    return _activate(trace.root)
+
+
+@contextmanager
+def _noop():
+    yield None
+
+
+@contextmanager
+def _activate(span):
+    token = _current.set(span)
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current.reset(token)
+        span.end(error)
+
+
+def span(name, **attributes):
+    """Context manager for a child of the current span (a no-op outside a recorded trace)"""
+    parent = _current.get()
+    if parent is None:
+        return _noop()
+    return _activate(Span(parent.trace, name, parent.span_id, attributes))
+
+
+def annotate(**attributes):
+    """Set attributes on the current span, if any"""
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def record_span(name, duration_ns, error=None, **attributes):
+    """Add an already-finished child span that ended just now (used for MongoDB commands)"""
+    parent = _current.get()
+    if parent is None:
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    child.start_ns -= duration_ns
+    child.end_ns = child.start_ns + duration_ns
+    child.error = error
+    parent.trace.finished(child)
+
+
+def context():
+    """(trace_id, span_id, sampled) of the current span, for handing work to another thread"""
+    current = _current.get()
+    return None if current is None else (current.trace.trace_id, current.span_id, current.trace.sampled)
+
+
+def bind(fn, name=None):
+    """Wrap `fn` so that, wherever it runs, it is traced as a child of the current span"""
+    parent = context()
+    if parent is None:
+        return fn
+
+    def traced(*args, **kwargs):
+        with start_trace(name or getattr(fn, "__name__", "task"), parent=parent):
+            return fn(*args, **kwargs)
+    return traced
+
+
+# ------------------------------
+# W3C trace context
+# ------------------------------
+def parse_traceparent(header):
+    """(trace_id, parent span id, sampled) from a traceparent header, or None"""
+    try:
+        version, trace_id, span_id, flags = header.strip().split("-")
+        int(trace_id, 16), int(span_id, 16)
+        if len(trace_id) != 32 or len(span_id) != 16 or version == "ff" or not int(trace_id, 16):
+            return None
+        return trace_id, span_id, bool(int(flags, 16) & 1)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_traceparent(span):
+    return f"00-{span.trace.trace_id}-{span.span_id}-{'01' if span.trace.sampled else '00'}"
+
+
+# ------------------------------
+# Export
+# ------------------------------
+class _Exporter:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self._pid = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def submit(self, spans):
+        self._ensure_thread()
+        for s in spans:
+            try:
+                self._queue.put_nowait(s.as_dict())
+            except queue.Full:
+                self.dropped += 1
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._pid = pid
+                    threading.Thread(target=self._run, name="trace-export", daemon=True).start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < EXPORT_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                export(batch)
+            except Exception as e:
+                print("Trace export error:", e)
+
+    def flush(self, timeout=5.0):
+        """Wait until queued spans have been exported (tests and scripts that exit right away)"""
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+_exporter = _Exporter()
+flush = _exporter.flush
+
+
+def export(spans):
+    if TRACE_EXPORT == "otlp":
+        export_otlp(spans)
+    else:
+        export_jsonl(spans)
+
+
+def export_jsonl(spans, path=None):
+    lines = "".join(json.dumps(s, default=str) + "\n" for s in spans)
+    with open(path or TRACE_FILE, "a", encoding="utf-8") as f:
+        f.write(lines)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans):
+    """An OTLP/JSON ExportTraceServiceRequest body"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "tracing"},
+            "spans": [{
+                "traceId": s["trace_id"],
+                "spanId": s["span_id"],
+                **({"parentSpanId": s["parent_id"]} if s["parent_id"] else {}),
+                "name": s["name"],
+                "kind": 2 if s["parent_id"] is None else 1,  # SERVER for roots, INTERNAL below
+                "startTimeUnixNano": str(s["start_ns"]),
+                "endTimeUnixNano": str(s["end_ns"]),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s["attributes"].items()],
+                "status": {"code": 2, "message": s["error"]} if s["error"] else {"code": 1},
+            } for s in spans],
+        }],
+    }]}
+
+
+def export_otlp(spans, endpoint=None):
+    body = json.dumps(to_otlp(spans), default=str).encode("utf-8")
+    req = urllib.request.Request(endpoint or TRACE_OTLP_ENDPOINT, data=body,
+                                 headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(req, timeout=10) as response:
+        response.read()
+
+
+# ------------------------------
+# Flask integration
+# ------------------------------
+def _before_request():
+    from flask import g, request
+    parent = parse_traceparent(request.headers.get("traceparent", ""))
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    trace = start_trace(f"{request.method} {route}", parent=parent,
+                        **{"http.method": request.method, "http.route": route})
+    g.trace_scope = trace
+    root = trace.__enter__()
+    if root is not None:
+        g.request_id = request.headers.get("X-Request-ID") or root.trace.trace_id
+        root.set(**{"request.id": g.request_id})
+
+
+def _after_request(response):
+    from flask import g
+    root = _current.get()
+    if root is not None and g.get("trace_scope") is not None:
+        root.set(**{"http.status_code": response.status_code})
+        if response.status_code >= 500:
+            root.error = f"HTTP {response.status_code}"  # kept by TRACE_SLOW_MS tail sampling
+        response.headers["traceparent"] = format_traceparent(root)
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+def _teardown_request(error=None):
+    from flask import g
+    scope = g.pop("trace_scope", None)
+    if scope is not None:
+        if error is not None:
+            scope.__exit__(type(error), error, error.__traceback__)
+        else:
+            scope.__exit__(None, None, None)
+
+
+def init_app(app):
+    """Trace the requests of `app` (nothing is registered when sampling is off)"""
+    if not enabled():
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
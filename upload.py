@@ -1,38 +1,30 @@
-import fitz
 import os
 import uuid
-from pymongo import MongoClient
-from datetime import datetime, timezone
+import datastore
 from dotenv import load_dotenv
-from ai21 import AI21Client
-from ai21.models.chat import ChatMessage
-import gridfs
+from llm_client import get_llm_client
+from llm_provider import ChatMessage
+from lazy_imports import lazy_import
+
+# Heavy parsers, loaded on first use
+fitz = lazy_import("fitz")
 
 # Load environment variables
 load_dotenv()
 
-# Get API key and MongoDB URI from environment
+# Get API key from environment
 api_key = os.getenv('AI21_API_KEY')
-mongo_client = MongoClient("mongodb://localhost:27017")  # Update if using Atlas
-db = mongo_client["chat_history_db"]
-fs = gridfs.GridFS(db)  # Create a GridFS instance
-chat_collection = db["cat_talk"]
-session_collection = db["chat_sessions"]
 
 # Create or continue a session
 session_choice = input("Start a new session? (yes/no): ").strip().lower()
 if session_choice == "yes":
     session_id = str(uuid.uuid4())
     session_description = input("Enter a short description for this session: ").strip()
-    session_collection.insert_one({
-        "_id": session_id,
-        "description": session_description,
-        "created_at": datetime.now(timezone.utc)
-    })
+    datastore.create_session(session_description, session_id)
     print(f"✅ New session created with ID: {session_id}")
 else:
     session_id = input("Enter existing session ID: ").strip()
-    existing = session_collection.find_one({"_id": session_id})
+    existing = datastore.get_session(session_id, ["_id"])
     if not existing:
         print("❌ Session ID not found. Exiting.")
         exit()
@@ -44,7 +36,7 @@ if upload_choice == "yes":
     # Upload txt file
     try:
         with open("cat.txt", "rb") as txt_file:
-            txt_file_id = fs.put(txt_file, filename="cat.txt")
+            txt_file_id = datastore.store_file(txt_file, "cat.txt")
             print(f"✅ Uploaded cat.txt to GridFS with ID: {txt_file_id}")
             txt_file.seek(0)
             txt_content = txt_file.read().decode("utf-8")
@@ -57,7 +49,7 @@ if upload_choice == "yes":
     pdf_path = "4thsemcorrected.pdf"
     if os.path.exists(pdf_path):
         with open(pdf_path, "rb") as pdf_file:
-            pdf_file_id = fs.put(pdf_file, filename="4thsemcorrected.pdf")
+            pdf_file_id = datastore.store_file(pdf_file, "4thsemcorrected.pdf")
             print(f"✅ Uploaded PDF to GridFS with ID: {pdf_file_id}")
         doc = fitz.open(pdf_path)
         for page in doc:
@@ -69,13 +61,16 @@ if upload_choice == "yes":
     # Upload DOCX file
     try:
         with open("Bff.docx", "rb") as docx_file:
-            docx_file_id = fs.put(docx_file, filename="Bff.docx")
+            docx_file_id = datastore.store_file(docx_file, "Bff.docx")
             print(f"✅ Uploaded Bff.docx to GridFS with ID: {docx_file_id}")
     except FileNotFoundError:
         print("❌ Bff.docx file not found.")
 
     doc_content = txt_content + "\n\n" + pdf_content
 
+# Initialize AI21 client (once, so retries and the circuit breaker span the whole chat)
+client = get_llm_client(api_key)
+
 # Start question-answer loop
 while True:
     ask_choice = input("\nDo you want to ask a question? (yes/exit): ").strip().lower()
@@ -110,8 +105,6 @@ while True:
         print("👋 Chat ended.")
         break
 
-    # Initialize AI21 client
-    client = AI21Client(api_key=api_key)
     messages = [
         ChatMessage(content=system, role="system"),
         ChatMessage(content=user_input, role="user"),
@@ -125,10 +118,4 @@ while True:
     response = chat_completions.choices[0].message.content
     print("\n🧠 AI Response:", response)
 
-    chat_record = {
-        "session_id": session_id,
-        "question": user_input,
-        "answer": response,
-        "timestamp": datetime.now(timezone.utc)
-    }
-    chat_collection.insert_one(chat_record)
+    datastore.save_message(session_id, user_input, response, "local" if mode == "1" else "global")
@@ -0,0 +1,341 @@
+"""
+Continuous ingestion of watched directories into a session (`python cli.py watch`).
+
+Changes under the watched directories are collected and, once no new event
+has arrived for --debounce seconds (or --max-delay seconds after the first
+one, during a steady stream of changes), handled as one batch:
+
+  - new or modified files go through the ingest pipeline (ingest.py), so a
+    file is re-extracted and re-stored only when its SHA-256 changed; the
+    extractive index picks up the new version on the next question, since
+    its cache is keyed by GridFS ids
+  - deleted files (or files under a deleted directory) are removed from the
+    session and GridFS through datastore.delete_documents, exactly as
+    /document/delete does
+
+Files are named as `cli.py ingest` names them given the same directories
+(relative to the watched directory, prefixed with a label for it when more
+than one is watched: contracts/a.txt, policies/a.txt), so both commands can
+feed the same session. Directories that overlap (the same one twice, or one
+inside another) are refused, since their files would have two names. Only
+documents that came from files (those with a sha256) are ever deleted;
+uploads made through the app are left alone.
+
+On Linux, events come from inotify (through ctypes, no extra dependency);
+elsewhere, or with --poll, the directories are rescanned every
+--poll-interval seconds. On start the directories are ingested once to
+pick up changes made while the watcher was stopped; --prune also deletes
+documents whose files are gone. When inotify drops events (queue overflow)
+the watcher does the same full sync, with pruning, since deletions may be
+among the lost events.
+
+    python cli.py watch shared/contracts shared/policies --session <id>
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+import datastore
+from ingest import (
+    SUPPORTED_TYPES, Ingester, State, discover, document_name, file_type, root_labels, state_path_for
+)
+
+# inotify(7) event bits
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def ignored_name(name):
+    # Editor swap files, Office lock files and partial downloads
+    return name.startswith((".", "~$")) or name.endswith(("~", ".tmp", ".part", ".crdownload"))
+
+
+# ------------------------------
+# Event sources: read(timeout) -> [(path, deleted, is_dir)]
+# ------------------------------
+class PollingSource:
+    """Rescans the directories and diffs (size, mtime) snapshots"""
+
+    def __init__(self, roots, interval=2.0):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        files = {}
+        for root in self.roots:
+            for directory, dirs, names in os.walk(root):
+                dirs[:] = [d for d in dirs if not ignored_name(d)]
+                for name in names:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue  # removed between listing and stat
+                    files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = self._scan()
+        events = [(path, False, False) for path, sig in current.items() if self.snapshot.get(path) != sig]
+        events += [(path, True, False) for path in self.snapshot.keys() - current.keys()]
+        self.snapshot = current
+        return events
+
+    def close(self):
+        pass
+
+
+class InotifySource:
+    """Linux inotify on every directory under the roots (new subdirectories are added as they appear)"""
+
+    def __init__(self, roots):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}  # watch descriptor -> directory
+        self.overflowed = False
+        for root in roots:
+            self._watch_tree(root)
+
+    def _watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0 and ctypes.get_errno() == errno.ENOENT:
+            return  # removed before it could be watched; its delete event follows
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory} "
+                                              "(raise fs.inotify.max_user_watches or use --poll)")
+        self.paths[wd] = directory
+
+    def _watch_tree(self, root):
+        """Watch `root` and its subdirectories; returns the files already in them"""
+        # Watch before listing, so a file created in between is either listed or reported
+        self._watch(root)
+        found = []
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            return found  # already gone again
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not ignored_name(entry.name):
+                    found += self._watch_tree(entry.path)
+            else:
+                found.append(entry.path)
+        return found
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 256 * 1024)
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True  # events were lost; the watcher rescans
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            directory = self.paths.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files can land in a new directory before it is watched: report what is there
+                    events += [(p, False, False) for p in self._watch_tree(path)]
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.append((path, True, True))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append((path, True, False))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                events.append((path, False, False))  # IN_CREATE alone: wait for the writer to close it
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def event_source(roots, poll=False, poll_interval=2.0):
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifySource(roots)
+        except OSError as e:
+            print(f"inotify unavailable ({e}); polling every {poll_interval}s", file=sys.stderr)
+    return PollingSource(roots, poll_interval)
+
+
+# ------------------------------
+# Watcher
+# ------------------------------
+def check_roots(roots):
+    """ValueError when watched directories overlap: their files would get two document names"""
+    real = [os.path.realpath(r) for r in roots]
+    for i, a in enumerate(real):
+        for j, b in enumerate(real):
+            if i != j and (a == b or b.startswith(a.rstrip(os.sep) + os.sep)):
+                raise ValueError(f"{roots[j]} is already watched through {roots[i]}")
+
+
+class Watcher:
+    def __init__(self, session_id, roots, source, types=SUPPORTED_TYPES, debounce=2.0, max_delay=30.0,
+                 workers=4, state_path=None, stream=sys.stderr):
+        self.session_id = session_id
+        self.roots = [os.path.abspath(r) for r in roots]
+        check_roots(self.roots)
+        self.labels = root_labels(self.roots) if len(self.roots) > 1 else [""]
+        self.source = source
+        self.types = types
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.workers = workers
+        # Loaded once: a fresh Ingester per batch would re-read the whole state file every time
+        self.state = State(state_path or state_path_for(session_id))
+        self.stream = stream
+        self.pending = {}  # path -> (deleted, is_dir), latest event wins
+        self._first = self._last = None
+
+    def _name(self, path):
+        """(root, document name) for a path under one of the roots, else None"""
+        for root, label in zip(self.roots, self.labels):
+            if path == root or path.startswith(root + os.sep):
+                return root, document_name(path, root, label)
+        return None
+
+    def _wanted(self, path):
+        return not ignored_name(os.path.basename(path)) and file_type(path) in self.types
+
+    def sync(self, prune=False):
+        """Ingest everything under the roots; with `prune`, delete documents whose files are gone"""
+        files = [(path, name) for path, name in discover(self.roots, self.types) if self._wanted(path)]
+        self._ingest(files)
+        if prune:
+            present = {name for _, name in files}
+            session = datastore.get_session(self.session_id, ["documents"]) or {}
+            gone = [d["filename"] for d in session.get("documents", [])
+                    if d.get("sha256") and d["filename"] not in present]
+            self._delete(gone)
+
+    def _ingest(self, files):
+        if not files:
+            return
+        ingester = Ingester(self.session_id, workers=self.workers, state=self.state)
+        ingester.run(files)
+        for path, error in ingester.failures:
+            print(f"failed: {path}: {error}", file=self.stream)
+
+    def _delete(self, names, prefixes=()):
+        """Delete file-backed documents by name, or everything under directory prefixes"""
+        names = set(names)
+        if prefixes:
+            session = datastore.get_session(self.session_id, ["documents"]) or {}
+            names.update(d["filename"] for d in session.get("documents", [])
+                         if d.get("sha256") and d["filename"].startswith(tuple(prefixes)))
+        if names:
+            removed = datastore.delete_documents(self.session_id, names)
+            for document in removed:
+                print(f"deleted {document['filename']}", file=self.stream)
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        self._first = self._last = None
+        changed, deleted, prefixes = [], [], []
+        for path, (is_deleted, is_dir) in pending.items():
+            located = self._name(path)
+            if located is None:
+                continue
+            _, name = located
+            if is_dir:
+                prefixes.append(name + "/")
+            elif is_deleted or not os.path.isfile(path):
+                if self._wanted(path):
+                    deleted.append(name)
+            elif self._wanted(path):
+                changed.append((path, name))
+        self._ingest(sorted(changed))
+        self._delete(deleted, prefixes)
+
+    def run(self, stop=None):
+        """Handle events until `stop()` returns true (or forever)"""
+        while not (stop and stop()):
+            now = time.monotonic()
+            timeout = 1.0
+            if self._last is not None:
+                timeout = max(0.0, min(self._last + self.debounce, self._first + self.max_delay) - now)
+            for path, deleted, is_dir in self.source.read(timeout):
+                self.pending[path] = (deleted, is_dir)
+                self._last = time.monotonic()
+                self._first = self._first or self._last
+            if getattr(self.source, "overflowed", False):
+                self.source.overflowed = False
+                self.pending.clear()
+                self._first = self._last = None
+                print("event queue overflowed; resyncing", file=self.stream)
+                self.sync(prune=True)  # lost events may include deletions
+                continue
+            now = time.monotonic()
+            if self.pending and (now - self._last >= self.debounce or now - self._first >= self.max_delay):
+                self.flush()
+
+
+def run(args):
+    """`cli.py watch`"""
+    types = tuple(t.strip().lower().lstrip(".") for t in args.types.split(",") if t.strip())
+    missing = [d for d in args.directories if not os.path.isdir(d)]
+    if missing:
+        raise SystemExit(f"Not a directory: {', '.join(missing)}")
+    if not datastore.get_session(args.session, ["_id"]):
+        raise SystemExit(f"Session {args.session} not found")
+
+    roots = [os.path.abspath(d) for d in args.directories]
+    try:
+        check_roots(roots)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    source = event_source(roots, args.poll, args.poll_interval)
+    watcher = Watcher(args.session, roots, source, types=types, debounce=args.debounce,
+                      max_delay=args.max_delay, workers=args.workers, state_path=args.state)
+    try:
+        watcher.sync(prune=args.prune)
+        print(f"watching {', '.join(watcher.roots)} ({type(source).__name__})", file=sys.stderr)
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.flush()
+    finally:
+        source.close()
+        watcher.state.close()
+    return 0
+
+
+def add_arguments(parser):
+    parser.add_argument("directories", nargs="+", help="directories to watch (recursively)")
+    parser.add_argument("--session", required=True, help="session the files are ingested into")
+    parser.add_argument("--types", default=",".join(SUPPORTED_TYPES), help="comma-separated file types")
+    parser.add_argument("--debounce", type=float, default=2.0, help="quiet seconds before a batch is handled")
+    parser.add_argument("--max-delay", type=float, default=30.0, help="longest a change waits under constant churn")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent hash/extract/upload workers")
+    parser.add_argument("--poll", action="store_true", help="rescan instead of using inotify")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="seconds between rescans with --poll")
+    parser.add_argument("--prune", action="store_true", help="on start, delete documents whose files are gone")
+    parser.add_argument("--state", help="ingest state file (default .ingest_state/<session>.jsonl)")
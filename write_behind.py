@@ -0,0 +1,343 @@
+"""
+Write-behind persistence for chat messages.
+
+/ask hands its finished turn to a MessageWriter and returns straight away;
+a background thread flushes queued messages to MongoDB with one bulk_write
+per batch (plus one counter update per session, and the token rollups of
+llm_usage.py when a rollups collection is given). Controls:
+
+    WRITE_BEHIND              1 = buffer writes (default), 0 = write synchronously
+    WRITE_BEHIND_FLUSH_MS     maximum time a message waits before being flushed
+    WRITE_BEHIND_MAX_BATCH    messages per bulk_write
+    WRITE_BEHIND_MAX_PENDING  above this many queued messages, writers flush inline (back-pressure),
+                              and are refused with WriteBehindFull while that doesn't help
+    WRITE_BEHIND_MAX_ATTEMPTS flushes a batch failing with a non-transient error gets (with
+                              exponential backoff) before its records are written one by one and
+                              the ones that still fail are set aside in WRITE_BEHIND_DEAD_LETTER
+    WRITE_BEHIND_DEAD_LETTER  directory for records that could not be written; its data.ndjson is
+                              in the export format, so `python cli.py import <dir>` loads it later
+
+Transient errors (MongoDB unreachable, a failover in progress) are waited
+out: the batch is retried with backoff for as long as it takes, and only
+the WRITE_BEHIND_MAX_PENDING bound on the queue limits what is held in
+memory meanwhile. Nothing is set aside because of an outage.
+
+Session counters and token rollups are applied once per message: a retried
+batch only applies what the failed attempt didn't, and a message that turns
+out to be in MongoDB already (inserted by an earlier attempt) is not counted
+again. A record set aside keeps what it still owes in its dead-letter line,
+and the import applies that once (see settle_owed). Deleting a session
+discards its queued records (see discard). Pending messages are flushed on
+interpreter shutdown. Until a message is
+flushed it is still visible to readers in this process through `pending()`,
+which the history readers merge in (read-your-writes). The guarantee is
+per process: with several workers, a read served by another worker may lag
+by up to one flush interval.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from bson import json_util
+from dotenv import load_dotenv
+
+import llm_usage
+from lazy_imports import lazy_import
+
+pymongo = lazy_import("pymongo")
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "200"))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "6"))
+WRITE_BEHIND_DEAD_LETTER = os.getenv("WRITE_BEHIND_DEAD_LETTER", "write_behind_dead_letter")
+RETRY_BACKOFF_MAX_SEC = 30.0
+
+DUPLICATE_KEY = 11000
+
+
+class WriteBehindFull(Exception):
+    """The queue is at WRITE_BEHIND_MAX_PENDING and MongoDB isn't taking writes"""
+
+
+def is_transient(error):
+    """Errors worth waiting out (MongoDB unreachable, failover) rather than setting records aside"""
+    if isinstance(error, pymongo.errors.ConnectionFailure):
+        return True
+    return isinstance(error, pymongo.errors.PyMongoError) and error.has_error_label("RetryableWriteError")
+
+
+def update_session_counters(sessions, records):
+    """Bump message_count / version / last_activity of the sessions of newly written `records`"""
+    per_session = {}
+    for record in records:
+        count, last = per_session.get(record["session_id"], (0, record["timestamp"]))
+        per_session[record["session_id"]] = (count + 1, max(last, record["timestamp"]))
+    sessions.bulk_write([
+        pymongo.UpdateOne({"_id": sid}, {"$inc": {"message_count": count, "version": count},
+                                         "$max": {"last_activity": last}})
+        for sid, (count, last) in per_session.items()
+    ], ordered=False)
+
+
+def settle_owed(messages, sessions, rollups, entries):
+    """
+    Apply the steps dead-lettered records still owe, `entries` being
+    (record, steps) pairs of records already in `messages`. Each record is
+    claimed with an `owed_settled` flag first, so importing the same dead
+    letter again applies nothing twice.
+    """
+    claimed = {"session": [], "rollups": []}
+    for record, steps in entries:
+        result = messages.update_one({"_id": record["_id"], "owed_settled": {"$exists": False}},
+                                     {"$set": {"owed_settled": True}})
+        if result.modified_count:
+            for step in steps:
+                claimed[step].append(record)
+    if claimed["session"]:
+        update_session_counters(sessions, claimed["session"])
+    if claimed["rollups"] and rollups is not None:
+        llm_usage.record_rollups(rollups, claimed["rollups"])
+
+
+class MessageWriter:
+    """Queue chat message records and persist them in batches"""
+
+    def __init__(self, messages, sessions, enabled=WRITE_BEHIND, flush_ms=WRITE_BEHIND_FLUSH_MS,
+                 max_batch=WRITE_BEHIND_MAX_BATCH, max_pending=WRITE_BEHIND_MAX_PENDING, on_write=None, rollups=None,
+                 max_attempts=WRITE_BEHIND_MAX_ATTEMPTS, dead_letter=WRITE_BEHIND_DEAD_LETTER):
+        self.messages = messages
+        self.sessions = sessions
+        self.rollups = rollups  # per session/day token counters, see llm_usage.py
+        self.on_write = on_write  # called with the session ids of every written batch
+        self.enabled = enabled
+        self.flush_interval = flush_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_attempts = max(1, max_attempts)
+        self.dead_letter = dead_letter
+        self._queue = []                    # records not yet handed to MongoDB
+        self._by_session = defaultdict(list)  # records not yet confirmed, for read-your-writes
+        self._owed = {}      # _id -> steps ("session", "rollups") still owed by an inserted record
+        self._failures = 0   # consecutive failed flushes, for the backoff
+        self._attempts = 0   # of those, the ones that failed with a non-transient error
+        self._last_error = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread_pid = None  # the flusher is started lazily, in the process that submits
+        if enabled:
+            atexit.register(self.close)
+
+    def _ensure_thread(self):
+        # Threads don't survive fork: a pre-forked worker starts its own flusher
+        pid = os.getpid()
+        if self._thread_pid != pid:
+            with self._lock:
+                if self._thread_pid != pid:
+                    self._thread_pid = pid
+                    threading.Thread(target=self._run, name="write-behind", daemon=True).start()
+
+    # ------------------------------
+    # Writing
+    # ------------------------------
+    def submit(self, record):
+        """Persist `record` (which must already carry _id and timestamp)"""
+        if not self.enabled:
+            try:
+                self._write([record])
+            finally:
+                with self._lock:
+                    self._owed.pop(record["_id"], None)  # no retry: the caller sees the error
+            return
+        self._ensure_thread()
+        if self._backlog() >= self.max_pending:
+            # Back-pressure: the writer pays for a flush, and is turned away if MongoDB still isn't taking them
+            self.flush()
+            if self._backlog() >= self.max_pending:
+                raise WriteBehindFull(f"{self._backlog()} messages waiting for MongoDB") from self._last_error
+        with self._lock:
+            self._queue.append(record)
+            self._by_session[record["session_id"]].append(record)
+            backlog = len(self._queue)
+        if backlog >= self.max_batch and not self._failures:  # while failing, the backoff decides
+            self._wakeup.set()
+
+    def _backlog(self):
+        with self._lock:
+            return len(self._queue)
+
+    def discard(self, session_id):
+        """Drop the queued records of `session_id`, whose session is being deleted; returns how many"""
+        with self._flush_lock:  # so none of them is in a batch being written (or about to be retried)
+            with self._lock:
+                queued = len(self._queue)
+                self._queue = [r for r in self._queue if r["session_id"] != session_id]
+                for record in self._by_session.pop(session_id, ()):
+                    self._owed.pop(record["_id"], None)
+                return queued - len(self._queue)
+
+    def flush(self):
+        """Write everything queued so far; returns the number of messages written"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._queue[:self.max_batch]
+                    del self._queue[:len(batch)]
+                if not batch:
+                    return written
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    self._failures += 1
+                    self._last_error = e
+                    if is_transient(e):
+                        # An outage: put the batch back in order, the flusher retries it after a backoff
+                        self._requeue(batch)
+                        log.warning("Write-behind flush failed, retrying (%d queued): %s", self._backlog(), e)
+                        return written
+                    self._attempts += 1
+                    if self._attempts < self.max_attempts:
+                        log.warning("Write-behind flush failed (attempt %d of %d): %s",
+                                    self._attempts, self.max_attempts, e)
+                        self._requeue(batch)
+                        return written
+                    log.error("Write-behind batch of %d failed %d times, isolating bad records: %s",
+                              len(batch), self._attempts, e)
+                    self._attempts = 0
+                    done = self._write_each(batch)
+                    self._confirm(batch[:done])
+                    written += done
+                    if done < len(batch):
+                        self._requeue(batch[done:])
+                        return written
+                    self._failures = 0
+                    continue
+                self._failures = self._attempts = 0
+                self._confirm(batch)
+                written += len(batch)
+
+    def _requeue(self, batch):
+        with self._lock:
+            self._queue[:0] = batch
+
+    def _confirm(self, batch):
+        """Drop written (or set aside) records from the read-your-writes view"""
+        with self._lock:
+            for record in batch:
+                pending = self._by_session.get(record["session_id"])
+                if pending:
+                    pending.remove(record)
+                    if not pending:
+                        del self._by_session[record["session_id"]]
+
+    def _write_each(self, batch):
+        """
+        Last resort for a batch that keeps failing: write records singly and set aside
+        those that fail. Stops at a transient error; returns how many records were dealt with.
+        """
+        for i, record in enumerate(batch):
+            try:
+                self._write([record])
+            except Exception as e:
+                if is_transient(e):
+                    self._last_error = e
+                    log.warning("Write-behind isolation interrupted, retrying: %s", e)
+                    return i
+                log.error("Write-behind record %s set aside in %s: %s", record["_id"], self.dead_letter, e)
+                self._set_aside(record)
+        return len(batch)
+
+    def _steps(self):
+        return {"session"} | ({"rollups"} if self.rollups is not None else set())
+
+    def _set_aside(self, record):
+        with self._lock:
+            owed = self._owed.pop(record["_id"], None)
+        # Not inserted at all: it owes every step; inserted: the ones that failed
+        owed = self._steps() if owed is None else owed
+        try:
+            os.makedirs(self.dead_letter, exist_ok=True)
+            line = json_util.dumps({"kind": "message", "doc": record, "owed": sorted(owed)},
+                                   json_options=json_util.RELAXED_JSON_OPTIONS) + "\n"
+            with open(os.path.join(self.dead_letter, "data.ndjson"), "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            log.error("Write-behind record %s lost, dead letter not writable: %s", record["_id"], e)
+
+    def _insert(self, batch):
+        """Insert `batch`; the records that weren't in MongoDB already"""
+        try:
+            self.messages.bulk_write([pymongo.InsertOne(r) for r in batch], ordered=False)
+            return batch
+        except pymongo.errors.BulkWriteError as e:
+            # Records that made it in before a retried flush show up as duplicates
+            errors = e.details["writeErrors"]
+            if any(err["code"] != DUPLICATE_KEY for err in errors):
+                raise
+            duplicates = {err["index"] for err in errors}
+            return [r for i, r in enumerate(batch) if i not in duplicates]
+
+    def _write(self, batch):
+        steps = self._steps()
+        inserted = self._insert(batch)
+        with self._lock:
+            for record in inserted:
+                self._owed[record["_id"]] = set(steps)
+        # Each step runs for the records still owing it: a retry after a failed
+        # session or rollup update neither skips nor repeats any of them
+        self._apply(batch, "session", lambda records: update_session_counters(self.sessions, records))
+        if self.rollups is not None:
+            self._apply(batch, "rollups", lambda records: llm_usage.record_rollups(self.rollups, records))
+        if self.on_write:
+            try:
+                self.on_write(list({r["session_id"] for r in batch}))
+            except Exception as e:
+                # The batch itself is written; don't requeue it over a bookkeeping failure
+                log.warning("Write-behind on_write error: %s", e)
+
+    def _apply(self, batch, step, update):
+        with self._lock:
+            records = [r for r in batch if step in self._owed.get(r["_id"], ())]
+        if not records:
+            return
+        update(records)
+        with self._lock:
+            for record in records:
+                owed = self._owed.get(record["_id"])
+                if owed is not None:
+                    owed.discard(step)
+                    if not owed:
+                        del self._owed[record["_id"]]
+
+    def _run(self):
+        while not self._stopped:
+            # After failed flushes, back off exponentially instead of hammering MongoDB
+            # (the exponent is capped: an outage can last many thousands of failed flushes)
+            delay = self.flush_interval * 2 ** min(self._failures, 20)
+            self._wakeup.wait(min(delay, RETRY_BACKOFF_MAX_SEC))
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and flush what is left"""
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+    # ------------------------------
+    # Reading
+    # ------------------------------
+    def pending(self, session_id):
+        """Messages of `session_id` accepted but not yet confirmed in MongoDB, oldest first"""
+        with self._lock:
+            return list(self._by_session.get(session_id, ()))